@@ -1,44 +1,178 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import logging
 import json
+import hmac
+import signal
 import aiohttp
+from aiohttp import web
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, BaseMiddleware, types
 from aiogram.filters import Command
 from aiogram.filters.command import CommandObject
 from aiogram.enums import ParseMode
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, FSInputFile
 import time
 import asyncio
 import re
 from datetime import datetime
-from collections import deque
+from email.utils import parsedate_to_datetime
+from collections import deque, OrderedDict
+from itertools import islice
+from contextlib import asynccontextmanager, contextmanager
 import speech_recognition as sr
 import tempfile
 # Добавляем импорты для Vosk
 import vosk
 import wave
-import concurrent.futures
 import subprocess
 import threading
+import glob
+import multiprocessing
+import functools
+import contextvars
+import traceback
+import cProfile
+import pstats
+import tracemalloc
+import html
+import random
+from queue import SimpleQueue
+from concurrent.futures import ThreadPoolExecutor
+# Быстрые JSON библиотеки необязательны: если их нет, используется стандартный json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+# Клиент Redis нужен только для общего состояния моделей между несколькими экземплярами бота
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+# Без prometheus_client метрики не собираются, а /metrics сообщает, что библиотека не установлена
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+# OpenTelemetry нужен только для отправки трассировок в коллектор (TRACE_EXPORTER=otlp)
+try:
+    from opentelemetry import trace as otel_trace
+    from opentelemetry import context as otel_context
+    from opentelemetry.sdk.resources import Resource as OtelResource
+    from opentelemetry.sdk.trace import TracerProvider as OtelTracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor as OtelBatchSpanProcessor
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+except ImportError:
+    otel_trace = None
+# yappi необязателен: с ним /profile учитывает и потоки, без него используется cProfile
+try:
+    import yappi
+except ImportError:
+    yappi = None
 
 # Путь к файлу с настройками пользователей
 SETTINGS_FILE = "user_settings.json"
 HISTORY_FILE = "user_history.json"
+SUMMARY_FILE = "user_summaries.json"
+USER_STATE_DIR = "user_state"  # Каталог с состоянием неактивных пользователей, выгруженных из памяти
 
 # Константы для таймаутов
 VOICE_RECOGNITION_TIMEOUT = 120  # Таймаут для распознавания голоса (в секундах)
+VOICE_RECOGNITION_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # Сколько сообщений Vosk распознает одновременно, каждое занимает ядро
 FFMPEG_CONVERSION_TIMEOUT = 60   # Таймаут для конвертации аудио через ffmpeg (в секундах)
 API_CHECK_TIMEOUT = 30          # Таймаут для проверки API моделей (в секундах)
 API_MIN_CHECK_TIME = 1         # Минимальное время проверки API (в секундах)
 
+# Таймауты запросов к моделям считаются для каждой модели по ее недавним задержкам,
+# отдельно на установку соединения, первый байт ответа и весь ответ
+REQUEST_CONNECT_TIMEOUT = 5      # Установка соединения с API (в секундах)
+REQUEST_TIMEOUT_DEFAULT = 30     # Таймаут ответа на TIMEOUT_REFERENCE_TOKENS токенов, пока у модели мало замеров
+MODEL_TIMEOUT_DEFAULTS = {       # Модели с рассуждениями отвечают заметно дольше остальных
+    "deepseek/deepseek-r1": 90,
+    "deepseek/deepseek-r1-zero:free": 90,
+    "perplexity/sonar-reasoning-pro": 90,
+    "perplexity/r1-1776": 90
+}
+TIMEOUT_REFERENCE_TOKENS = 500   # Длина ответа, к которой относятся таймауты по умолчанию
+TIMEOUT_OVERHEAD_TOKENS = 100    # Часть задержки, не зависящая от длины ответа, в пересчете на токены
+TIMEOUT_PERCENTILE = 95          # Перцентиль недавних задержек модели, от которого считается таймаут
+TIMEOUT_MARGIN = 2.0             # Во сколько раз таймаут больше перцентиля задержки
+TIMEOUT_WINDOW = 50              # Сколько последних успешных ответов модели учитывать
+TIMEOUT_MIN_SAMPLES = 5          # Сколько ответов нужно, чтобы считать таймаут по замерам
+MIN_REQUEST_TIMEOUT = 10         # Нижняя граница таймаута ответа (в секундах)
+MIN_FIRST_BYTE_TIMEOUT = 5       # Нижняя граница таймаута первого байта (в секундах)
+MAX_REQUEST_TIMEOUT = 180        # Верхняя граница таймаута ответа (в секундах)
+TIMEOUT_BACKOFF = 1.5            # Во сколько раз увеличивается таймаут после каждого таймаута подряд,
+                                 # но не больше таймаута по умолчанию для модели
+
+# Ограничения на одновременные запросы к API моделей
+MAX_CONCURRENT_REQUESTS = 8      # Общий лимит одновременных запросов ко всем провайдерам
+PROVIDER_CONCURRENCY_LIMITS = {  # Лимиты одновременных запросов для каждого провайдера
+    "openrouter": 6,
+    "together": 3,
+    "huggingface": 2
+}
+MAX_QUEUE_SIZE = 200             # Максимальное количество запросов, ожидающих в очереди
+QUEUE_MAX_WAIT = 90              # Максимальное время ожидания в очереди (в секундах)
+QUEUE_POSITION_UPDATE_INTERVAL = 3  # Как часто обновлять сообщение с позицией в очереди (в секундах)
+STREAM_UPDATE_INTERVAL = 1.5     # Как часто показывать готовую часть ответа при потоковой генерации (в секундах)
+
+# Параметры выбора моделей по задержке и доле успешных ответов
+AUTO_MODEL = "auto"              # Значение настройки model, при котором модель выбирается автоматически
+ROUTER_EWMA_ALPHA = 0.2          # Вес нового запроса в сглаженных оценках модели
+ROUTER_PRIOR_LATENCY = 10.0      # Предполагаемая задержка модели без замеров (в секундах)
+ROUTER_PRIOR_SUCCESS = {         # Предполагаемая доля успешных ответов по статусу модели
+    "fully_working": 0.9,
+    "partially_working": 0.5,
+    "unavailable": 0.05
+}
+ROUTER_RECOVERY_HALF_LIFE = 600  # За сколько секунд без запросов оценка модели наполовину возвращается к предполагаемой
+ROUTER_EXPLORATION = 0.05        # Доля запросов "auto", отправляемых случайной рабочей модели для обновления оценок
+
+# Параметры сжатия длинной истории диалога в краткое содержание
+SUMMARY_TRIGGER_MESSAGES = 24    # С какого количества сообщений в истории начинать сжатие. Более короткая
+                                 # история не сжимается: старые сообщения просто отбрасываются
+SUMMARY_KEEP_RECENT = 12         # Сколько последних сообщений оставлять в истории без сжатия
+SUMMARY_MAX_TOKENS = 400         # Максимальная длина краткого содержания (в токенах)
+SUMMARY_MODEL = "google/gemini-2.0-flash-lite-preview-02-05:free"  # Быстрая модель для сжатия
+
+# Ограничения частоты запросов к провайдерам: (запросов в секунду, допустимая пачка запросов)
+PROVIDER_RATE_LIMITS = {
+    "openrouter": (3.0, 10),
+    "together": (1.0, 5),
+    "huggingface": (0.5, 3)
+}
+RATE_LIMIT_MAX_RETRIES = 3       # Сколько раз повторять запрос после ответа 429
+
+# Ограничения Telegram Bot API на отправку сообщений
+TELEGRAM_GLOBAL_RATE = 30        # Сообщений в секунду для всего бота
+TELEGRAM_CHAT_RATE = 1.0         # Сообщений в секунду в личном чате
+TELEGRAM_GROUP_CHAT_RATE = 20 / 60  # Сообщений в секунду в группе
+TELEGRAM_CHAT_BURST = 3          # Сколько сообщений подряд можно отправить в чат без паузы
+TELEGRAM_SEND_RETRIES = 3        # Сколько раз повторять запрос после TelegramRetryAfter
+TELEGRAM_MAX_RETRY_AFTER = 60    # Дольше этого времени (в секундах) не ждем, а возвращаем ошибку
+
+# Выгрузка неактивных пользователей из памяти
+USER_EVICTION_INTERVAL = 5 * 60  # Как часто проверять неактивных пользователей (в секундах)
+SNAPSHOT_DELAY = 2               # Через сколько секунд после изменения записывать данные на диск
+
 VOSK_MODEL_PATH = "vosk-model-ru-0.22"
 vosk_model = None
 use_local_recognition = True
 
-recognition_stop_flag = threading.Event()
+# Отдельный ограниченный пул для Vosk: распознавание долго занимает процессор и не должно
+# вытеснять из пула по умолчанию короткие задачи (ffmpeg, запись файлов)
+vosk_executor = ThreadPoolExecutor(max_workers=VOICE_RECOGNITION_WORKERS, thread_name_prefix="vosk")
 
 # Функция для инициализации Vosk модели
 def init_vosk_model():
@@ -81,10 +215,12 @@ def init_vosk_model():
         return False
 
 # Функция для локального распознавания через Vosk
-def recognize_with_vosk(audio_file_path):
-    global recognition_stop_flag
-    recognition_stop_flag.clear()
-    
+def recognize_with_vosk(audio_file_path, stop_event):
+    """
+    Args:
+        audio_file_path: Путь к WAV файлу (моно, 16 бит)
+        stop_event: threading.Event этого распознавания, при его установке распознавание прерывается и возвращает None
+    """
     if vosk_model is None:
         logging.error("Vosk модель не инициализирована при попытке распознавания")
         raise Exception("Vosk модель не инициализирована")
@@ -125,7 +261,7 @@ def recognize_with_vosk(audio_file_path):
         processed_frames = 0
         last_progress = 0
         
-        while not recognition_stop_flag.is_set():
+        while not stop_event.is_set():
             data = wf.readframes(chunk_size)
             if len(data) == 0:
                 break
@@ -143,7 +279,7 @@ def recognize_with_vosk(audio_file_path):
                     result += part_result["text"] + " "
                     logging.debug(f"Промежуточное распознавание: {part_result['text']}")
         
-        if recognition_stop_flag.is_set():
+        if stop_event.is_set():
             logging.info("Процесс распознавания был принудительно остановлен")
             return None
             
@@ -176,12 +312,61 @@ def recognize_with_vosk(audio_file_path):
             except:
                 pass
 
+# Реализации JSON кодека: имя -> (функция кодирования в bytes, функция разбора bytes или str)
+def _stdlib_json_dumps(obj, pretty=False):
+    return json.dumps(obj, ensure_ascii=False, indent=2 if pretty else None).encode('utf-8')
+
+JSON_BACKENDS = {"json": (_stdlib_json_dumps, json.loads)}
+
+if orjson is not None:
+    def _orjson_dumps(obj, pretty=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    JSON_BACKENDS["orjson"] = (_orjson_dumps, orjson.loads)
+
+if msgspec is not None:
+    _msgspec_encoder = msgspec.json.Encoder()
+    _msgspec_decoder = msgspec.json.Decoder()
+    
+    def _msgspec_dumps(obj, pretty=False):
+        data = _msgspec_encoder.encode(obj)
+        return msgspec.json.format(data, indent=2) if pretty else data
+    JSON_BACKENDS["msgspec"] = (_msgspec_dumps, _msgspec_decoder.decode)
+
+def select_json_backend(name=None):
+    """
+    Выбирает JSON кодек: указанный в переменной окружения JSON_BACKEND, иначе самый быстрый из установленных.
+    """
+    name = name or os.getenv("JSON_BACKEND", "")
+    if name in JSON_BACKENDS:
+        return name
+    if name:
+        logging.warning(f"JSON кодек {name} недоступен, используется кодек по умолчанию")
+    for candidate in ("orjson", "msgspec", "json"):
+        if candidate in JSON_BACKENDS:
+            return candidate
+
+JSON_BACKEND = select_json_backend()
+json_dumps, json_loads = JSON_BACKENDS[JSON_BACKEND]
+
+# Функция для атомарной записи JSON файла
+def write_json_atomic(path, data, pretty=False):
+    """
+    Записывает данные во временный файл рядом с целевым, сбрасывает его на диск и
+    атомарно подменяет им целевой файл: при падении посреди записи старый файл остается целым.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(json_dumps(data, pretty))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
 # Функция для загрузки настроек пользователей из файла
 def load_user_settings():
     try:
         if os.path.exists(SETTINGS_FILE):
-            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                settings_data = json.load(f)
+            with open(SETTINGS_FILE, 'rb') as f:
+                settings_data = json_loads(f.read())
                 return {int(user_id): settings for user_id, settings in settings_data.items()}
         return {}
     except Exception as e:
@@ -192,18 +377,63 @@ def load_user_settings():
 def save_user_settings(settings_dict):
     try:
         settings_data = {str(user_id): settings for user_id, settings in settings_dict.items()}
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(settings_data, f, ensure_ascii=False, indent=2)
+        write_json_atomic(SETTINGS_FILE, settings_data, pretty=True)
+        return True
     except Exception as e:
         logging.error(f"Ошибка при сохранении настроек пользователей: {e}")
+        return False
+
+ROLE_USER = sys.intern("user")
+ROLE_ASSISTANT = sys.intern("assistant")
+
+class HistoryEntry:
+    """
+    Сообщение в истории диалога.
+    
+    Занимает в несколько раз меньше памяти, чем словарь {"role": ..., "content": ...}:
+    роли интернированы и хранятся как общие строки, а оценка количества токенов
+    вычисляется один раз и запоминается.
+    """
+    
+    __slots__ = ("role", "content", "tokens")
+    
+    def __init__(self, role, content):
+        self.role = sys.intern(role)
+        self.content = content
+        self.tokens = None
+    
+    def token_count(self):
+        if self.tokens is None:
+            self.tokens = estimate_tokens(self.content)
+        return self.tokens
+    
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+# Функция для создания истории пользователя с ограничением длины
+def make_user_history(history_length, entries=()):
+    """
+    Создает историю диалога в виде deque, которая сама отбрасывает самые старые сообщения.
+    
+    Args:
+        history_length: Количество пар сообщений (вопрос-ответ) в истории, не более 100
+        entries: Начальные сообщения истории (объекты HistoryEntry)
+    """
+    return deque(entries, maxlen=min(history_length, 100) * 2)
 
 # Функция для загрузки истории сообщений пользователей из файла
-def load_user_history():
+def load_user_history(settings_dict):
     try:
         if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                history_data = json.load(f)
-                return {int(user_id): history for user_id, history in history_data.items()}
+            with open(HISTORY_FILE, 'rb') as f:
+                history_data = json_loads(f.read())
+                return {
+                    int(user_id): make_user_history(
+                        settings_dict.get(int(user_id), DEFAULT_SETTINGS).get("history_length", 10),
+                        (HistoryEntry(msg["role"], msg["content"]) for msg in history)
+                    )
+                    for user_id, history in history_data.items()
+                }
         return {}
     except Exception as e:
         logging.error(f"Ошибка при загрузке истории сообщений: {e}")
@@ -212,11 +442,76 @@ def load_user_history():
 # Функция для сохранения истории сообщений пользователей в файл
 def save_user_history(history_dict):
     try:
-        history_data = {str(user_id): history for user_id, history in history_dict.items()}
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(history_data, f, ensure_ascii=False, indent=2)
+        history_data = {str(user_id): [entry.to_dict() for entry in history] for user_id, history in history_dict.items()}
+        write_json_atomic(HISTORY_FILE, history_data)
+        return True
     except Exception as e:
         logging.error(f"Ошибка при сохранении истории сообщений: {e}")
+        return False
+
+# Функция для загрузки кратких содержаний диалогов из файла
+def load_history_summaries():
+    try:
+        if os.path.exists(SUMMARY_FILE):
+            with open(SUMMARY_FILE, 'rb') as f:
+                summary_data = json_loads(f.read())
+                return {int(user_id): summary for user_id, summary in summary_data.items()}
+        return {}
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке кратких содержаний диалогов: {e}")
+        return {}
+
+# Функция для сохранения кратких содержаний диалогов в файл
+def save_history_summaries(summaries_dict):
+    try:
+        summary_data = {str(user_id): summary for user_id, summary in summaries_dict.items()}
+        write_json_atomic(SUMMARY_FILE, summary_data, pretty=True)
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении кратких содержаний диалогов: {e}")
+        return False
+
+# Функция для получения пути к файлу состояния выгруженного пользователя
+def get_cold_user_state_path(user_id):
+    return os.path.join(USER_STATE_DIR, f"{user_id}.json")
+
+# Функция для получения списка пользователей, выгруженных на диск
+def list_cold_users():
+    try:
+        if os.path.isdir(USER_STATE_DIR):
+            return {int(name[:-5]) for name in os.listdir(USER_STATE_DIR) if name.endswith(".json") and name[:-5].lstrip("-").isdigit()}
+        return set()
+    except Exception as e:
+        logging.error(f"Ошибка при чтении каталога состояний пользователей: {e}")
+        return set()
+
+# Функция для загрузки состояния выгруженного пользователя
+def load_cold_user_state(user_id):
+    try:
+        with open(get_cold_user_state_path(user_id), 'rb') as f:
+            return json_loads(f.read())
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке состояния пользователя {user_id}: {e}")
+        return None
+
+# Функция для сохранения состояния выгружаемого пользователя
+def save_cold_user_state(user_id, state):
+    try:
+        os.makedirs(USER_STATE_DIR, exist_ok=True)
+        write_json_atomic(get_cold_user_state_path(user_id), state)
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении состояния пользователя {user_id}: {e}")
+        return False
+
+# Функция для удаления файла состояния пользователя, загруженного обратно в память
+def delete_cold_user_state(user_id):
+    try:
+        os.remove(get_cold_user_state_path(user_id))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"Ошибка при удалении состояния пользователя {user_id}: {e}")
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -232,28 +527,616 @@ logger = logging.getLogger(__name__)
 API_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")  # API ключ OpenRouter
 
-bot = Bot(token=API_TOKEN)
+# Через сколько секунд бездействия выгружать данные пользователя из памяти на диск
+USER_IDLE_TTL = int(os.getenv("USER_IDLE_TTL", 60 * 60))
+
+# Адреса API провайдеров (можно переопределить, например для локального тестового сервера)
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+TOGETHER_API_URL = os.getenv("TOGETHER_API_URL", "https://api.together.xyz/v1/chat/completions")
+HUGGINGFACE_API_URL = os.getenv("HUGGINGFACE_API_URL", "https://api-inference.huggingface.co/models")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # Например, локальный Bot API сервер
+
+# Локальный OpenAI-совместимый сервер моделей (llama.cpp server, Ollama, vLLM), например http://127.0.0.1:11434/v1.
+# Его модели доступны под именами local/<имя модели на сервере>
+LOCAL_LLM_URL = os.getenv("LOCAL_LLM_URL", "").rstrip("/")
+LOCAL_LLM_API_KEY = os.getenv("LOCAL_LLM_API_KEY", "")
+LOCAL_LLM_MODELS = [name for name in os.getenv("LOCAL_LLM_MODELS", "").replace(" ", "").split(",") if name]  # Пусто - спросить у сервера
+LOCAL_LLM_CONCURRENCY = int(os.getenv("LOCAL_LLM_CONCURRENCY", 1))  # На CPU одновременные запросы только делят ядра
+LOCAL_LLM_TIMEOUT = float(os.getenv("LOCAL_LLM_TIMEOUT", 180))     # Генерация на CPU медленнее, чем у облачных API
+LOCAL_LLM_CONTEXT = int(os.getenv("LOCAL_LLM_CONTEXT", 4096))       # Длинный запрос на CPU обрабатывается долго
+LOCAL_LLM_PREFERRED_FALLBACK = os.getenv("LOCAL_LLM_PREFERRED_FALLBACK", "1") not in ("", "0", "false")
+
+# Порядок запасных моделей по замерам задержки и доли успешных ответов вместо фиксированного порядка
+ADAPTIVE_ROUTING = os.getenv("ADAPTIVE_ROUTING", "1") not in ("", "0", "false")
+
+# Режим webhook: если задан WEBHOOK_URL, бот получает обновления через HTTP-сервер вместо long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_SHUTDOWN_TIMEOUT = 60  # Сколько секунд при остановке ждать завершения обрабатываемых обновлений
+
+# Количество рабочих процессов. При значении больше 1 основной процесс только принимает обновления
+# и распределяет их по процессам по user_id, так что данные каждого пользователя живут в одном процессе
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 1))
+POLLING_TIMEOUT = 30  # Таймаут long polling (в секундах) при приеме обновлений для рабочих процессов
+
+# Общее состояние моделей для нескольких экземпляров бота (redis://localhost:6379/0). Если не задано, состояние локальное
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "telegram-neural-bot")
+
+# Адрес HTTP-сервера с метриками Prometheus (/metrics). METRICS_PORT=0 отключает сервер.
+# Рабочие процессы используют следующие порты: METRICS_PORT + 1 + номер процесса
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9464))
+
+class NoopMetric:
+    """Заглушка метрики на случай, когда prometheus_client не установлен"""
+    
+    def labels(self, *args, **kwargs):
+        return self
+    
+    def inc(self, amount=1):
+        pass
+    
+    def dec(self, amount=1):
+        pass
+    
+    def set(self, value):
+        pass
+    
+    def set_function(self, func):
+        pass
+    
+    def observe(self, value):
+        pass
+    
+    def time(self):
+        return NoopTimer()
+
+class NoopTimer:
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+def create_metric(kind, name, documentation, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return NoopMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 45, 60, 90, 120)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+PROVIDER_REQUEST_SECONDS = create_metric(
+    "Histogram", "bot_provider_request_seconds", "Время ответа API модели (без ожидания в очереди)",
+    ("provider", "model", "result"), buckets=LATENCY_BUCKETS
+)
+PROVIDER_ERRORS = create_metric(
+    "Counter", "bot_provider_errors_total", "Ошибки запросов к API моделей", ("provider", "model", "reason")
+)
+PROVIDER_RATE_LIMITED = create_metric(
+    "Counter", "bot_provider_rate_limited_total", "Ответы 429 от провайдеров (включая повторенные запросы)", ("provider",)
+)
+PROVIDER_IN_FLIGHT = create_metric(
+    "Gauge", "bot_provider_requests_in_flight", "Запросы к API моделей, выполняющиеся сейчас", ("provider",)
+)
+ADMISSION_QUEUE_DEPTH = create_metric(
+    "Gauge", "bot_admission_queue_depth", "Запросы к API моделей, ожидающие в очереди"
+)
+FALLBACKS = create_metric(
+    "Counter", "bot_fallbacks_total", "Ответы, полученные от запасной модели вместо выбранной", ("model", "fallback_model")
+)
+MESSAGE_HANDLING_SECONDS = create_metric(
+    "Histogram", "bot_message_handling_seconds", "Полное время обработки сообщения пользователя",
+    ("kind",), buckets=LATENCY_BUCKETS
+)
+FORMATTING_SECONDS = create_metric(
+    "Histogram", "bot_formatting_seconds", "Время преобразования ответа модели в HTML для Telegram", buckets=FAST_BUCKETS
+)
+TELEGRAM_REQUEST_SECONDS = create_metric(
+    "Histogram", "bot_telegram_request_seconds", "Время запроса к Telegram Bot API (без ожидания лимитов)",
+    ("method",), buckets=FAST_BUCKETS + (5, 10)
+)
+FFMPEG_SECONDS = create_metric(
+    "Histogram", "bot_ffmpeg_seconds", "Время конвертации голосового сообщения через ffmpeg", buckets=LATENCY_BUCKETS
+)
+SPEECH_RECOGNITION_SECONDS = create_metric(
+    "Histogram", "bot_speech_recognition_seconds", "Время распознавания речи", ("engine",), buckets=LATENCY_BUCKETS
+)
+VOICE_QUEUE_DEPTH = create_metric(
+    "Gauge", "bot_voice_queue_depth", "Голосовые сообщения, которые сейчас обрабатываются"
+)
+CACHE_LOOKUPS = create_metric(
+    "Counter", "bot_cache_lookups_total", "Обращения к кэшам бота", ("cache", "result")
+)
+EVENT_LOOP_LAG_SECONDS = create_metric(
+    "Histogram", "bot_event_loop_lag_seconds", "Задержка пробуждения задачи в цикле событий относительно плана",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+EVENT_LOOP_BLOCKS = create_metric(
+    "Counter", "bot_event_loop_blocks_total", "Случаи, когда цикл событий был заблокирован дольше LOOP_BLOCK_THRESHOLD"
+)
+# Счетчики кэшей увеличиваются один раз на подбор истории или запрос, а не на каждое обращение
+HISTORY_TOKEN_CACHE_HITS = CACHE_LOOKUPS.labels("history_tokens", "hit")
+HISTORY_TOKEN_CACHE_MISSES = CACHE_LOOKUPS.labels("history_tokens", "miss")
+REQUEST_BODY_CACHE_HITS = CACHE_LOOKUPS.labels("request_body", "hit")
+REQUEST_BODY_CACHE_MISSES = CACHE_LOOKUPS.labels("request_body", "miss")
+
+def instrument_handler(kind):
+    """Декоратор обработчика, измеряющий полное время обработки сообщения и открывающий его трассировку"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            message = args[0] if args else None
+            user = getattr(message, "from_user", None)
+            with MESSAGE_HANDLING_SECONDS.labels(kind).time(), \
+                    trace_span(f"message.{kind}", user_id=user.id if user else None):
+                return await handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Контроль задержек цикла событий. В режиме LOOP_DEBUG=1 в лог пишется стек кода,
+# который удерживает цикл событий дольше LOOP_BLOCK_THRESHOLD секунд
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", 0.1))
+LOOP_DEBUG = os.getenv("LOOP_DEBUG", "") not in ("", "0", "false")
+
+class LoopLagMonitor:
+    """
+    Измеряет задержку цикла событий и находит код, который его блокирует.
+    
+    Фоновая задача засыпает на interval секунд и записывает в гистограмму, насколько позже
+    плана она проснулась: это время, на которое ответы всем пользователям задерживаются из-за
+    блокирующих вызовов и перегрузки. В отладочном режиме отдельный поток следит за тем, когда
+    задача проснулась в последний раз, и если цикл событий не отвечает дольше порога, записывает
+    в лог текущий стек потока цикла событий, то есть код, который его блокирует.
+    """
+    
+    def __init__(self, interval, block_threshold, debug):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.debug = debug
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.task = None
+    
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = loop.create_task(self._sample())
+        if self.debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.block_threshold
+            threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+            logger.info(f"Включен поиск блокировок цикла событий (порог {self.block_threshold} сек)")
+    
+    async def _sample(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - self.heartbeat - self.interval)
+            self.heartbeat = now
+            EVENT_LOOP_LAG_SECONDS.observe(lag)
+            if lag >= self.block_threshold:
+                EVENT_LOOP_BLOCKS.inc()
+                if not self.debug:
+                    logger.warning(f"Цикл событий был заблокирован на {lag:.3f} сек")
+    
+    def _watch(self):
+        reported = None
+        while True:
+            time.sleep(self.block_threshold / 2)
+            heartbeat = self.heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.block_threshold or reported == heartbeat:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                return
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning(f"Цикл событий заблокирован уже {blocked_for:.3f} сек, стек:\n{stack}")
+
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD, LOOP_DEBUG)
+
+# Профилирование работающего бота командой /profile, доступной только администраторам
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if user_id}
+PROFILE_DIR = "profiles"         # Каталог для файлов профилей
+PROFILE_DEFAULT_SECONDS = 30     # Длительность профилирования по умолчанию (в секундах)
+PROFILE_MAX_SECONDS = 300        # Максимальная длительность профилирования (в секундах)
+PROFILE_TOP_FUNCTIONS = 15       # Сколько самых затратных функций показывать в чате
+
+# Трассировка обработки сообщений: "file" - запись спанов в TRACE_FILE (JSON Lines),
+# "otlp" - отправка в коллектор OpenTelemetry (адрес задается стандартной переменной OTEL_EXPORTER_OTLP_ENDPOINT)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+
+class NoopSpan:
+    """Спан, который ничего не записывает: используется, когда трассировка выключена"""
+    
+    def set_attribute(self, key, value):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_time", "started", "duration", "attributes", "status")
+    
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.start_time = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.attributes = attributes
+        self.status = "ok"
+    
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+    
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_time,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes
+        }
+
+class FileSpanExporter:
+    """Записывает завершенные спаны в файл в отдельном потоке, не блокируя цикл событий"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.spans = SimpleQueue()
+        self.thread = threading.Thread(target=self._write_loop, name="span-exporter", daemon=True)
+        self.thread.start()
+    
+    def export(self, span):
+        self.spans.put(span)
+    
+    def _write_loop(self):
+        while True:
+            batch = [self.spans.get()]
+            while not self.spans.empty() and len(batch) < 1000:
+                batch.append(self.spans.get())
+            try:
+                with open(self.path, 'ab') as f:
+                    for span in batch:
+                        f.write(json_dumps(span.to_dict()) + b"\n")
+            except Exception as e:
+                logging.error(f"Ошибка при записи трассировки в {self.path}: {e}")
+
+current_span = contextvars.ContextVar("current_span", default=None)
+span_exporter = None
+otel_tracer = None
+
+def init_tracing():
+    global span_exporter, otel_tracer
+    if TRACE_EXPORTER == "file":
+        span_exporter = FileSpanExporter(TRACE_FILE)
+        logging.info(f"Трассировка сообщений записывается в {TRACE_FILE}")
+    elif TRACE_EXPORTER == "otlp":
+        if otel_trace is None:
+            logging.warning("TRACE_EXPORTER=otlp, но пакеты opentelemetry не установлены: трассировка отключена")
+            return
+        provider = OtelTracerProvider(resource=OtelResource.create({"service.name": "telegram-neural-bot"}))
+        provider.add_span_processor(OtelBatchSpanProcessor(OTLPSpanExporter()))
+        otel_trace.set_tracer_provider(provider)
+        otel_tracer = otel_trace.get_tracer("telegram-neural-bot")
+        logging.info("Трассировка сообщений отправляется в коллектор OpenTelemetry")
+
+init_tracing()
+
+def start_new_trace():
+    """
+    Отвязывает текущую задачу от трассировки, в которой она создана: следующие спаны задачи
+    начнут новую трассировку. Для фоновой работы, которая не относится к вызвавшему ее сообщению.
+    """
+    current_span.set(None)
+    if otel_tracer is not None:
+        otel_context.attach(otel_context.Context())
+
+@contextmanager
+def trace_span(name, **attributes):
+    """
+    Измеряет этап обработки. Вложенные спаны автоматически становятся дочерними,
+    в том числе в задачах, созданных внутри спана.
+    
+    Использование:
+        with trace_span("provider_request", model=model) as span:
+            ...
+            span.set_attribute("status", status)
+    """
+    if otel_tracer is not None:
+        attributes = {key: value for key, value in attributes.items() if value is not None}
+        with otel_tracer.start_as_current_span(name, attributes=attributes) as span:
+            yield span
+        return
+    if span_exporter is None:
+        yield NOOP_SPAN
+        return
+    
+    span = Span(name, current_span.get(), attributes)
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.status = "error"
+        span.attributes["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span.duration = time.perf_counter() - span.started
+        current_span.reset(token)
+        span_exporter.export(span)
+
+class ProviderTimeoutError(Exception):
+    """Провайдер не ответил за отведенное время"""
+
+def classify_provider_error(error):
+    if isinstance(error, ProviderTimeoutError):
+        return "timeout"
+    text = str(error).lower()
+    if "429" in text or "лимит" in text:
+        return "rate_limited"
+    return "error"
+
+bot_session = AiohttpSession(json_loads=json_loads, json_dumps=lambda obj: json_dumps(obj).decode('utf-8'))
+if TELEGRAM_API_URL:
+    bot_session.api = TelegramAPIServer.from_base(TELEGRAM_API_URL)
+bot = Bot(token=API_TOKEN, session=bot_session)
 dp = Dispatcher()
 
 # Словарь для хранения истории сообщений пользователей
 user_message_history = {}
 
+# Словарь для хранения кратких содержаний старой части диалога (сжатая история)
+user_history_summaries = {}
+
+# Задачи сжатия истории, выполняющиеся в фоне
+summary_tasks = {}
+
 # Словарь для хранения настроек пользователей
 user_settings = {}
 
 # Словарь для хранения ID последних сообщений бота для каждого пользователя
 user_last_messages = {}
 
+# Словарь для хранения полных текстов длинных ответов (для кнопки "Продолжить ответ")
+full_responses = {}
+
+# Время последней активности пользователей, находящихся в памяти (time.monotonic())
+user_last_activity = {}
+
+# Пользователи, состояние которых выгружено на диск в USER_STATE_DIR
+cold_users = set()
+
+class SnapshotWriter:
+    """
+    Фоновая запись данных пользователей на диск.
+    
+    Обработчики только отмечают изменившиеся хранилища через mark_dirty. Запись откладывается
+    на SNAPSHOT_DELAY секунд, чтобы объединить несколько изменений. В потоке событий снимается
+    лишь неглубокая копия данных (записи истории не изменяются после создания), а сериализация
+    и запись файла выполняются в отдельном потоке. Неизменившиеся хранилища не записываются.
+    """
+    
+    def __init__(self, delay):
+        self.delay = delay
+        self.stores = {}
+        self.versions = {}
+        self.saved_versions = {}
+        self.lock = asyncio.Lock()
+        self.pending = None
+        self.after_save = []  # Что выполнить после первой полностью успешной записи
+    
+    def register(self, name, freeze, write):
+        """
+        Args:
+            name: Имя хранилища
+            freeze: Функция, возвращающая копию данных, которую можно сериализовать в другом потоке
+            write: Функция записи копии на диск, возвращает True при успехе
+        """
+        self.stores[name] = (freeze, write)
+        self.versions[name] = 0
+        self.saved_versions[name] = 0
+    
+    def mark_dirty(self, *names):
+        for name in names or self.stores:
+            self.versions[name] += 1
+        if self.pending is None or self.pending.done():
+            try:
+                self.pending = asyncio.get_running_loop().create_task(self._delayed_flush())
+            except RuntimeError:
+                # Вне цикла событий (например, при импорте в скриптах) данные запишет следующий flush
+                pass
+    
+    def is_dirty(self):
+        return any(self.versions[name] != self.saved_versions[name] for name in self.stores)
+    
+    def call_after_save(self, callback):
+        """Выполняет callback после ближайшей успешной записи, после которой не осталось незаписанных изменений"""
+        self.after_save.append(callback)
+    
+    async def _delayed_flush(self):
+        # Запись объединяет изменения нескольких сообщений, поэтому ее спаны не относятся к сообщению, создавшему задачу
+        start_new_trace()
+        # Изменения, отмеченные во время записи, не планируют новую запись, поэтому записываем, пока они есть
+        while True:
+            await asyncio.sleep(self.delay)
+            if not await self.flush() or not self.is_dirty():
+                break
+    
+    async def flush(self):
+        """
+        Записывает на диск все хранилища, изменившиеся с момента последней записи.
+        
+        Returns:
+            bool: True, если все изменившиеся хранилища записаны
+        """
+        success = True
+        async with self.lock:
+            for name, (freeze, write) in self.stores.items():
+                version = self.versions[name]
+                if version == self.saved_versions[name]:
+                    continue
+                with trace_span(f"snapshot.{name}"):
+                    snapshot = freeze()
+                    if await asyncio.to_thread(write, snapshot):
+                        self.saved_versions[name] = version
+                    else:
+                        success = False
+                        logger.warning(f"Не удалось записать {name}, повторим при следующем сохранении")
+            
+            # Изменения, отмеченные во время записи, могли не попасть в уже записанные хранилища
+            if success and self.after_save and not self.is_dirty():
+                callbacks, self.after_save = self.after_save, []
+                for callback in callbacks:
+                    callback()
+        return success
+
+snapshot_writer = SnapshotWriter(SNAPSHOT_DELAY)
+snapshot_writer.register("settings", lambda: {user_id: dict(settings) for user_id, settings in user_settings.items()}, save_user_settings)
+snapshot_writer.register("history", lambda: {user_id: tuple(history) for user_id, history in user_message_history.items()}, save_user_history)
+snapshot_writer.register("summaries", lambda: dict(user_history_summaries), save_history_summaries)
+
+async def load_user_state(user_id):
+    """
+    Загружает состояние выгруженного пользователя обратно в память.
+    
+    Файл выгруженного состояния удаляется только после очередной записи общих файлов,
+    поэтому при падении бота данные не теряются, а обработка сообщения не ждет записи.
+    """
+    state = await asyncio.to_thread(load_cold_user_state, user_id)
+    # Пока файл читался, этот же пользователь мог быть загружен другим обновлением
+    if user_id not in cold_users:
+        return
+    cold_users.discard(user_id)
+    if state is None:
+        return
+    
+    if state.get("settings") is not None:
+        user_settings[user_id] = state["settings"]
+    history_length = user_settings.get(user_id, DEFAULT_SETTINGS).get("history_length", 10)
+    user_message_history[user_id] = make_user_history(
+        history_length, (HistoryEntry(msg["role"], msg["content"]) for msg in state.get("history", []))
+    )
+    if state.get("summary"):
+        user_history_summaries[user_id] = state["summary"]
+    if state.get("last_messages"):
+        user_last_messages[user_id] = state["last_messages"]
+    
+    # Пока пользователь не записан в общие файлы, его данные есть только в файле выгруженного состояния
+    def delete_after_save():
+        # К этому времени пользователь мог быть выгружен снова, тогда файл содержит его актуальное состояние
+        if user_id not in cold_users:
+            delete_cold_user_state(user_id)
+    snapshot_writer.call_after_save(delete_after_save)
+    snapshot_writer.mark_dirty()
+    logger.info(f"Состояние пользователя {user_id} загружено с диска")
+
+async def evict_idle_users():
+    """Выгружает на диск состояние пользователей, неактивных дольше USER_IDLE_TTL"""
+    deadline = time.monotonic() - USER_IDLE_TTL
+    idle_users = [
+        user_id for user_id, last_activity in user_last_activity.items()
+        if last_activity < deadline and user_id not in summary_tasks
+    ]
+    if not idle_users:
+        return
+    
+    evicted = 0
+    for user_id in idle_users:
+        state = {
+            "settings": user_settings.get(user_id),
+            "history": [entry.to_dict() for entry in user_message_history.get(user_id, ())],
+            "summary": user_history_summaries.get(user_id),
+            "last_messages": user_last_messages.get(user_id, [])
+        }
+        if not await asyncio.to_thread(save_cold_user_state, user_id, state):
+            continue
+        # Пользователь мог написать, пока состояние записывалось на диск
+        if user_last_activity.get(user_id, 0) >= deadline:
+            delete_cold_user_state(user_id)
+            continue
+        
+        for state_dict in (user_settings, user_message_history, user_history_summaries,
+                           user_last_messages, full_responses, user_last_activity):
+            state_dict.pop(user_id, None)
+        cold_users.add(user_id)
+        evicted += 1
+    
+    if evicted:
+        snapshot_writer.mark_dirty()
+        await snapshot_writer.flush()
+        logger.info(f"Выгружено из памяти неактивных пользователей: {evicted}, в памяти осталось: {len(user_last_activity)}")
+
+async def periodic_eviction():
+    """Периодически выгружает неактивных пользователей из памяти"""
+    while True:
+        await asyncio.sleep(USER_EVICTION_INTERVAL)
+        try:
+            await evict_idle_users()
+        except Exception as e:
+            logger.error(f"Ошибка при выгрузке неактивных пользователей: {e}")
+
+class UserStateMiddleware(BaseMiddleware):
+    """Отмечает активность пользователя и загружает его выгруженное состояние перед обработкой обновления"""
+    
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        if user is not None:
+            user_last_activity[user.id] = time.monotonic()
+            if user.id in cold_users:
+                await load_user_state(user.id)
+        return await handler(event, data)
+
+user_state_middleware = UserStateMiddleware()
+dp.message.outer_middleware(user_state_middleware)
+dp.callback_query.outer_middleware(user_state_middleware)
+
 # Настройки по умолчанию
 DEFAULT_SETTINGS = {
     "model": "google/gemini-2.0-pro-exp-02-05:free",  # Gemini Pro модель
     "max_tokens": 500,
     "temperature": 0.7,
     "dynamic_chat": False,  # Удалять ли предыдущие сообщения бота
+    "compact_replies": True,  # Превращать сообщение о генерации в ответ вместо отправки новых сообщений
     "history_length": 10,   # Количество пар сообщений (вопрос-ответ) в истории
     "system_message": "Ты дружелюбный ассистент, который помогает пользователям. Отвечай на русском языке, кратко и по делу. При форматировании текста следуй этим правилам: 1) Для блоков кода используй ```язык и ``` (например, ```python для Python кода); 2) Для однострочного кода используй обратные кавычки `код`; 3) Для выделения заголовков используй # для основного заголовка и ## для подзаголовков; 4) Для жирного текста используй **текст**; 5) Для курсива используй *текст*; 6) Для маркированного списка используй звездочку и пробел: * элемент списка. Telegram поддерживает базовое форматирование и корректно отображает код в сообщениях."
 }
 
+# Инструкции для запасных моделей, которые отвечают вместо недоступной модели пользователя
+FALLBACK_SYSTEM_MESSAGE = (
+    "Ты русскоязычный ассистент общего назначения. ВАЖНО: отвечаешь на вопросы по ЛЮБЫМ темам, "
+    "Не ограничивай себя какой-то конкретной тематикой. "
+    "Ты должен помогать с любыми темами: наукой, искусством, историей, повседневными вопросами - со всем. "
+    "НЕ выдавай шаблонные ответы. Каждый ответ должен быть уникальным и соответствовать запросу пользователя. "
+    "Обязательно отвечай ТОЛЬКО НА РУССКОМ ЯЗЫКЕ, кратко и по сути вопроса. "
+    "Очень внимательно прочитай вопрос пользователя и отвечай ТОЛЬКО на заданный вопрос. "
+    "Не давай общую информацию не по теме запроса. "
+    "При необходимости используй форматирование markdown: **жирный**, *курсив*, # заголовок, ```код```."
+)
+FALLBACK_USER_INSTRUCTION = (
+    "ВАЖНО: Отвечай ТОЛЬКО на русском языке. "
+    "Отвечай СТРОГО по теме вопроса, не давай общую информацию не по теме. "
+    "ОТВЕЧАЙ НА ВОПРОСЫ ПО ЛЮБЫМ ТЕМАМ. "
+    "Ты универсальный помощник, который может обсуждать любые темы."
+)
+FALLBACK_USER_INSTRUCTION_SHORT = (
+    "ВАЖНО: Отвечай ТОЛЬКО на русском языке и строго по теме вопроса. "
+    "Отвечай на вопросы по ЛЮБЫМ темам."
+)
+
 # Модели
 AVAILABLE_MODELS = [
     # OpenRouter модели
@@ -333,9 +1216,63 @@ MODEL_DESCRIPTIONS = {
     
     "huggingface/facebook/opt-350m": "Маленькая модель OPT от Meta, очень быстрая и компактная. Идеальна для базовых запросов и ситуаций с ограниченными ресурсами.",
     
-    "huggingface/facebook/opt-1.3b": "Средняя модель OPT от Meta с хорошим балансом качества и скорости. Универсальная модель для повседневного использования."
+    "huggingface/facebook/opt-1.3b": "Средняя модель OPT от Meta с хорошим балансом качества и скорости. Универсальная модель для повседневного использования.",
+    
+    AUTO_MODEL: "Для каждого сообщения выбирается рабочая модель, которая в последнее время отвечала быстрее и надежнее остальных."
+}
+
+# Размер контекстного окна моделей (в токенах)
+MODEL_CONTEXT_LIMITS = {
+    # OpenRouter модели
+    "google/gemini-2.0-pro-exp-02-05:free": 2000000,
+    "google/gemini-2.0-flash-lite-preview-02-05:free": 1000000,
+    "deepseek/deepseek-r1": 163840,
+    "deepseek/deepseek-r1-zero:free": 128000,
+    "deepseek/deepseek-chat-v3-0324:free": 131072,
+    "perplexity/sonar-reasoning-pro": 128000,
+    "perplexity/r1-1776": 128000,
+    
+    # Together AI модели
+    "together/mixtral-8x7b-instruct": 32768,
+    "together/mistral-7b-instruct": 32768,
+    "together/llama-2-13b-chat": 4096,
+    "together/llama-2-70b-chat": 4096,
+    "together/qwen-72b-chat": 32768,
+    "together/codellama-34b-instruct": 16384,
+    "together/neural-chat-7b-v3-1": 8192,
+    
+    # HuggingFace модели
+    "huggingface/mistralai/Mistral-7B-Instruct-v0.2": 32768,
+    "huggingface/microsoft/phi-2": 2048,
+    "huggingface/TinyLlama/TinyLlama-1.1B-Chat-v1.0": 2048,
+    "huggingface/facebook/opt-350m": 2048,
+    "huggingface/facebook/opt-1.3b": 2048
 }
 
+DEFAULT_CONTEXT_LIMIT = 4096     # Размер контекста для моделей, которых нет в таблице
+MAX_PROMPT_TOKENS = 8000         # Верхняя граница размера запроса независимо от контекста модели
+CONTEXT_RESERVE_TOKENS = 64      # Запас на служебные токены шаблона диалога
+MESSAGE_TOKEN_OVERHEAD = 4       # Служебные токены на каждое сообщение (роль, разделители)
+
+LOCAL_MODEL_PREFIX = "local/"
+
+def register_local_models(names):
+    """Добавляет модели локального сервера в список доступных моделей"""
+    for name in names:
+        model = LOCAL_MODEL_PREFIX + name
+        if model in AVAILABLE_MODELS:
+            continue
+        AVAILABLE_MODELS.append(model)
+        MODEL_DESCRIPTIONS.setdefault(
+            model,
+            "Локальная модель на сервере бота. Отвечает без сетевых задержек и лимитов бесплатных API, "
+            "но генерирует текст медленнее, ответ появляется по мере генерации."
+        )
+        MODEL_CONTEXT_LIMITS.setdefault(model, LOCAL_LLM_CONTEXT)
+
+if LOCAL_LLM_URL:
+    register_local_models(LOCAL_LLM_MODELS)
+
 # Описания для настроек
 SETTINGS_DESCRIPTIONS = {
     "model": "Выберите языковую модель, которая будет генерировать ответы. Разные модели имеют различные сильные стороны и особенности.",
@@ -343,9 +1280,92 @@ SETTINGS_DESCRIPTIONS = {
     "temperature": "Параметр, влияющий на креативность ответов. Низкие значения (0.3) дают более предсказуемые ответы, высокие (1.5) - более творческие и разнообразные.",
     "system_message": "Инструкция для модели, определяющая её поведение и стиль ответов. Это сообщение влияет на то, как модель будет отвечать.",
     "dynamic_chat": "Режим динамического чата. Когда включен - предыдущие сообщения бота удаляются при отправке новых, создавая более чистый интерфейс.",
+    "compact_replies": "Компактные ответы. Когда включены - сообщение о генерации превращается в ответ, а информация о модели и времени генерации выводится внизу того же сообщения. Ответы приходят быстрее.",
     "history_length": "Максимальное количество пар сообщений (вопрос-ответ) в истории диалога. Больше значение - больше контекста для модели."
 }
 
+# Функция для быстрой оценки количества токенов в тексте
+def estimate_tokens(text):
+    """
+    Оценивает количество токенов без загрузки токенизатора.
+    
+    Для латиницы и кода токенизаторы популярных моделей дают в среднем около 4 символов
+    на токен, для кириллицы - около 2.5. Количество не-ASCII символов считается по длине
+    UTF-8 представления, поэтому оценка выполняется за один проход на уровне C.
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    non_ascii = min(chars, len(text.encode('utf-8')) - chars)
+    return int((chars - non_ascii) / 4 + non_ascii / 2.5) + 1
+
+# Функция для вычисления бюджета токенов на запрос к модели
+def get_prompt_token_budget(model, max_tokens):
+    context_limit = MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT)
+    return max(256, min(context_limit - max_tokens - CONTEXT_RESERVE_TOKENS, MAX_PROMPT_TOKENS))
+
+# Функция для сокращения текста до заданного количества токенов
+def truncate_to_tokens(text, max_tokens):
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    cut = max(1, int(len(text) * max_tokens / tokens))
+    return text[:cut] + "\n\n[...сообщение сокращено...]"
+
+# Функция для выбора истории диалога, которая помещается в контекст модели
+def fit_history_to_budget(history, system_message, user_message, model, max_tokens):
+    """
+    Выбирает самые свежие сообщения истории, которые помещаются в бюджет токенов модели
+    вместе с системным сообщением и новым сообщением пользователя.
+    
+    Args:
+        history: История диалога (HistoryEntry), последнее сообщение в ней - новый вопрос пользователя
+        system_message: Системное сообщение
+        user_message: Текст нового вопроса, который будет отправлен модели
+        model: Имя модели
+        max_tokens: Количество токенов, зарезервированных под ответ
+        
+    Returns:
+        tuple: (предыдущие сообщения истории в хронологическом порядке, сообщение пользователя,
+                сокращенное при необходимости)
+    """
+    budget = get_prompt_token_budget(model, max_tokens)
+    used = estimate_tokens(system_message) + 2 * MESSAGE_TOKEN_OVERHEAD
+    
+    user_tokens = estimate_tokens(user_message)
+    if used + user_tokens > budget:
+        logger.warning(f"Сообщение пользователя (~{user_tokens} токенов) не помещается в бюджет {budget} токенов модели {model}, сокращаем")
+        user_message = truncate_to_tokens(user_message, budget - used)
+        return [], user_message
+    used += user_tokens
+    
+    window = []
+    lookups = misses = 0
+    for entry in islice(reversed(history), 1, None):
+        lookups += 1
+        if entry.tokens is None:
+            misses += 1
+        cost = entry.token_count() + MESSAGE_TOKEN_OVERHEAD
+        if used + cost > budget:
+            break
+        used += cost
+        window.append(entry)
+    window.reverse()
+    
+    if lookups > misses:
+        HISTORY_TOKEN_CACHE_HITS.inc(lookups - misses)
+    if misses:
+        HISTORY_TOKEN_CACHE_MISSES.inc(misses)
+    
+    # Контекст должен начинаться с вопроса пользователя, а не с ответа без вопроса
+    if window and window[0].role == ROLE_ASSISTANT:
+        window = window[1:]
+    
+    if len(window) < len(history) - 1:
+        logger.info(f"В контекст модели {model} вошло {len(window)} из {len(history) - 1} сообщений истории (~{used} из {budget} токенов)")
+    
+    return window, user_message
+
 # Функция для обработки содержимого (удаление тегов думания)
 def process_content(content):
     if content is None:
@@ -441,293 +1461,1081 @@ def format_markdown_to_html(text):
     
     return text
 
-# Функция для генерации ответа с использованием OpenRouter API
-async def generate_response_openrouter(messages, model, max_tokens, temperature, timeout=30):
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json"
-    }
+class TokenBucket:
+    """
+    Ограничитель частоты запросов по алгоритму token bucket.
     
-    formatted_messages = []
+    Запросы сверх лимита не отклоняются, а ждут своей очереди. Скорость снижается
+    вдвое при ответе 429 и постепенно восстанавливается после успешных запросов.
+    """
     
-    system_content = next((msg["content"] for msg in messages if msg["role"] == "system"), None)
-    if system_content:
-        formatted_messages.append({"role": "system", "content": system_content})
-    
-    for msg in messages:
-        if msg["role"] in ["user", "assistant"]:
-            formatted_messages.append({"role": msg["role"], "content": msg["content"]})
-    
-    data = {
-        "model": model,
-        "messages": formatted_messages,
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-        "stream": False
-    }
+    def __init__(self, rate, capacity):
+        self.max_rate = rate
+        self.min_rate = rate / 16
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.decreased_at = 0.0
+        self.paused_until = 0.0
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def expected_delay(self):
+        """Сколько секунд ждал бы новый запрос, не занимая токен"""
+        now = time.monotonic()
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        return max(0.0, (1 - tokens) / self.rate, self.paused_until - now)
+    
+    async def acquire(self, max_wait=None):
+        """
+        Занимает токен и ждет, если запрос нужно отложить.
+        
+        Args:
+            max_wait: Максимальное допустимое ожидание в секундах
+            
+        Returns:
+            float: Время ожидания в секундах, или None если ожидание превысило бы max_wait
+        """
+        self._refill()
+        # Отрицательный баланс означает очередь уже занятых, но еще не отправленных запросов
+        delay = max(0.0, (1 - self.tokens) / self.rate)
+        if max_wait is not None and delay > max_wait:
+            return None
+        
+        self.tokens -= 1
+        if delay > 0:
+            await asyncio.sleep(delay)
+        
+        # Пауза могла быть назначена, пока запрос ждал своей очереди
+        pause = self.paused_until - time.monotonic()
+        while pause > 0:
+            delay += pause
+            await asyncio.sleep(pause)
+            pause = self.paused_until - time.monotonic()
+        return delay
+    
+    def on_rate_limited(self, retry_after=None):
+        """Снижает скорость после ответа 429 и приостанавливает запросы на retry_after секунд"""
+        self._refill()
+        # Одновременные ответы 429 сигнализируют об одной и той же перегрузке, поэтому не складываем их
+        if self.updated - self.decreased_at > 1.0:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.decreased_at = self.updated
+        pause = retry_after if retry_after is not None else 1 / self.rate
+        self._pause(pause)
+    
+    def _pause(self, pause):
+        # Следующий токен станет доступен не раньше, чем через pause секунд
+        self.tokens = min(self.tokens, 1 - pause * self.rate)
+        self.paused_until = max(self.paused_until, time.monotonic() + pause)
+    
+    def on_success(self, remaining=None, reset_after=None):
+        """Восстанавливает скорость и учитывает остаток квоты из заголовков ответа"""
+        self._refill()
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+        if remaining is not None and reset_after:
+            if remaining <= 0:
+                self._pause(reset_after)
+            else:
+                # Растягиваем оставшуюся квоту до момента ее сброса
+                self.rate = max(self.min_rate, min(self.rate, remaining / reset_after))
+
+# Функция для разбора заголовков ограничения частоты запросов
+def parse_rate_limit_headers(headers):
+    """
+    Извлекает из заголовков ответа время до повтора и остаток квоты.
     
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=aiohttp.ClientTimeout(total=timeout)
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"Ошибка API: {response.status}, {error_text}")
-                    raise Exception(f"API вернул код {response.status}: {error_text}")
-                
-                result = await response.json()
-                
-                if "choices" in result and len(result["choices"]) > 0:
-                    content = result["choices"][0]["message"]["content"]
-                    return process_content(content)
-                else:
-                    logger.error(f"API не вернул ожидаемый результат: {result}")
-                    if "error" in result:
-                        raise Exception(f"API вернул ошибку: {result['error']}")
-                    else:
-                        raise Exception(f"API не вернул ожидаемый результат: {result}")
+    Returns:
+        tuple: (retry_after, remaining, reset_after) - секунды до повтора, оставшиеся запросы,
+               секунды до сброса квоты. Отсутствующие значения равны None.
+    """
+    retry_after = None
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            retry_after = max(0.0, float(value))
+        except ValueError:
+            try:
+                retry_after = max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    
+    remaining = None
+    value = headers.get("X-RateLimit-Remaining") or headers.get("X-RateLimit-Remaining-Requests")
+    if value:
+        try:
+            remaining = int(float(value))
+        except ValueError:
+            pass
+    
+    reset_after = None
+    value = headers.get("X-RateLimit-Reset") or headers.get("X-RateLimit-Reset-Requests")
+    if value:
+        try:
+            reset = float(value.rstrip("s"))
+            # Значение может быть меткой времени в миллисекундах, в секундах или интервалом
+            if reset > 1e12:
+                reset = reset / 1000 - time.time()
+            elif reset > 1e9:
+                reset = reset - time.time()
+            reset_after = max(0.0, reset)
+        except ValueError:
+            pass
+    
+    return retry_after, remaining, reset_after
+
+# Методы Bot API, которые отправляют или изменяют сообщения в чате и подпадают под лимиты чата
+TELEGRAM_CHAT_PACED_METHODS = {
+    "sendMessage", "editMessageText", "editMessageReplyMarkup", "editMessageCaption",
+    "sendDocument", "sendPhoto", "sendAudio", "sendVoice", "sendMediaGroup",
+    "copyMessage", "forwardMessage"
+}
+# Служебные методы, которые учитываются только в общем лимите бота
+TELEGRAM_GLOBAL_PACED_METHODS = {"deleteMessage", "deleteMessages", "sendChatAction"}
+
+class TelegramSendScheduler(BaseRequestMiddleware):
+    """
+    Планировщик исходящих запросов к Telegram Bot API.
+    
+    Сообщения в каждый чат выстраиваются в очередь своего token bucket, а все запросы
+    дополнительно проходят общий лимит бота. При TelegramRetryAfter чат приостанавливается
+    на указанное Telegram время, и запрос отправляется повторно.
+    """
+    
+    def __init__(self):
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets = {}
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= 10000:
+                self._forget_idle_chats()
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            bucket = TokenBucket(TELEGRAM_GROUP_CHAT_RATE if is_group else TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+    
+    def _forget_idle_chats(self):
+        # Полностью восстановившиеся лимиты ничем не отличаются от новых, их можно не хранить
+        now = time.monotonic()
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            idle_tokens = bucket.tokens + (now - bucket.updated) * bucket.rate
+            if idle_tokens >= bucket.capacity and bucket.rate == bucket.max_rate:
+                del self.chat_buckets[chat_id]
+    
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        if api_method not in TELEGRAM_CHAT_PACED_METHODS and api_method not in TELEGRAM_GLOBAL_PACED_METHODS:
+            if api_method == "getUpdates":
+                # Long polling длится до POLLING_TIMEOUT секунд и исказил бы гистограмму
+                return await make_request(bot, method)
+            with TELEGRAM_REQUEST_SECONDS.labels(api_method).time(), trace_span(f"telegram.{api_method}"):
+                return await make_request(bot, method)
+        
+        chat_id = getattr(method, "chat_id", None)
+        chat_bucket = None
+        if api_method in TELEGRAM_CHAT_PACED_METHODS and chat_id is not None:
+            chat_bucket = self._chat_bucket(chat_id)
+        
+        for attempt in range(TELEGRAM_SEND_RETRIES + 1):
+            paced_since = time.monotonic()
+            if chat_bucket:
+                await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            paced = time.monotonic() - paced_since
+            
+            try:
+                with TELEGRAM_REQUEST_SECONDS.labels(api_method).time(), \
+                        trace_span(f"telegram.{api_method}", chat_id=chat_id, attempt=attempt, paced_ms=round(paced * 1000, 1)):
+                    response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= TELEGRAM_SEND_RETRIES or e.retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                    logger.error(f"Telegram ограничил {api_method} в чате {chat_id} на {e.retry_after} сек, запрос не отправлен")
+                    raise
+                logger.warning(f"Telegram ограничил {api_method} в чате {chat_id}: повтор через {e.retry_after} сек "
+                               f"(попытка {attempt+1}/{TELEGRAM_SEND_RETRIES})")
+                (chat_bucket or self.global_bucket).on_rate_limited(e.retry_after)
+                continue
+            
+            if chat_bucket:
+                chat_bucket.on_success()
+            return response
+
+telegram_send_scheduler = TelegramSendScheduler()
+bot.session.middleware(telegram_send_scheduler)
+
+class ModelRequest:
+    """
+    Запрос к моделям, общий для всех попыток ответить на одно сообщение.
     
-    except asyncio.TimeoutError:
-        logger.error(f"Таймаут при запросе к OpenRouter API для модели {model}")
-        raise Exception(f"Таймаут при запросе к API (превышено время ожидания {timeout} сек)")
-    except Exception as e:
-        logger.error(f"Ошибка при запросе к OpenRouter API: {e}")
-        raise
+    Тело запроса готовится один раз для каждого адаптера и кэшируется здесь, поэтому повторы
+    и перебор запасных моделей не форматируют и не сериализуют диалог заново.
+    """
+    __slots__ = ("messages", "bodies")
+    
+    def __init__(self, messages):
+        self.messages = messages
+        self.bodies = {}  # (адаптер, max_tokens, temperature, поток) -> сериализованное тело без имени модели
 
-# Функция для генерации ответа с использованием Together AI API
-async def generate_response_together(messages, model, max_tokens, temperature, timeout=30):
-    headers = {
-        "Authorization": f"Bearer {os.getenv('TOGETHER_API_KEY')}",
-        "Content-Type": "application/json"
-    }
+class TimeoutBudget:
+    """
+    Таймауты запроса к модели (в секундах): установка соединения, ожидание первого байта
+    и весь ответ, включая ожидание лимита частоты запросов и повторы после 429.
     
-    model_mapping = {
-        "together/mixtral-8x7b-instruct": "mistralai/Mixtral-8x7B-Instruct-v0.1",
-        "together/mistral-7b-instruct": "mistralai/Mistral-7B-Instruct-v0.2",
-        "together/llama-2-13b-chat": "meta-llama/Llama-2-13b-chat-hf",
-        "together/llama-2-70b-chat": "meta-llama/Llama-2-70b-chat-hf",
-        "together/qwen-72b-chat": "Qwen/Qwen-72B-Chat",
-        "together/codellama-34b-instruct": "codellama/CodeLlama-34b-Instruct-hf"
-    }
+    Таймаут первого байта действует на каждое чтение из сокета, поэтому при потоковой
+    генерации он ограничивает и паузы между частями ответа.
+    """
+    __slots__ = ("connect", "first_byte", "total")
     
-    api_model = model_mapping.get(model)
-    if not api_model:
-        raise Exception(f"Модель {model} не поддерживается Together AI API")
+    def __init__(self, total, first_byte=None, connect=REQUEST_CONNECT_TIMEOUT):
+        self.total = total
+        self.first_byte = total if first_byte is None else min(first_byte, total)
+        self.connect = min(connect, total)
     
-    formatted_messages = []
+    def at_least(self, seconds):
+        """Возвращает таймауты не меньше seconds, для медленных серверов"""
+        if self.first_byte >= seconds:
+            return self
+        return TimeoutBudget(max(self.total, seconds), seconds, self.connect)
     
-    system_content = next((msg["content"] for msg in messages if msg["role"] == "system"), None)
-    if system_content:
-        formatted_messages.append({"role": "system", "content": system_content})
-    
-    for msg in messages:
-        if msg["role"] in ["user", "assistant"]:
-            formatted_messages.append({"role": msg["role"], "content": msg["content"]})
-    
-    data = {
-        "model": api_model,
-        "messages": formatted_messages,
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-        "top_p": 0.7,
-        "top_k": 50,
-        "repetition_penalty": 1.1
-    }
+    def client_timeout(self, remaining):
+        return aiohttp.ClientTimeout(total=remaining, sock_connect=self.connect, sock_read=min(self.first_byte, remaining))
     
-    try:
-        async with aiohttp.ClientSession() as session:
+    def __str__(self):
+        return f"соединение {self.connect:.3g} сек, первый байт {self.first_byte:.3g} сек, весь ответ {self.total:.3g} сек"
+
+class ProviderAdapter:
+    """
+    Адаптер провайдера API моделей.
+    
+    Все, что нужно для запросов к провайдеру, готовится один раз при создании адаптера:
+    заголовки с ключом API, таблица соответствия имен моделей, ограничитель частоты запросов
+    и политика повторов. Соединения берутся из общего для провайдера пула aiohttp.
+    Подклассы определяют только формат запроса и разбор ответа.
+    """
+    
+    supports_streaming = False
+    model_in_body = False  # Передается ли имя модели в теле запроса (иначе в адресе)
+    
+    def __init__(self, name, title, url, api_key="", model_prefix="", model_map=None, strip_prefix=False,
+                 concurrency=MAX_CONCURRENT_REQUESTS, rate_limit=(1.0, 1), max_attempts=1, retry_delay=1,
+                 retry_statuses=(), extra_payload=None, min_timeout=0, stream_replies=False):
+        """
+        Args:
+            name: Имя провайдера в метриках, трассировках и лимитах очереди
+            title: Название API в сообщениях об ошибках
+            url: Адрес API
+            api_key: Ключ API
+            model_prefix: Префикс имен моделей провайдера в AVAILABLE_MODELS, пустой у провайдера по умолчанию
+            model_map: Имена моделей в API провайдера. Если задано, другие модели не поддерживаются
+            strip_prefix: Отбрасывать ли префикс из имени модели при запросе к API
+            concurrency: Лимит одновременных запросов к провайдеру
+            rate_limit: Ограничение частоты запросов: (запросов в секунду, допустимая пачка запросов)
+            max_attempts: Сколько раз пробовать запрос при ошибках сети, таймаутах и кодах из retry_statuses
+            retry_delay: Пауза перед повтором (в секундах), растет с каждой попыткой
+            retry_statuses: Коды ответа, после которых запрос повторяется
+            extra_payload: Дополнительные параметры запроса провайдера
+            min_timeout: Таймаут запроса не меньше этого значения (в секундах), для медленных серверов
+            stream_replies: Показывать ли ответ пользователю по мере генерации (нужна поддержка потоковой генерации)
+        """
+        self.name = name
+        self.title = title
+        self.url = url
+        self.model_prefix = model_prefix
+        self.model_map = model_map
+        self.strip_prefix = strip_prefix
+        self.concurrency = concurrency
+        self.limiter = TokenBucket(*rate_limit)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retry_statuses = frozenset(retry_statuses)
+        self.extra_payload = extra_payload or {}
+        self.min_timeout = min_timeout
+        self.stream_replies = stream_replies and self.supports_streaming
+        self.headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        self.session = None
+    
+    def api_model(self, model):
+        """Возвращает имя модели в API провайдера"""
+        if self.model_map is not None:
+            api_model = self.model_map.get(model)
+            if not api_model:
+                raise Exception(f"Модель {model} не поддерживается {self.title}")
+            return api_model
+        if self.strip_prefix and self.model_prefix:
+            return model[len(self.model_prefix):]
+        return model
+    
+    def get_url(self, api_model):
+        return self.url
+    
+    def build_payload(self, messages, max_tokens, temperature, stream=False):
+        """Возвращает тело запроса без имени модели"""
+        raise NotImplementedError
+    
+    def encode_body(self, request, api_model, max_tokens, temperature, stream=False):
+        """Возвращает сериализованное тело запроса к модели, используя подготовленное для запроса тело провайдера"""
+        key = (self.name, max_tokens, temperature, stream)
+        body = request.bodies.get(key)
+        if body is None:
+            REQUEST_BODY_CACHE_MISSES.inc()
+            body = request.bodies[key] = json_dumps(self.build_payload(request.messages, max_tokens, temperature, stream))
+        else:
+            REQUEST_BODY_CACHE_HITS.inc()
+        if not self.model_in_body:
+            return body
+        # Имя модели дописывается в начало готового JSON объекта, остальное тело общее для всех моделей
+        return b'{"model":' + json_dumps(api_model) + b"," + body[1:]
+    
+    def parse_response(self, result):
+        """Извлекает текст ответа модели из разобранного JSON, или возвращает None"""
+        raise NotImplementedError
+    
+    def get_session(self):
+        # Сессия создается при первом запросе, так как ей нужен работающий цикл событий
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+    
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+    
+    @asynccontextmanager
+    async def open_response(self, url, body, timeout, deadline):
+        """
+        Отправляет POST-запрос к API провайдера, соблюдая ограничение частоты запросов.
+        При ответе 429 ждет указанное провайдером время и повторяет запрос, пока укладывается в deadline.
+        
+        Args:
+            timeout: TimeoutBudget запроса
+            deadline: Момент time.monotonic(), к которому должен быть получен весь ответ
+        
+        Yields:
+            tuple: (ответ aiohttp с кодом, отличным от 429, время отправки запроса, текст последнего ответа 429).
+                Ответ None, если из-за лимита запросов его не удалось получить до deadline
+        """
+        limiter = self.limiter
+        error_text = ""
+        session = self.get_session()
+        
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            waited = await limiter.acquire(max_wait=deadline - time.monotonic())
+            if waited is None:
+                logger.warning(f"Лимит запросов к {self.name} не позволяет отправить запрос до истечения таймаута")
+                error_text = error_text or "превышен лимит запросов, ожидание дольше таймаута"
+                break
+            if waited > 0.5:
+                logger.info(f"Запрос к {self.name} отложен на {waited:.2f} сек из-за лимита запросов")
+            
+            sent = time.monotonic()
             async with session.post(
-                "https://api.together.xyz/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=aiohttp.ClientTimeout(total=timeout)
+                url,
+                headers=self.headers,
+                data=body,
+                timeout=timeout.client_timeout(max(0.1, deadline - sent))
             ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"Ошибка Together AI API: {response.status}, {error_text}")
-                    raise Exception(f"Together AI API вернул код {response.status}: {error_text}")
+                retry_after, remaining, reset_after = parse_rate_limit_headers(response.headers)
                 
-                result = await response.json()
+                if response.status == 429:
+                    PROVIDER_RATE_LIMITED.labels(self.name).inc()
+                    error_text = await response.text()
+                    limiter.on_rate_limited(retry_after if retry_after is not None else reset_after)
+                    logger.warning(f"{self.name} вернул 429 (попытка {attempt+1}/{RATE_LIMIT_MAX_RETRIES+1}), "
+                                   f"новый лимит {limiter.rate:.2f} запр/сек")
+                    continue
                 
-                if "choices" in result and len(result["choices"]) > 0:
-                    content = result["choices"][0]["message"]["content"]
-                    return process_content(content)
-                else:
-                    logger.error(f"Together AI API не вернул ожидаемый результат: {result}")
-                    if "error" in result:
-                        raise Exception(f"Together AI API вернул ошибку: {result['error']}")
-                    else:
-                        raise Exception(f"Together AI API не вернул ожидаемый результат: {result}")
+                limiter.on_success(remaining, reset_after)
+                yield response, sent, error_text
+                return
+        
+        yield None, None, error_text
     
-    except asyncio.TimeoutError:
-        logger.error(f"Таймаут при запросе к Together AI API для модели {model}")
-        raise Exception(f"Таймаут при запросе к API (превышено время ожидания {timeout} сек)")
-    except Exception as e:
-        logger.error(f"Ошибка при запросе к Together AI API: {e}")
-        raise
+    async def post(self, url, body, timeout, timing=None, deadline=None):
+        """
+        Отправляет POST-запрос к API провайдера через open_response и читает ответ целиком.
+        
+        Args:
+            timeout: TimeoutBudget запроса
+            timing: Словарь, в который записывается время до первого байта ответа (first_byte)
+            deadline: Момент time.monotonic(), к которому должен быть получен ответ.
+                По умолчанию через timeout.total от начала запроса
+        
+        Returns:
+            tuple: (код ответа, разобранный JSON при коде 200 или текст ответа в остальных случаях)
+        """
+        if deadline is None:
+            deadline = time.monotonic() + timeout.total
+        async with self.open_response(url, body, timeout, deadline) as (response, sent, error_text):
+            if response is None:
+                return 429, error_text
+            if timing is not None:
+                timing["first_byte"] = time.monotonic() - sent
+            if response.status == 200:
+                return 200, json_loads(await response.read())
+            return response.status, await response.text()
+    
+    async def generate(self, request, model, max_tokens, temperature, timeout=30, timing=None):
+        """
+        Запрашивает ответ модели на ModelRequest с повторами по политике провайдера и возвращает обработанный текст.
+        timeout - TimeoutBudget или таймаут всего ответа в секундах, вместе с повторами.
+        """
+        timeout = as_timeout_budget(timeout).at_least(self.min_timeout)
+        deadline = time.monotonic() + timeout.total
+        api_model = self.api_model(model)
+        url = self.get_url(api_model)
+        body = self.encode_body(request, api_model, max_tokens, temperature)
+        
+        last_error = None
+        error_type = Exception
+        for attempt in range(self.max_attempts):
+            retry = attempt < self.max_attempts - 1
+            error_type = Exception
+            try:
+                status, result = await self.post(url, body, timeout, timing, deadline)
+            except asyncio.TimeoutError as e:
+                logger.error(f"Таймаут при запросе к {self.title} для модели {model} ({type(e).__name__}, {timeout})")
+                last_error = f"Таймаут при запросе к API (превышено время ожидания: {timeout})"
+                error_type = ProviderTimeoutError
+            except aiohttp.ClientError as e:
+                logger.error(f"Ошибка сетевого соединения с {self.title}: {e}")
+                last_error = f"Ошибка сетевого соединения: {e}"
+            else:
+                if status == 200:
+                    content = self.parse_response(result)
+                    if content is not None:
+                        return process_content(content)
+                    logger.error(f"{self.title} не вернул ожидаемый результат: {result}")
+                    if isinstance(result, dict) and "error" in result:
+                        last_error = f"{self.title} вернул ошибку: {result['error']}"
+                    else:
+                        last_error = f"{self.title} не вернул ожидаемый результат: {result}"
+                else:
+                    logger.error(f"Ошибка {self.title}: {status}, {str(result)[:500]}")
+                    last_error = f"{self.title} вернул код {status}: {str(result)[:500]}"
+                    retry = retry and status in self.retry_statuses
+            
+            if not retry:
+                break
+            retry_delay = self.retry_delay * (attempt + 1)
+            # Повтор имеет смысл, только если после паузы останется время на ответ
+            if deadline - time.monotonic() <= retry_delay + MIN_FIRST_BYTE_TIMEOUT:
+                logger.warning(f"Не осталось времени на повторную попытку запроса к {self.title}")
+                break
+            logger.warning(f"Повторная попытка {attempt+2}/{self.max_attempts} запроса к {self.title}...")
+            await asyncio.sleep(retry_delay)
+        
+        raise error_type(last_error)
 
-# Функция для генерации ответа с использованием Hugging Face API
-async def generate_response_huggingface(messages, model, max_tokens, temperature, timeout=30):
-    headers = {
-        "Authorization": f"Bearer {os.getenv('HUGGINGFACE_API_KEY')}",
-        "Content-Type": "application/json"
-    }
+def as_timeout_budget(timeout):
+    return timeout if isinstance(timeout, TimeoutBudget) else TimeoutBudget(timeout)
+
+def format_chat_messages(messages):
+    """Оставляет одно системное сообщение в начале, затем сообщения пользователя и ассистента"""
+    formatted = []
+    system_content = next((msg["content"] for msg in messages if msg["role"] == "system"), None)
+    if system_content:
+        formatted.append({"role": "system", "content": system_content})
+    # Сообщения истории уже содержат только роль и текст, поэтому передаются без копирования
+    formatted.extend(msg for msg in messages if msg["role"] in (ROLE_USER, ROLE_ASSISTANT))
+    return formatted
+
+class OpenAICompatibleAdapter(ProviderAdapter):
+    """Провайдер с OpenAI-совместимым API /chat/completions: OpenRouter, Together AI, llama.cpp, vLLM и др."""
     
-    # Маппинг моделей Hugging Face на их правильные названия в API
-    model_mapping = {
-        "huggingface/mistralai/Mistral-7B-Instruct-v0.2": "mistralai/Mistral-7B-Instruct-v0.2",
-        "huggingface/microsoft/phi-2": "microsoft/phi-2",
-        "huggingface/TinyLlama/TinyLlama-1.1B-Chat-v1.0": "TinyLlama/TinyLlama-1.1B-Chat-v1.0",
-        "huggingface/facebook/opt-350m": "facebook/opt-350m",
-        "huggingface/facebook/opt-1.3b": "facebook/opt-1.3b"
-    }
+    supports_streaming = True
+    model_in_body = True
     
-    api_model = model_mapping.get(model)
-    if not api_model:
-        raise Exception(f"Модель {model} не поддерживается Hugging Face API")
+    def build_payload(self, messages, max_tokens, temperature, stream=False):
+        payload = {
+            "messages": format_chat_messages(messages),
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            **self.extra_payload
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+    
+    def parse_response(self, result):
+        choices = result.get("choices") if isinstance(result, dict) else None
+        if choices:
+            return choices[0]["message"]["content"]
+        return None
+    
+    async def stream(self, request, model, max_tokens, temperature, timeout=30, timing=None):
+        """
+        Запрашивает ответ модели на ModelRequest в потоковом режиме (server-sent events).
+        timeout - TimeoutBudget или таймаут всего ответа в секундах, timing - как в post.
+        
+        Yields:
+            str: Очередной фрагмент текста ответа
+        """
+        timeout = as_timeout_budget(timeout)
+        api_model = self.api_model(model)
+        body = self.encode_body(request, api_model, max_tokens, temperature, stream=True)
+        deadline = time.monotonic() + timeout.total
+        
+        async with self.open_response(self.get_url(api_model), body, timeout, deadline) as (response, sent, error_text):
+            if response is None:
+                raise Exception(f"{self.title} вернул код 429: {error_text[:500]}")
+            if response.status != 200:
+                error_text = await response.text()
+                logger.error(f"Ошибка {self.title}: {response.status}, {error_text[:500]}")
+                raise Exception(f"{self.title} вернул код {response.status}: {error_text[:500]}")
+            
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                choices = json_loads(data).get("choices")
+                if choices:
+                    text = (choices[0].get("delta") or {}).get("content")
+                    if text:
+                        # Сервер отвечает заголовками сразу, а первый токен появляется после обработки запроса
+                        if timing is not None and "first_byte" not in timing:
+                            timing["first_byte"] = time.monotonic() - sent
+                        yield text
+    
+    async def generate_streaming(self, request, model, max_tokens, temperature, on_partial, timeout=30, timing=None):
+        """
+        Запрашивает ответ модели в потоковом режиме и периодически передает готовую часть в on_partial.
+        
+        Показ готовой части идет в фоне, чтобы медленный запрос к Telegram не задерживал чтение ответа.
+        
+        Returns:
+            str: Обработанный текст полного ответа
+        """
+        timeout = as_timeout_budget(timeout).at_least(self.min_timeout)
+        parts = []
+        last_update = time.monotonic()
+        update_task = None
+        try:
+            async for text in self.stream(request, model, max_tokens, temperature, timeout, timing):
+                parts.append(text)
+                now = time.monotonic()
+                if now - last_update >= STREAM_UPDATE_INTERVAL and (update_task is None or update_task.done()):
+                    last_update = now
+                    update_task = asyncio.create_task(on_partial("".join(parts)))
+        except asyncio.TimeoutError as e:
+            logger.error(f"Таймаут при запросе к {self.title} для модели {model} ({type(e).__name__}, {timeout})")
+            raise ProviderTimeoutError(f"Таймаут при запросе к API (превышено время ожидания: {timeout})")
+        except aiohttp.ClientError as e:
+            logger.error(f"Ошибка сетевого соединения с {self.title}: {e}")
+            raise Exception(f"Ошибка сетевого соединения: {e}")
+        finally:
+            # Промежуточный показ не должен перезаписать окончательный ответ
+            if update_task is not None:
+                await asyncio.gather(update_task, return_exceptions=True)
+        
+        return process_content("".join(parts))
+
+class HuggingFaceAdapter(ProviderAdapter):
+    """Hugging Face Inference API: модель указывается в адресе, диалог передается одной строкой"""
+    
+    def __init__(self, name, title, url, **kwargs):
+        super().__init__(name, title, url, **kwargs)
+        self.model_urls = {api_model: f"{url}/{api_model}" for api_model in (self.model_map or {}).values()}
+    
+    def get_url(self, api_model):
+        return self.model_urls.get(api_model) or f"{self.url}/{api_model}"
+    
+    def build_payload(self, messages, max_tokens, temperature, stream=False):
+        parts = []
+        system_content = next((msg["content"] for msg in messages if msg["role"] == "system"), None)
+        if system_content:
+            parts.append(f"<|system|>\n{system_content}\n")
+        for msg in messages:
+            if msg["role"] in (ROLE_USER, ROLE_ASSISTANT):
+                parts.append(f"<|{msg['role']}|>\n{msg['content']}\n")
+        parts.append("<|assistant|>\n")
+        
+        return {
+            "inputs": "".join(parts),
+            "parameters": {
+                "max_new_tokens": max_tokens,
+                "temperature": temperature,
+                **self.extra_payload
+            }
+        }
     
-    conversation = ""
+    def parse_response(self, result):
+        if isinstance(result, list) and len(result) > 0 and "generated_text" in result[0]:
+            content = result[0]["generated_text"]
+        elif isinstance(result, dict) and "generated_text" in result:
+            content = result["generated_text"]
+        else:
+            return None
+        # Модель возвращает диалог целиком, ответ идет после последней метки ассистента
+        return content.split("<|assistant|>\n")[-1]
+
+# Типы адаптеров, которые можно указать в PROVIDER_CONFIGS
+ADAPTER_TYPES = {
+    "openai": OpenAICompatibleAdapter,
+    "huggingface": HuggingFaceAdapter
+}
+
+# Провайдеры API моделей. Чтобы подключить еще один OpenAI-совместимый сервер, достаточно добавить
+# сюда запись с его адресом и префиксом моделей, а модели с этим префиксом - в AVAILABLE_MODELS.
+# Лимиты concurrency и rate_limit по умолчанию берутся из PROVIDER_CONCURRENCY_LIMITS и PROVIDER_RATE_LIMITS
+PROVIDER_CONFIGS = {
+    "openrouter": {
+        "type": "openai",
+        "title": "OpenRouter API",
+        "url": OPENROUTER_API_URL,
+        "api_key": OPENROUTER_API_KEY,
+        "extra_payload": {"stream": False}
+    },
+    "together": {
+        "type": "openai",
+        "title": "Together AI API",
+        "url": TOGETHER_API_URL,
+        "api_key": os.getenv("TOGETHER_API_KEY", ""),
+        "model_prefix": "together/",
+        "model_map": {
+            "together/mixtral-8x7b-instruct": "mistralai/Mixtral-8x7B-Instruct-v0.1",
+            "together/mistral-7b-instruct": "mistralai/Mistral-7B-Instruct-v0.2",
+            "together/llama-2-13b-chat": "meta-llama/Llama-2-13b-chat-hf",
+            "together/llama-2-70b-chat": "meta-llama/Llama-2-70b-chat-hf",
+            "together/qwen-72b-chat": "Qwen/Qwen-72B-Chat",
+            "together/codellama-34b-instruct": "codellama/CodeLlama-34b-Instruct-hf"
+        },
+        "extra_payload": {"top_p": 0.7, "top_k": 50, "repetition_penalty": 1.1}
+    },
+    "huggingface": {
+        "type": "huggingface",
+        "title": "Hugging Face API",
+        "url": HUGGINGFACE_API_URL,
+        "api_key": os.getenv("HUGGINGFACE_API_KEY", ""),
+        "model_prefix": "huggingface/",
+        "model_map": {
+            "huggingface/mistralai/Mistral-7B-Instruct-v0.2": "mistralai/Mistral-7B-Instruct-v0.2",
+            "huggingface/microsoft/phi-2": "microsoft/phi-2",
+            "huggingface/TinyLlama/TinyLlama-1.1B-Chat-v1.0": "TinyLlama/TinyLlama-1.1B-Chat-v1.0",
+            "huggingface/facebook/opt-350m": "facebook/opt-350m",
+            "huggingface/facebook/opt-1.3b": "facebook/opt-1.3b"
+        },
+        "max_attempts": 2,
+        "retry_statuses": (500, 502, 503),
+        "extra_payload": {"top_p": 0.9, "top_k": 50, "repetition_penalty": 1.1, "do_sample": True}
+    }
+}
+
+if LOCAL_LLM_URL:
+    PROVIDER_CONFIGS["local"] = {
+        "type": "openai",
+        "title": "Локальный сервер моделей",
+        "url": f"{LOCAL_LLM_URL}/chat/completions",
+        "api_key": LOCAL_LLM_API_KEY,
+        "model_prefix": LOCAL_MODEL_PREFIX,
+        "strip_prefix": True,
+        "concurrency": LOCAL_LLM_CONCURRENCY,
+        "rate_limit": (100.0, 100),  # Ограничивает только concurrency
+        "min_timeout": LOCAL_LLM_TIMEOUT,
+        "stream_replies": True
+    }
+
+def create_provider_adapters(configs):
+    adapters = {}
+    for name, config in configs.items():
+        config = dict(config)
+        adapter_class = ADAPTER_TYPES[config.pop("type")]
+        config.setdefault("concurrency", PROVIDER_CONCURRENCY_LIMITS.get(name, MAX_CONCURRENT_REQUESTS))
+        config.setdefault("rate_limit", PROVIDER_RATE_LIMITS.get(name, (1.0, 1)))
+        adapters[name] = adapter_class(name, **config)
+    return adapters
+
+provider_adapters = create_provider_adapters(PROVIDER_CONFIGS)
+# Провайдер без префикса обслуживает все остальные модели
+default_provider_adapter = next(adapter for adapter in provider_adapters.values() if not adapter.model_prefix)
+
+def find_provider_adapter(model):
+    # Более длинный префикс точнее, поэтому проверяется первым
+    for adapter in sorted(provider_adapters.values(), key=lambda adapter: len(adapter.model_prefix), reverse=True):
+        if adapter.model_prefix and model.startswith(adapter.model_prefix):
+            return adapter
+    return default_provider_adapter
+
+# Адаптеры известных моделей находятся заранее, чтобы не искать их при каждом запросе
+model_adapters = {model: find_provider_adapter(model) for model in AVAILABLE_MODELS}
+
+def get_provider_adapter(model):
+    return model_adapters.get(model) or find_provider_adapter(model)
+
+# Функция для определения провайдера API по имени модели
+def get_model_provider(model):
+    return get_provider_adapter(model).name
+
+async def discover_local_models():
+    """Запрашивает список моделей у локального сервера, если LOCAL_LLM_MODELS не задан"""
+    if not LOCAL_LLM_URL or LOCAL_LLM_MODELS:
+        return
     
-    system_content = next((msg["content"] for msg in messages if msg["role"] == "system"), None)
-    if system_content:
-        conversation += f"<|system|>\n{system_content}\n"
+    adapter = provider_adapters["local"]
+    try:
+        async with adapter.get_session().get(
+            f"{LOCAL_LLM_URL}/models",
+            headers=adapter.headers,
+            timeout=aiohttp.ClientTimeout(total=10)
+        ) as response:
+            result = json_loads(await response.read())
+        names = [item["id"] for item in result.get("data", [])]
+    except Exception as e:
+        logger.error(f"Не удалось получить список моделей локального сервера {LOCAL_LLM_URL}: {e}")
+        return
     
-    for msg in messages:
-        if msg["role"] == "user":
-            conversation += f"<|user|>\n{msg['content']}\n"
-        elif msg["role"] == "assistant":
-            conversation += f"<|assistant|>\n{msg['content']}\n"
+    register_local_models(names)
+    logger.info(f"Модели локального сервера {LOCAL_LLM_URL}: {', '.join(names) or 'нет'}")
+
+async def close_provider_sessions():
+    await asyncio.gather(*(adapter.close() for adapter in provider_adapters.values()))
+
+class QueueOverloadedError(Exception):
+    """Очередь запросов к API переполнена или время ожидания в ней истекло"""
+
+class AdmissionController:
+    """
+    Ограничивает количество одновременных запросов к API моделей.
     
-    conversation += "<|assistant|>\n"
+    Действует общий лимит и отдельные лимиты для каждого провайдера. Запросы сверх
+    лимита ждут в очереди, которая обслуживается по кругу между пользователями,
+    поэтому один активный пользователь не может занять все слоты.
+    """
     
-    data = {
-        "inputs": conversation,
-        "parameters": {
-            "max_new_tokens": max_tokens,
-            "temperature": temperature,
-            "top_p": 0.9,
-            "top_k": 50,
-            "repetition_penalty": 1.1,
-            "do_sample": True
+    def __init__(self, max_concurrent, provider_limits, max_queue_size, max_wait):
+        self.max_concurrent = max_concurrent
+        self.provider_limits = provider_limits
+        self.max_queue_size = max_queue_size
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.provider_in_flight = {}
+        self.user_queues = OrderedDict()  # Очереди ожидающих запросов по пользователям
+        self.queued = 0
+        self.stats = {
+            "admitted": 0,         # Запросов допущено к API
+            "waited": 0,           # Из них ждали в очереди
+            "rejected": 0,         # Отклонено из-за перегрузки
+            "total_queue_time": 0.0,
+            "max_queue_time": 0.0
         }
-    }
     
-    max_retries = 2
-    retry_delay = 1
-    last_error = None
+    def _has_capacity(self, provider):
+        provider_limit = self.provider_limits.get(provider, self.max_concurrent)
+        return (self.in_flight < self.max_concurrent and
+                self.provider_in_flight.get(provider, 0) < provider_limit)
+    
+    def _dispatch(self):
+        # Выдаем освободившиеся слоты по кругу: после обслуживания пользователь уходит в конец очереди
+        granted = True
+        while granted and self.in_flight < self.max_concurrent:
+            granted = False
+            for user_key in list(self.user_queues):
+                queue = self.user_queues[user_key]
+                # Запрос к занятому провайдеру не задерживает следующие запросы пользователя к свободным,
+                # а к одному провайдеру запросы пользователя выполняются по порядку
+                waiter = next((item for item in queue if self._has_capacity(item["provider"])), None)
+                if waiter is None:
+                    continue
+                
+                queue.remove(waiter)
+                self.queued -= 1
+                if queue:
+                    self.user_queues.move_to_end(user_key)
+                else:
+                    del self.user_queues[user_key]
+                
+                self.in_flight += 1
+                self.provider_in_flight[waiter["provider"]] = self.provider_in_flight.get(waiter["provider"], 0) + 1
+                waiter["future"].set_result(True)
+                granted = True
+                break
     
-    api_endpoint = f"https://api-inference.huggingface.co/models/{api_model}"
+    def _remove_waiter(self, waiter):
+        queue = self.user_queues.get(waiter["user_key"])
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self.queued -= 1
+            if not queue:
+                del self.user_queues[waiter["user_key"]]
+        if not waiter["future"].done():
+            waiter["future"].cancel()
+    
+    def provider_backlog(self, provider):
+        """Сколько запросов к провайдеру выполняется и ждет в очереди, в долях его лимита"""
+        queued = sum(1 for queue in self.user_queues.values() for waiter in queue if waiter["provider"] == provider)
+        return (self.provider_in_flight.get(provider, 0) + queued) / self.provider_limits.get(provider, self.max_concurrent)
+    
+    def queue_position(self, waiter):
+        """Примерная позиция запроса в очереди с учетом обслуживания по кругу (начиная с 1)"""
+        queue = self.user_queues.get(waiter["user_key"])
+        if not queue or waiter not in queue:
+            return 0
+        
+        index = queue.index(waiter)
+        position = 1 + index
+        behind = False
+        for user_key, other_queue in self.user_queues.items():
+            if user_key == waiter["user_key"]:
+                behind = True
+                continue
+            # Пользователи впереди по кругу успеют получить на один слот больше, чем стоящие позади
+            position += min(len(other_queue), index if behind else index + 1)
+        
+        return position
     
-    for attempt in range(max_retries):
+    async def acquire(self, user_key, provider, on_queue_position=None):
+        """
+        Ожидает свободный слот для запроса к провайдеру.
+        
+        Args:
+            user_key: Идентификатор пользователя, от имени которого выполняется запрос
+            provider: Имя провайдера API
+            on_queue_position: Корутина, которая вызывается с номером в очереди, если приходится ждать,
+                и с номером 0, когда запрос вышел из очереди
+            
+        Returns:
+            float: Время ожидания в очереди в секундах
+        """
+        if self.queued >= self.max_queue_size:
+            self.stats["rejected"] += 1
+            logger.warning(f"Очередь запросов переполнена ({self.queued} запросов), запрос отклонен")
+            raise QueueOverloadedError("Сервис перегружен: слишком много запросов в очереди")
+        
+        start_time = time.monotonic()
+        waiter = {
+            "user_key": user_key,
+            "provider": provider,
+            "future": asyncio.get_running_loop().create_future()
+        }
+        self.user_queues.setdefault(user_key, deque()).append(waiter)
+        self.queued += 1
+        self._dispatch()
+        
+        last_position = None
         try:
-            logger.info(f"Запрос к Hugging Face API (попытка {attempt+1}/{max_retries})")
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    api_endpoint,
-                    headers=headers,
-                    json=data,
-                    timeout=aiohttp.ClientTimeout(total=timeout)
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        
-                        if isinstance(result, list) and len(result) > 0 and "generated_text" in result[0]:
-                            content = result[0]["generated_text"]
-                            assistant_parts = content.split("<|assistant|>\n")
-                            if len(assistant_parts) > 1:
-                                return process_content(assistant_parts[-1])
-                            return process_content(content)
-                        elif isinstance(result, dict) and "generated_text" in result:
-                            content = result["generated_text"]
-                            assistant_parts = content.split("<|assistant|>\n")
-                            if len(assistant_parts) > 1:
-                                return process_content(assistant_parts[-1])
-                            return process_content(content)
-                        else:
-                            logger.error(f"Hugging Face API не вернул ожидаемый результат: {result}")
-                            last_error = f"Hugging Face API не вернул ожидаемый результат: {result}"
-                            continue
-                    
-                    elif response.status in [503, 502, 500]:
-                        error_text = await response.text()
-                        logger.warning(f"Hugging Face API временно недоступен ({response.status}): попытка {attempt+1}/{max_retries}")
-                        last_error = f"Hugging Face API вернул код {response.status} (сервис временно недоступен)"
-                        if attempt < max_retries - 1:
-                            await asyncio.sleep(retry_delay * (attempt + 1))
-                            continue
-                        else:
-                            raise Exception(last_error)
-                            
-                    elif response.status == 429:
-                        error_text = await response.text()
-                        logger.warning(f"Hugging Face API превышение лимита запросов (429): попытка {attempt+1}/{max_retries}")
-                        last_error = f"Hugging Face API вернул код 429 (превышен лимит запросов)"
-                        if attempt < max_retries - 1:
-                            await asyncio.sleep(retry_delay * (attempt + 1))
-                            continue
-                        else:
-                            raise Exception(last_error)
-                            
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка Hugging Face API: {response.status}, {error_text[:500]}...")
-                        last_error = f"Hugging Face API вернул код {response.status}"
-                        if attempt < max_retries - 1:
-                            await asyncio.sleep(retry_delay)
-                            continue
-                        else:
-                            raise Exception(f"Hugging Face API вернул код {response.status}: {error_text[:500]}...")
-        
-        except asyncio.TimeoutError:
-            logger.error(f"Таймаут при запросе к Hugging Face API для модели {model}")
-            last_error = f"Таймаут при запросе к API (превышено время ожидания {timeout} сек)"
-            if attempt < max_retries - 1:
-                logger.warning(f"Повторная попытка {attempt+2}/{max_retries} после таймаута...")
-                await asyncio.sleep(retry_delay)
-                continue
-            else:
-                raise Exception(last_error)
+            while not waiter["future"].done():
+                remaining = self.max_wait - (time.monotonic() - start_time)
+                if remaining <= 0:
+                    self.stats["rejected"] += 1
+                    logger.warning(f"Запрос пользователя {user_key} к {provider} не дождался очереди за {self.max_wait} сек")
+                    raise QueueOverloadedError(f"Сервис перегружен: превышено время ожидания в очереди ({self.max_wait} сек)")
                 
-        except aiohttp.ClientError as e:
-            logger.error(f"Ошибка сетевого соединения с Hugging Face API: {e}")
-            last_error = f"Ошибка сетевого соединения: {str(e)}"
-            if attempt < max_retries - 1:
-                logger.warning(f"Повторная попытка {attempt+2}/{max_retries} после ошибки соединения...")
-                await asyncio.sleep(retry_delay)
-                continue
-            else:
-                raise Exception(last_error)
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(waiter["future"]),
+                        timeout=min(QUEUE_POSITION_UPDATE_INTERVAL, remaining)
+                    )
+                except asyncio.TimeoutError:
+                    pass
                 
-        except Exception as e:
-            logger.error(f"Неожиданная ошибка при запросе к Hugging Face API: {e}")
-            last_error = str(e)
-            if attempt < max_retries - 1:
-                logger.warning(f"Повторная попытка {attempt+2}/{max_retries} после ошибки...")
-                await asyncio.sleep(retry_delay)
-                continue
+                if on_queue_position and not waiter["future"].done():
+                    position = self.queue_position(waiter)
+                    if position and position != last_position:
+                        last_position = position
+                        try:
+                            await on_queue_position(position)
+                        except Exception as e:
+                            logger.debug(f"Не удалось обновить позицию в очереди: {e}")
+        except BaseException:
+            if waiter["future"].done() and not waiter["future"].cancelled():
+                self.release(provider)
             else:
-                raise Exception(f"Неожиданная ошибка при запросе к Hugging Face API: {e}")
+                self._remove_waiter(waiter)
+            raise
+        
+        queue_time = time.monotonic() - start_time
+        self.stats["admitted"] += 1
+        self.stats["total_queue_time"] += queue_time
+        self.stats["max_queue_time"] = max(self.stats["max_queue_time"], queue_time)
+        if last_position is not None:
+            self.stats["waited"] += 1
+            logger.info(f"Запрос пользователя {user_key} к {provider} ждал в очереди {queue_time:.2f} сек")
+            try:
+                await on_queue_position(0)
+            except Exception as e:
+                logger.debug(f"Не удалось обновить позицию в очереди: {e}")
+        
+        return queue_time
+    
+    def release(self, provider):
+        self.in_flight -= 1
+        self.provider_in_flight[provider] -= 1
+        self._dispatch()
     
-    if last_error:
-        raise Exception(f"Все попытки подключения к Hugging Face API не удались. Последняя ошибка: {last_error}")
+    @asynccontextmanager
+    async def slot(self, user_key, provider, on_queue_position=None):
+        await self.acquire(user_key, provider, on_queue_position)
+        try:
+            yield
+        finally:
+            self.release(provider)
+
+admission_controller = AdmissionController(
+    max_concurrent=MAX_CONCURRENT_REQUESTS,
+    provider_limits={name: adapter.concurrency for name, adapter in provider_adapters.items()},
+    max_queue_size=MAX_QUEUE_SIZE,
+    max_wait=QUEUE_MAX_WAIT
+)
+ADMISSION_QUEUE_DEPTH.set_function(lambda: admission_controller.queued)
+
+class ModelStats:
+    __slots__ = ("latency", "failure_latency", "success_rate", "updated", "samples", "timeouts")
+    
+    def __init__(self):
+        self.latency = None          # Сглаженная задержка успешного ответа
+        self.failure_latency = None  # Сглаженное время до ошибки
+        self.success_rate = None     # Сглаженная доля успешных ответов
+        self.updated = 0.0
+        self.samples = deque(maxlen=TIMEOUT_WINDOW)  # (задержка, первый байт, max_tokens) последних успешных ответов
+        self.timeouts = 0            # Таймаутов подряд с последнего успешного ответа
+
+class ModelRouter:
+    """
+    Оценивает модели по реальным запросам: экспоненциально сглаженные (EWMA) задержка ответа,
+    время до ошибки и доля успешных ответов.
+    
+    Модели перебираются по очереди до первого ответа, поэтому ожидаемое время до ответа
+    минимально при сортировке по отношению ожидаемой длительности попытки к вероятности успеха.
+    В длительность попытки входит ожидание очереди и лимита частоты запросов провайдера,
+    чтобы все запросы не уходили к одной, самой быстрой модели.
+    Без новых запросов оценка модели постепенно возвращается к предполагаемой по ее статусу,
+    чтобы модель после сбоя снова получала запросы.
+    """
     
-    raise Exception("Непредвиденная ошибка в работе с Hugging Face API")
+    def __init__(self, alpha=ROUTER_EWMA_ALPHA, prior_latency=ROUTER_PRIOR_LATENCY,
+                 recovery_half_life=ROUTER_RECOVERY_HALF_LIFE, exploration=ROUTER_EXPLORATION):
+        self.alpha = alpha
+        self.prior_latency = prior_latency
+        self.recovery_half_life = recovery_half_life
+        self.exploration = exploration
+        self.stats = {}
+    
+    def observe(self, model, ok, latency, max_tokens=None, first_byte=None, timed_out=False):
+        """
+        Учитывает результат запроса к модели. Успешные ответы с max_tokens попадают в окно для таймаутов,
+        таймауты подряд (timed_out) увеличивают следующий таймаут модели.
+        """
+        stats = self.stats.get(model)
+        if stats is None:
+            stats = self.stats[model] = ModelStats()
+        alpha = self.alpha
+        if ok:
+            stats.latency = latency if stats.latency is None else stats.latency + alpha * (latency - stats.latency)
+            if max_tokens:
+                stats.samples.append((latency, latency if first_byte is None else first_byte, max_tokens))
+            stats.timeouts = 0
+        else:
+            stats.failure_latency = latency if stats.failure_latency is None else stats.failure_latency + alpha * (latency - stats.failure_latency)
+            if timed_out:
+                stats.timeouts += 1
+        # Сначала оценка доли успешных ответов возвращается к предполагаемой за время без запросов
+        success_rate = self.success_rate(model)
+        stats.success_rate = success_rate + alpha * ((1.0 if ok else 0.0) - success_rate)
+        stats.updated = time.monotonic()
+    
+    def prior_success(self, model):
+        for status, models in MODEL_STATUSES.items():
+            if model in models:
+                return ROUTER_PRIOR_SUCCESS.get(status, 0.5)
+        return ROUTER_PRIOR_SUCCESS["partially_working"]
+    
+    def success_rate(self, model):
+        prior = self.prior_success(model)
+        stats = self.stats.get(model)
+        if stats is None or stats.success_rate is None:
+            return prior
+        decay = 0.5 ** ((time.monotonic() - stats.updated) / self.recovery_half_life)
+        return prior + (stats.success_rate - prior) * decay
+    
+    def expected_time(self, model):
+        """Ожидаемое время до ответа при попытках только этой модели (в секундах)"""
+        stats = self.stats.get(model)
+        latency = self.prior_latency if stats is None or stats.latency is None else stats.latency
+        failure_latency = latency if stats is None or stats.failure_latency is None else stats.failure_latency
+        success_rate = max(self.success_rate(model), 0.01)
+        attempt_time = success_rate * latency + (1 - success_rate) * failure_latency
+        
+        adapter = get_provider_adapter(model)
+        # Если все слоты провайдера заняты, запрос ждет примерно по одной попытке на каждый лимит запросов впереди
+        queue_rounds = max(0.0, admission_controller.provider_backlog(adapter.name) + 1 / adapter.concurrency - 1)
+        wait_time = adapter.limiter.expected_delay() + queue_rounds * attempt_time
+        return (wait_time + attempt_time) / success_rate
+    
+    def rank(self, models):
+        # Сортировка устойчива: модели без замеров остаются в исходном порядке
+        return sorted(models, key=self.expected_time)
+    
+    def choose_primary(self):
+        """Выбирает модель для пользователей с настройкой "auto" """
+        candidates = MODEL_STATUSES["fully_working"] or MODEL_STATUSES["partially_working"] or AVAILABLE_MODELS
+        if random.random() < self.exploration:
+            return random.choice(candidates)
+        return min(candidates, key=self.expected_time)
+    
+    def timeout_budget(self, model, max_tokens, max_total=MAX_REQUEST_TIMEOUT):
+        """
+        Считает таймауты запроса к модели по перцентилю ее недавних задержек.
+        
+        Задержка считается состоящей из постоянной части и части, пропорциональной max_tokens,
+        поэтому замеры приводятся к запрошенной длине ответа. Пока замеров мало, используется
+        таймаут по умолчанию для модели, пересчитанный так же.
+        
+        После таймаутов подряд таймаут по замерам увеличивается в TIMEOUT_BACKOFF раз за каждый,
+        но не больше таймаута по умолчанию: замедлившаяся модель снова успевает ответить
+        и пополняет замеры, а зависшая не держит сообщения дольше, чем без замеров.
+        """
+        size = TIMEOUT_OVERHEAD_TOKENS + max_tokens
+        stats = self.stats.get(model)
+        samples = stats.samples if stats is not None else ()
+        default = MODEL_TIMEOUT_DEFAULTS.get(model, REQUEST_TIMEOUT_DEFAULT)
+        default_total = default * size / (TIMEOUT_OVERHEAD_TOKENS + TIMEOUT_REFERENCE_TOKENS)
+        if len(samples) < TIMEOUT_MIN_SAMPLES:
+            total = default_total
+            first_byte = None
+        else:
+            index = min(len(samples) - 1, len(samples) * TIMEOUT_PERCENTILE // 100)
+            totals = sorted(latency * size / (TIMEOUT_OVERHEAD_TOKENS + tokens) for latency, _, tokens in samples)
+            first_bytes = sorted(first * size / (TIMEOUT_OVERHEAD_TOKENS + tokens) for _, first, tokens in samples)
+            total = max(TIMEOUT_MARGIN * totals[index], MIN_REQUEST_TIMEOUT)
+            first_byte = max(MIN_FIRST_BYTE_TIMEOUT, TIMEOUT_MARGIN * first_bytes[index])
+            if stats.timeouts and total < default_total:
+                backoff = min(TIMEOUT_BACKOFF ** stats.timeouts, default_total / total)
+                total *= backoff
+                first_byte *= backoff
+        total = min(max(total, MIN_REQUEST_TIMEOUT), max_total)
+        return TimeoutBudget(total, first_byte)
+    
+    def describe(self, model):
+        stats = self.stats.get(model)
+        latency = "нет замеров" if stats is None or stats.latency is None else f"{stats.latency:.1f} сек"
+        return f"{latency}, успешных {self.success_rate(model) * 100:.0f}%"
 
-# Функция для определения и вызова правильного API на основе имени модели
-async def generate_response(messages, model, max_tokens, temperature, timeout=30):
+model_router = ModelRouter()
+
+# Функция для вызова API провайдера, которому принадлежит модель
+async def generate_response(messages, model, max_tokens, temperature, timeout=None, user_id=None, on_queue_position=None, on_partial=None):
     """
-    Определяет нужный API на основе имени модели и вызывает соответствующую функцию
+    Находит адаптер провайдера модели и выполняет запрос с учетом очереди запросов
     
     Args:
-        messages: Список сообщений для отправки в API
+        messages: Список сообщений для отправки в API или ModelRequest, общий для нескольких моделей
         model: Имя модели
         max_tokens: Максимальное количество токенов в ответе
         temperature: Температура (креативность) генерации
-        timeout: Время ожидания ответа от API в секундах
+        timeout: TimeoutBudget или время ожидания ответа в секундах. По умолчанию таймауты
+            считаются по недавним задержкам модели (model_router.timeout_budget)
+        user_id: ID пользователя для справедливой очереди запросов
+        on_queue_position: Корутина для уведомления о позиции в очереди
+        on_partial: Корутина, которой передается готовая часть ответа, если провайдер генерирует его потоком
         
     Returns:
         str: Сгенерированный ответ
@@ -746,59 +2554,87 @@ async def generate_response(messages, model, max_tokens, temperature, timeout=30
     if temperature is None:
         temperature = 0.7  # Значение по умолчанию
         
-    if not messages:
+    request = messages if isinstance(messages, ModelRequest) else ModelRequest(messages)
+    if not request.messages:
         logger.error("Получен пустой список сообщений в generate_response")
         raise ValueError("Список сообщений не может быть пустым")
     
+    adapter = get_provider_adapter(model)
+    provider = adapter.name
+    if timeout is None:
+        timeout = model_router.timeout_budget(model, max_tokens)
+    timing = {}
+    
     try:
-        if model.startswith('together/'):
-            return await generate_response_together(
-                messages=messages,
-                model=model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                timeout=timeout
-            )
-        elif model.startswith('huggingface/'):
-            return await generate_response_huggingface(
-                messages=messages,
-                model=model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                timeout=timeout
-            )
-        else:
-            return await generate_response_openrouter(
-                messages=messages,
-                model=model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                timeout=timeout
-            )
+        async with admission_controller.slot(user_id, provider, on_queue_position):
+            with trace_span("provider_request", provider=provider, model=model, max_tokens=max_tokens):
+                PROVIDER_IN_FLIGHT.labels(provider).inc()
+                started = time.monotonic()
+                try:
+                    if on_partial is not None and adapter.stream_replies:
+                        response = await adapter.generate_streaming(
+                            request=request,
+                            model=model,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                            on_partial=on_partial,
+                            timeout=timeout,
+                            timing=timing
+                        )
+                    else:
+                        response = await adapter.generate(
+                            request=request,
+                            model=model,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                            timeout=timeout,
+                            timing=timing
+                        )
+                except Exception as e:
+                    elapsed = time.monotonic() - started
+                    PROVIDER_REQUEST_SECONDS.labels(provider, model, "error").observe(elapsed)
+                    error_kind = classify_provider_error(e)
+                    PROVIDER_ERRORS.labels(provider, model, error_kind).inc()
+                    model_router.observe(model, False, elapsed, timed_out=error_kind == "timeout")
+                    raise
+                finally:
+                    PROVIDER_IN_FLIGHT.labels(provider).dec()
+                elapsed = time.monotonic() - started
+                PROVIDER_REQUEST_SECONDS.labels(provider, model, "ok").observe(elapsed)
+                model_router.observe(model, True, elapsed, max_tokens, timing.get("first_byte"))
+                return response
+    except QueueOverloadedError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при запросе к API для модели {model}: {e}")
         raise
 
+# Функция для удаления нескольких сообщений бота одним запросом
+async def delete_bot_messages(chat_id, message_ids):
+    # Bot API позволяет удалить до 100 сообщений за один вызов
+    for i in range(0, len(message_ids), 100):
+        chunk = message_ids[i:i + 100]
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+        except Exception as e:
+            logger.error(f"Не удалось удалить сообщения {chunk}: {e}")
+
 @dp.message(Command("start"))
 async def start(message: types.Message):
     user_id = message.from_user.id
     
-    user_message_history[user_id] = []
+    user_message_history[user_id] = make_user_history(user_settings.get(user_id, DEFAULT_SETTINGS).get("history_length", 10))
+    reset_history_summary(user_id)
     
     if user_id in user_last_messages:
-        for msg_id in user_last_messages[user_id]:
-            try:
-                await bot.delete_message(chat_id=message.chat.id, message_id=msg_id)
-            except Exception as e:
-                logger.error(f"Не удалось удалить сообщение {msg_id}: {e}")
-        
+        await delete_bot_messages(message.chat.id, user_last_messages[user_id])
         user_last_messages[user_id] = []
     
-    save_user_history(user_message_history)
+    snapshot_writer.mark_dirty("history")
     
     if user_id not in user_settings:
         user_settings[user_id] = DEFAULT_SETTINGS.copy()
-        save_user_settings(user_settings)
+        snapshot_writer.mark_dirty("settings")
     
     quick_start_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔍 Выбрать модель", callback_data="setting_model")],
@@ -877,9 +2713,10 @@ async def help_command(message: types.Message):
 async def clear_history(message: types.Message):
     user_id = message.from_user.id
     
-    user_message_history[user_id] = []
+    user_message_history[user_id] = make_user_history(user_settings.get(user_id, DEFAULT_SETTINGS).get("history_length", 10))
+    reset_history_summary(user_id)
     
-    save_user_history(user_message_history)
+    snapshot_writer.mark_dirty("history")
     
     await message.answer("История нашего разговора очищена!")
 
@@ -892,6 +2729,7 @@ async def show_info(message: types.Message):
     
     settings = user_settings[user_id]
     dynamic_status = "включен" if settings.get('dynamic_chat', False) else "выключен"
+    compact_status = "включены" if settings.get('compact_replies', True) else "выключены"
     
     await message.answer(
         f"Ваши текущие настройки:\n"
@@ -899,6 +2737,7 @@ async def show_info(message: types.Message):
         f"Максимальное количество токенов: {settings['max_tokens']}\n"
         f"Температура (креативность): {settings['temperature']}\n"
         f"Динамический чат: {dynamic_status}\n"
+        f"Компактные ответы: {compact_status}\n"
         f"Системное сообщение: {settings['system_message']}"
     )
 
@@ -918,6 +2757,7 @@ async def settings(message: types.Message):
         [InlineKeyboardButton(text="📜 Длина истории", callback_data='setting_history_length')],
         [InlineKeyboardButton(text="✍️ Системное сообщение", callback_data='setting_system_message')],
         [InlineKeyboardButton(text="💬 Режим динамического чата", callback_data='setting_dynamic_chat')],
+        [InlineKeyboardButton(text="📦 Компактные ответы", callback_data='setting_compact_replies')],
         [InlineKeyboardButton(text="🔙 Вернуться в главное меню", callback_data='back_to_main')]
     ])
     
@@ -988,6 +2828,12 @@ async def button_callback(callback_query: types.CallbackQuery):
                     callback_data='show_models_unavailable'
                 )])
             
+            auto_indicator = "✅ " if user_settings[user_id]["model"] == AUTO_MODEL else ""
+            keyboard.append([InlineKeyboardButton(
+                text=f"{auto_indicator}🧭 Автовыбор самой быстрой модели",
+                callback_data=f'set_model_{AUTO_MODEL}'
+            )])
+            
             # Добавляем кнопку возврата
             keyboard.append([InlineKeyboardButton(text="🔙 Назад к настройкам", callback_data='back_to_settings')])
             
@@ -1117,7 +2963,7 @@ async def button_callback(callback_query: types.CallbackQuery):
             old_model = user_settings[user_id]['model']
             user_settings[user_id]['model'] = model
             
-            save_user_settings(user_settings)
+            snapshot_writer.mark_dirty("settings")
             
             loading_message = await callback_query.message.edit_text(
                 f"⏳ Меняю модель с {old_model.split('/')[-1]} на {model.split('/')[-1]}...",
@@ -1144,7 +2990,7 @@ async def button_callback(callback_query: types.CallbackQuery):
             max_tokens = int(callback_data.replace('set_max_tokens_', ''))
             user_settings[user_id]['max_tokens'] = max_tokens
             
-            save_user_settings(user_settings)
+            snapshot_writer.mark_dirty("settings")
             
             success_text = (
                 f"✅ <b>Настройка успешно изменена!</b>\n\n"
@@ -1163,7 +3009,7 @@ async def button_callback(callback_query: types.CallbackQuery):
             temperature = float(callback_data.replace('set_temperature_', ''))
             user_settings[user_id]['temperature'] = temperature
             
-            save_user_settings(user_settings)
+            snapshot_writer.mark_dirty("settings")
             
             creativity_level = "низкая" if temperature <= 0.3 else "средняя" if temperature <= 0.7 else "высокая" if temperature <= 1.0 else "очень высокая"
             
@@ -1191,7 +3037,7 @@ async def button_callback(callback_query: types.CallbackQuery):
             
             user_settings[user_id]['system_message'] = system_examples[example_index]
             
-            save_user_settings(user_settings)
+            snapshot_writer.mark_dirty("settings")
             
             success_text = (
                 f"✅ <b>Системное сообщение успешно изменено!</b>\n\n"
@@ -1245,7 +3091,7 @@ async def button_callback(callback_query: types.CallbackQuery):
             enabled = callback_data == 'set_dynamic_chat_true'
             user_settings[user_id]['dynamic_chat'] = enabled
             
-            save_user_settings(user_settings)
+            snapshot_writer.mark_dirty("settings")
             
             status_text = "включен" if enabled else "выключен"
             success_text = (
@@ -1259,11 +3105,46 @@ async def button_callback(callback_query: types.CallbackQuery):
             ])
             await callback_query.message.edit_text(success_text, reply_markup=back_keyboard, parse_mode=ParseMode.HTML)
         
+        elif callback_data == 'setting_compact_replies':
+            current_status = "включены" if user_settings[user_id].get('compact_replies', True) else "выключены"
+            compact_text = (
+                f"📦 <b>Компактные ответы</b>\n\n"
+                f"{SETTINGS_DESCRIPTIONS['compact_replies']}\n\n"
+                f"Текущий статус: <b>{current_status}</b>\n\n"
+                f"При выключенном режиме ответ, информация о генерации и предложение сменить модель "
+                f"приходят отдельными сообщениями."
+            )
+            
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="✅ Включить", callback_data='set_compact_replies_true')],
+                [InlineKeyboardButton(text="❌ Выключить", callback_data='set_compact_replies_false')],
+                [InlineKeyboardButton(text="🔙 Назад к настройкам", callback_data='back_to_settings')]
+            ])
+            await callback_query.message.edit_text(compact_text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+        
+        elif callback_data.startswith('set_compact_replies_'):
+            enabled = callback_data == 'set_compact_replies_true'
+            user_settings[user_id]['compact_replies'] = enabled
+            
+            snapshot_writer.mark_dirty("settings")
+            
+            status_text = "включены" if enabled else "выключены"
+            success_text = (
+                f"✅ <b>Настройка успешно изменена!</b>\n\n"
+                f"Компактные ответы: <b>{status_text}</b>\n\n"
+                f"{'Теперь ответ будет появляться на месте сообщения о генерации.' if enabled else 'Теперь ответ и информация о генерации будут приходить отдельными сообщениями.'}"
+            )
+            
+            back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 Назад к настройкам", callback_data='back_to_settings')]
+            ])
+            await callback_query.message.edit_text(success_text, reply_markup=back_keyboard, parse_mode=ParseMode.HTML)
+        
         elif callback_data.startswith('set_history_length_'):
             history_length = int(callback_data.replace('set_history_length_', ''))
             user_settings[user_id]['history_length'] = history_length
             
-            save_user_settings(user_settings)
+            snapshot_writer.mark_dirty("settings")
             
             history_description = "минимальная" if history_length <= 5 else "небольшая" if history_length <= 10 else "средняя" if history_length <= 20 else "большая" if history_length <= 50 else "максимальная"
             
@@ -1324,22 +3205,168 @@ async def show_menu(message: types.Message):
         reply_markup=main_keyboard
     )
 
+# Одновременно может идти только одно профилирование
+profile_lock = asyncio.Lock()
+
+def measure_user_state():
+    """Возвращает размер данных пользователей в памяти, которые обычно растут со временем"""
+    return {
+        "пользователей в памяти": len(user_message_history),
+        "сообщений в истории": sum(len(history) for history in user_message_history.values()),
+        "символов в истории": sum(len(entry.content) for history in user_message_history.values() for entry in history),
+        "длинных ответов": len(full_responses),
+        "символов в длинных ответах": sum(len(response) for response in full_responses.values()),
+    }
+
+async def collect_profile(seconds, clock):
+    """
+    Профилирует все задачи цикла событий в течение seconds секунд.
+    
+    cProfile видит только поток цикла событий, yappi (если установлен) также учитывает
+    потоки, в которых идут ffmpeg и распознавание речи.
+    
+    Returns:
+        pstats.Stats: Собранная статистика
+    """
+    if yappi is not None:
+        yappi.clear_stats()
+        yappi.set_clock_type(clock)
+        yappi.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            yappi.stop()
+        stats = yappi.convert2pstats(yappi.get_func_stats())
+        yappi.clear_stats()
+        return stats
+    
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    return pstats.Stats(profiler)
+
+def format_profile_top(stats, limit):
+    """Форматирует самые затратные функции по собственному времени для отправки в чат"""
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+    lines = [f"{'своё, с':>8} {'всего, с':>9} {'вызовов':>8}  функция"]
+    for (file_name, line, function), (_, calls, own_time, total_time, _) in rows:
+        location = f"{os.path.basename(file_name)}:{line}" if line else file_name
+        lines.append(f"{own_time:8.3f} {total_time:9.3f} {calls:8}  {location}({function})")
+    return html.escape("\n".join(lines))
+
+def format_memory_diff(before, after, limit=10):
+    """Сравнивает снимки tracemalloc и форматирует строки кода с наибольшим ростом памяти"""
+    # Память самих профилировщиков не относится к боту
+    profiler_modules = [cProfile, pstats, tracemalloc] + ([yappi] if yappi is not None else [])
+    profiler_files = [tracemalloc.Filter(False, module.__file__) for module in profiler_modules]
+    before = before.filter_traces(profiler_files)
+    after = after.filter_traces(profiler_files)
+    lines = []
+    for stat in after.compare_to(before, "lineno")[:limit]:
+        frame = stat.traceback[0]
+        lines.append(
+            f"{stat.size_diff / 1024:+9.1f} КБ {stat.count_diff:+7}  "
+            f"{os.path.basename(frame.filename)}:{frame.lineno}"
+        )
+    return html.escape("\n".join(lines))
+
+@dp.message(Command("profile"))
+async def profile_command(message: types.Message, command: CommandObject):
+    """
+    Профилирует работающего бота: /profile [секунды] [mem] [wall|cpu].
+    
+    mem дополнительно сравнивает снимки памяти tracemalloc до и после профилирования,
+    wall/cpu выбирает часы yappi (по умолчанию cpu).
+    """
+    if message.from_user.id not in ADMIN_USER_IDS:
+        await message.answer("⛔ Команда доступна только администраторам бота.")
+        return
+    
+    seconds = PROFILE_DEFAULT_SECONDS
+    with_memory = False
+    clock = "cpu"
+    for argument in (command.args or "").split():
+        if argument.isdigit():
+            seconds = max(1, min(int(argument), PROFILE_MAX_SECONDS))
+        elif argument == "mem":
+            with_memory = True
+        elif argument in ("wall", "cpu"):
+            clock = argument
+    
+    if profile_lock.locked():
+        await message.answer("⏳ Профилирование уже идет, дождитесь его окончания.")
+        return
+    
+    async with profile_lock:
+        engine = f"yappi ({clock})" if yappi is not None else "cProfile"
+        await message.answer(
+            f"⏱ Профилирую бота {seconds} сек с помощью {engine}"
+            f"{' и tracemalloc' if with_memory else ''}..."
+        )
+        logger.info(f"Администратор {message.from_user.id} запустил профилирование на {seconds} сек")
+        
+        started_tracing = False
+        if with_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            memory_before = tracemalloc.take_snapshot()
+            state_before = measure_user_state()
+        
+        try:
+            stats = await collect_profile(seconds, clock)
+            if with_memory:
+                memory_after = tracemalloc.take_snapshot()
+                state_after = measure_user_state()
+            
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile_path = os.path.join(PROFILE_DIR, f"profile_{datetime.now():%Y%m%d_%H%M%S}.pstats")
+            await asyncio.to_thread(stats.dump_stats, profile_path)
+            
+            report = (
+                f"📊 <b>Профиль за {seconds} сек</b> ({engine})\n\n"
+                f"<pre>{format_profile_top(stats, PROFILE_TOP_FUNCTIONS)}</pre>"
+            )
+            await message.answer(report, parse_mode=ParseMode.HTML)
+            await message.answer_document(
+                FSInputFile(profile_path),
+                caption="Файл pstats: python -m pstats, snakeviz или gprof2dot"
+            )
+            
+            if with_memory:
+                # Сравнение снимков занимает заметное время, поэтому идет в отдельном потоке
+                memory_diff = await asyncio.to_thread(format_memory_diff, memory_before, memory_after)
+                state_lines = "\n".join(
+                    f"{name}: {state_before[name]} → {state_after[name]}" for name in state_after
+                )
+                await message.answer(
+                    f"🧠 <b>Рост памяти за {seconds} сек</b>\n\n"
+                    f"<pre>{memory_diff}</pre>\n\n"
+                    f"<b>Данные пользователей</b>\n{html.escape(state_lines)}",
+                    parse_mode=ParseMode.HTML
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при профилировании: {e}", exc_info=True)
+            await message.answer(f"❌ Ошибка при профилировании: {e}")
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
 # Добавляем обработчики для кнопок основного меню
 @dp.message(lambda message: message.text == "🤖 Новый диалог")
 async def new_dialog(message: types.Message):
     user_id = message.from_user.id
-    user_message_history[user_id] = []
+    user_message_history[user_id] = make_user_history(user_settings.get(user_id, DEFAULT_SETTINGS).get("history_length", 10))
+    reset_history_summary(user_id)
     
     if user_id in user_last_messages:
-        for msg_id in user_last_messages[user_id]:
-            try:
-                await bot.delete_message(chat_id=message.chat.id, message_id=msg_id)
-            except Exception as e:
-                logger.error(f"Не удалось удалить сообщение {msg_id}: {e}")
-        
+        await delete_bot_messages(message.chat.id, user_last_messages[user_id])
         user_last_messages[user_id] = []
     
-    save_user_history(user_message_history)
+    snapshot_writer.mark_dirty("history")
 
     await start(message)
 
@@ -1360,11 +3387,13 @@ async def help_button(message: types.Message):
     await help_command(message)
 
 @dp.message(lambda message: message.voice is not None, flags={"priority": 10})
+@instrument_handler("voice")
 async def handle_voice_message(message: types.Message):
     logger.info(f"Получено голосовое сообщение от пользователя {message.from_user.id}")
     
     global use_local_recognition, vosk_model
     
+    VOICE_QUEUE_DEPTH.inc()
     try:
         processing_msg = await message.answer("🎤 Распознаю голосовое сообщение...")
         
@@ -1383,8 +3412,9 @@ async def handle_voice_message(message: types.Message):
             return
         
         logger.info("Скачиваю голосовой файл...")
-        voice_file = await bot.get_file(file_id)
-        voice_data = await bot.download_file(voice_file.file_path)
+        with trace_span("voice.download", duration=voice.duration):
+            voice_file = await bot.get_file(file_id)
+            voice_data = await bot.download_file(voice_file.file_path)
         
         with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as temp_voice:
             temp_voice.write(voice_data.read())
@@ -1418,13 +3448,16 @@ async def handle_voice_message(message: types.Message):
         logger.info(f"Выполняемая команда: {' '.join(command)}")
         
         try:
-            process = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                timeout=FFMPEG_CONVERSION_TIMEOUT,
-                creationflags=subprocess.CREATE_NO_WINDOW
-            )
+            with FFMPEG_SECONDS.time(), trace_span("voice.ffmpeg"):
+                # ffmpeg запускается в отдельном потоке, чтобы не блокировать цикл событий
+                process = await asyncio.to_thread(
+                    subprocess.run,
+                    command,
+                    capture_output=True,
+                    text=True,
+                    timeout=FFMPEG_CONVERSION_TIMEOUT,
+                    creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)  # Флаг есть только в Windows
+                )
             
             if process.returncode != 0:
                 logger.error(f"FFmpeg вернул ошибку: {process.stderr}")
@@ -1460,19 +3493,21 @@ async def handle_voice_message(message: types.Message):
             
             if use_local_recognition:
                 logger.info("Начинаю локальное распознавание через Vosk...")
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    future = None
-                    try:
-                        future = executor.submit(recognize_with_vosk, temp_wav_path)
-                        text = future.result(timeout=VOICE_RECOGNITION_TIMEOUT)
-                    except concurrent.futures.TimeoutError:
-                        logger.error(f"Превышено время ожидания при распознавании через Vosk ({VOICE_RECOGNITION_TIMEOUT} сек)")
-                        if future:
-                            recognition_stop_flag.set()
-                            future.cancel()
-                            await asyncio.sleep(1)
-                        await processing_msg.edit_text(f"⚠️ Превышено время ожидания при распознавании ({VOICE_RECOGNITION_TIMEOUT} секунд). Пожалуйста, используйте более короткое сообщение.")
-                        return
+                stop_event = threading.Event()
+                try:
+                    # Распознавание идет в потоке, цикл событий в это время обслуживает других пользователей
+                    with SPEECH_RECOGNITION_SECONDS.labels("vosk").time(), trace_span("voice.recognize", engine="vosk"):
+                        text = await asyncio.wait_for(
+                            asyncio.get_running_loop().run_in_executor(vosk_executor, recognize_with_vosk, temp_wav_path, stop_event),
+                            timeout=VOICE_RECOGNITION_TIMEOUT
+                        )
+                except asyncio.TimeoutError:
+                    logger.error(f"Превышено время ожидания при распознавании через Vosk ({VOICE_RECOGNITION_TIMEOUT} сек)")
+                    # Поток распознавания нельзя отменить, поэтому просим остановиться только это распознавание
+                    stop_event.set()
+                    await asyncio.sleep(1)
+                    await processing_msg.edit_text(f"⚠️ Превышено время ожидания при распознавании ({VOICE_RECOGNITION_TIMEOUT} секунд). Пожалуйста, используйте более короткое сообщение.")
+                    return
                 
                 if text:
                     logger.info(f"Распознан текст: '{text}'")
@@ -1493,7 +3528,8 @@ async def handle_voice_message(message: types.Message):
                     recognizer = sr.Recognizer()
                     with sr.AudioFile(temp_wav_path) as source:
                         audio_data = recognizer.record(source)
-                        text = recognizer.recognize_google(audio_data, language='ru-RU')
+                        with SPEECH_RECOGNITION_SECONDS.labels("google").time(), trace_span("voice.recognize", engine="google"):
+                            text = await asyncio.to_thread(recognizer.recognize_google, audio_data, language='ru-RU')
                     
                     if not text or not text.strip():
                         logger.error("Google API вернул пустой текст")
@@ -1561,8 +3597,117 @@ async def handle_voice_message(message: types.Message):
             await message.answer(f"❌ Произошла ошибка при обработке голосового сообщения: {e}")
         except Exception as msg_err:
             logger.error(f"Невозможно отправить сообщение об ошибке: {msg_err}")
+    finally:
+        VOICE_QUEUE_DEPTH.dec()
+
+# Функция для сброса краткого содержания диалога при очистке истории
+def reset_history_summary(user_id):
+    task = summary_tasks.pop(user_id, None)
+    if task:
+        task.cancel()
+    if user_history_summaries.pop(user_id, None) is not None:
+        snapshot_writer.mark_dirty("summaries")
+
+# Функция для запуска фонового сжатия истории, если она стала слишком длинной
+def schedule_history_summary(user_id, model):
+    history = user_message_history.get(user_id)
+    # Историю, в которую не помещается SUMMARY_TRIGGER_MESSAGES сообщений, пользователь ограничил сам
+    if not history or history.maxlen <= SUMMARY_TRIGGER_MESSAGES or len(history) < SUMMARY_TRIGGER_MESSAGES or user_id in summary_tasks:
+        return
+    
+    task = asyncio.create_task(summarize_history(user_id, model))
+    summary_tasks[user_id] = task
+    
+    def forget_task(finished_task):
+        if summary_tasks.get(user_id) is finished_task:
+            del summary_tasks[user_id]
+    task.add_done_callback(forget_task)
+
+# Функция для сжатия старой части истории в краткое содержание
+async def summarize_history(user_id, model):
+    """
+    Сворачивает старые сообщения истории пользователя в краткое содержание.
+    
+    Новое краткое содержание строится из предыдущего и сворачиваемых сообщений, поэтому
+    размер запроса к модели остается постоянным. Последние SUMMARY_KEEP_RECENT сообщений
+    остаются в истории без изменений.
+    
+    Args:
+        user_id: ID пользователя
+        model: Модель пользователя, используется если модель для сжатия недоступна
+    """
+    history = user_message_history.get(user_id)
+    if not history:
+        return
+    
+    fold_count = len(history) - SUMMARY_KEEP_RECENT
+    # Оставшаяся часть истории должна начинаться с вопроса пользователя
+    while fold_count < len(history) and history[fold_count].role != ROLE_USER:
+        fold_count += 1
+    folded = list(islice(history, fold_count))
+    if not folded:
+        return
+    
+    summary_model = SUMMARY_MODEL if SUMMARY_MODEL not in MODEL_STATUSES["unavailable"] else model
+    
+    dialog_text = "\n\n".join(
+        f"{'Пользователь' if entry.role == ROLE_USER else 'Ассистент'}: {entry.content}"
+        for entry in folded
+    )
+    dialog_text = truncate_to_tokens(
+        dialog_text,
+        get_prompt_token_budget(summary_model, SUMMARY_MAX_TOKENS) - 2 * SUMMARY_MAX_TOKENS
+    )
+    
+    previous_summary = user_history_summaries.get(user_id)
+    request_text = ""
+    if previous_summary:
+        request_text += f"Краткое содержание более ранней части диалога:\n{previous_summary}\n\n"
+    request_text += (
+        f"Продолжение диалога:\n{dialog_text}\n\n"
+        "Составь единое краткое содержание всего диалога выше."
+    )
+    
+    summary_messages = [
+        {"role": "system", "content": (
+            "Ты сжимаешь историю диалога пользователя с ассистентом. Пиши на русском языке, сжато, "
+            "в виде списка фактов: о чем спрашивал пользователь, что ему ответили, какие договоренности, "
+            "предпочтения и важные детали (имена, числа, код) нужно помнить дальше. Не добавляй ничего от себя."
+        )},
+        {"role": "user", "content": request_text}
+    ]
+    
+    try:
+        summary = await generate_response(
+            messages=summary_messages,
+            model=summary_model,
+            max_tokens=SUMMARY_MAX_TOKENS,
+            temperature=0.3,
+            user_id=user_id
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось сжать историю пользователя {user_id} моделью {summary_model}: {e}")
+        return
+    
+    if not summary or not summary.strip():
+        logger.warning(f"Модель {summary_model} вернула пустое краткое содержание для пользователя {user_id}")
+        return
+    
+    # Пока шло сжатие, история могла сократиться или пополниться: удаляем только свернутые сообщения
+    current_history = user_message_history.get(user_id)
+    folded_ids = {id(entry) for entry in folded}
+    removed = 0
+    while current_history and id(current_history[0]) in folded_ids:
+        current_history.popleft()
+        removed += 1
+    
+    user_history_summaries[user_id] = summary.strip()
+    logger.info(f"История пользователя {user_id}: {removed} сообщений свернуто в краткое содержание (~{estimate_tokens(summary)} токенов)")
+    
+    snapshot_writer.mark_dirty("history", "summaries")
 
 @dp.message(flags={"priority": 1})
+@instrument_handler("text")
 async def handle_message(message: types.Message):
     if message is None:
         logger.error("Получено пустое сообщение (None) в handle_message")
@@ -1584,68 +3729,103 @@ async def handle_message(message: types.Message):
         logger.error("Получено сообщение с пустым ID пользователя (None) в handle_message")
         return
         
-    if user_id not in user_settings:
-        logger.warning(f"Настройки не найдены для пользователя {user_id}, создаем новые")
-        user_settings[user_id] = DEFAULT_SETTINGS.copy()
-        save_user_settings(user_settings)
-    
-    settings = user_settings[user_id]
-    if settings is None:
-        logger.error(f"Настройки пользователя {user_id} оказались None")
-        settings = DEFAULT_SETTINGS.copy()
-        user_settings[user_id] = settings
-        save_user_settings(user_settings)
-    
-    if user_id not in user_message_history:
-        logger.info(f"Создаем новую историю для пользователя {user_id}")
-        user_message_history[user_id] = []
-        save_user_history(user_message_history)
-    
-    user_message_history[user_id].append({"role": "user", "content": message.text})
-    
-    history_length = min(settings.get("history_length", 10), 100)
-    max_messages = history_length * 2
-    if len(user_message_history[user_id]) > max_messages:
-        excess = len(user_message_history[user_id]) - max_messages
-        user_message_history[user_id] = user_message_history[user_id][excess:]
-        logger.info(f"История пользователя {user_id} сокращена до {max_messages} сообщений (макс. {history_length} пар)")
-    
-    save_user_history(user_message_history)
+    with trace_span("settings"):
+        if user_id not in user_settings:
+            logger.warning(f"Настройки не найдены для пользователя {user_id}, создаем новые")
+            user_settings[user_id] = DEFAULT_SETTINGS.copy()
+            snapshot_writer.mark_dirty("settings")
+        
+        settings = user_settings[user_id]
+        if settings is None:
+            logger.error(f"Настройки пользователя {user_id} оказались None")
+            settings = DEFAULT_SETTINGS.copy()
+            user_settings[user_id] = settings
+            snapshot_writer.mark_dirty("settings")
+    
+    with trace_span("history"):
+        history_length = settings.get("history_length", 10)
+        if user_id not in user_message_history:
+            logger.info(f"Создаем новую историю для пользователя {user_id}")
+            user_message_history[user_id] = make_user_history(history_length)
+        elif user_message_history[user_id].maxlen != min(history_length, 100) * 2:
+            # Пользователь изменил длину истории: самые старые сообщения отбрасываются при пересоздании
+            user_message_history[user_id] = make_user_history(history_length, user_message_history[user_id])
+        
+        history = user_message_history[user_id]
+        history.append(HistoryEntry(ROLE_USER, message.text))
+        
+        snapshot_writer.mark_dirty("history")
     
     try:
         dynamic_chat = settings.get('dynamic_chat', False)
         
+        model = settings['model']
+        if model == AUTO_MODEL:
+            model = model_router.choose_primary()
+            logger.info(f"Автовыбор модели для пользователя {user_id}: {model} ({model_router.describe(model)})")
+        
         if dynamic_chat and user_id in user_last_messages:
-            last_messages = user_last_messages[user_id]
-            for msg_id in last_messages:
-                try:
-                    await bot.delete_message(chat_id=message.chat.id, message_id=msg_id)
-                except Exception as e:
-                    logger.error(f"Не удалось удалить сообщение {msg_id}: {e}")
+            with trace_span("delete_old_messages", count=len(user_last_messages[user_id])):
+                await delete_bot_messages(message.chat.id, user_last_messages[user_id])
             user_last_messages[user_id] = []
         
-        system_message = settings['system_message']
-        if "русском языке" not in system_message:
-            system_message = "Ты русскоязычный ассистент. ОБЯЗАТЕЛЬНО отвечай ТОЛЬКО на русском языке, кратко и по делу. " + system_message
+        with trace_span("build_context") as span:
+            system_message = settings['system_message']
+            if "русском языке" not in system_message:
+                system_message = "Ты русскоязычный ассистент. ОБЯЗАТЕЛЬНО отвечай ТОЛЬКО на русском языке, кратко и по делу. " + system_message
+            
+            user_message = message.text
+            if not any(phrase in user_message.lower() for phrase in ["на русском", "по-русски", "русский"]):
+                user_message = f"{user_message}\n\nОтветь на русском языке."
+            
+            summary = user_history_summaries.get(user_id)
+            if summary:
+                system_message += f"\n\nКраткое содержание предыдущей части диалога:\n{summary}"
+            
+            history_window, user_message = fit_history_to_budget(
+                history, system_message, user_message,
+                model, settings['max_tokens']
+            )
+            messages = [{"role": "system", "content": system_message}]
+            messages.extend(entry.to_dict() for entry in history_window)
+            messages.append({"role": "user", "content": user_message})
+            span.set_attribute("history_messages", len(history_window))
         
-        user_message = message.text
-        if not any(phrase in user_message.lower() for phrase in ["на русском", "по-русски", "русский"]):
-            user_message = f"{user_message}\n\nОтветь на русском языке."
+        compact_replies = settings.get('compact_replies', True)
+        if not compact_replies:
+            # В компактном режиме статус "печатает" не нужен: сразу появится сообщение о генерации
+            with trace_span("send_chat_action"):
+                await bot.send_chat_action(message.chat.id, 'typing')
         
-        messages = [{"role": "system", "content": system_message}] + user_message_history[user_id]
-        messages[-1]["content"] = user_message
+        model_name = model.split('/')[-1]  # Модель, которая сейчас генерирует ответ (меняется при переходе к запасной)
         
-        await bot.send_chat_action(message.chat.id, 'typing')
+        def get_generating_text():
+            return f"⏳ <i>Генерирую ответ с помощью модели</i> <code>{model_name}</code>..."
         
-        model_name = settings['model'].split('/')[-1]
-        loading_message = await message.answer(
-            f"⏳ <i>Генерирую ответ с помощью модели</i> <code>{model_name}</code>...", 
-            parse_mode=ParseMode.HTML
-        )
+        with trace_span("loading_message"):
+            loading_message = await message.answer(get_generating_text(), parse_mode=ParseMode.HTML)
         
         start_time = time.time()
         
-        model = settings['model']
+        async def show_queue_position(position):
+            if position:
+                text = f"⏳ <i>Много запросов, вы</i> <b>№{position}</b> <i>в очереди к модели</i> <code>{model_name}</code>..."
+            else:
+                # Запрос вышел из очереди и отправлен модели
+                text = get_generating_text()
+            await loading_message.edit_text(text, parse_mode=ParseMode.HTML)
+        
+        partial_shown = False
+        
+        async def show_partial_response(text):
+            # Пока модель генерирует ответ, показываем готовую часть без форматирования
+            nonlocal partial_shown
+            try:
+                await loading_message.edit_text(html.escape(text[:3500]) + " ▌", parse_mode=ParseMode.HTML)
+                partial_shown = True
+            except Exception as e:
+                logger.debug(f"Не удалось показать часть ответа: {e}")
+        
         bot_response = None
         used_fallback = False
         fallback_model = None
@@ -1670,17 +3850,24 @@ async def handle_message(message: types.Message):
         try:
             current_model = fallback_model if fallback_model else model
             
-            bot_response = await generate_response(
-                messages=messages,
-                model=current_model,
-                max_tokens=settings['max_tokens'],
-                temperature=settings['temperature']
-            )
+            with trace_span("generate", model=current_model, fallback=bool(fallback_model)):
+                bot_response = await generate_response(
+                    messages=messages,
+                    model=current_model,
+                    max_tokens=settings['max_tokens'],
+                    temperature=settings['temperature'],
+                    user_id=user_id,
+                    on_queue_position=show_queue_position,
+                    on_partial=show_partial_response
+                )
                 
             if not bot_response or bot_response.strip() == "":
                 logger.warning(f"Получен пустой ответ от модели {current_model}, пробуем запасную модель")
                 raise Exception(f"Пустой ответ от модели {current_model}")
-                
+        
+        except QueueOverloadedError:
+            # При перегрузке не перебираем запасные модели, чтобы не усиливать нагрузку
+            raise
         except Exception as api_error:
             logger.warning(f"Ошибка при использовании {model if not fallback_model else fallback_model}: {api_error}")
             
@@ -1693,65 +3880,60 @@ async def handle_message(message: types.Message):
                 logger.error("Исчерпаны все доступные запасные модели!")
                 raise Exception(f"Не удалось получить ответ. Последняя ошибка: {api_error}")
             
-            fallback_system_message = (
-                "Ты русскоязычный ассистент общего назначения. ВАЖНО: отвечаешь на вопросы по ЛЮБЫМ темам, "
-                "Не ограничивай себя какой-то конкретной тематикой. "
-                "Ты должен помогать с любыми темами: наукой, искусством, историей, повседневными вопросами - со всем. "
-                "НЕ выдавай шаблонные ответы. Каждый ответ должен быть уникальным и соответствовать запросу пользователя. "
-                "Обязательно отвечай ТОЛЬКО НА РУССКОМ ЯЗЫКЕ, кратко и по сути вопроса. "
-                "Очень внимательно прочитай вопрос пользователя и отвечай ТОЛЬКО на заданный вопрос. "
-                "Не давай общую информацию не по теме запроса. "
-                "При необходимости используй форматирование markdown: **жирный**, *курсив*, # заголовок, ```код```."
-            )
-
-            if user_id in user_message_history and len(user_message_history[user_id]) > 0:
-                for i in range(len(user_message_history[user_id]) - 1, -1, -1):
-                    if user_message_history[user_id][i]["role"] == "assistant":
-                        logger.info(f"Удаляем последний ответ ассистента из истории при переключении на запасную модель")
-                        break
+            # Запасным моделям отправляются последние сообщения истории с инструкцией отвечать по-русски
+            recent_history = list(islice(history, max(0, len(history) - 3), None))
+            if recent_history and recent_history[-1].role == ROLE_USER:
+                fallback_user_message = f"{recent_history[-1].content}\n\n{FALLBACK_USER_INSTRUCTION}"
+            else:
+                recent_history = []
+                fallback_user_message = f"{user_message}\n\n{FALLBACK_USER_INSTRUCTION_SHORT}"
+            
+            # Запрос зависит от модели только через бюджет токенов, поэтому собирается один раз на бюджет
+            fallback_requests = {}
+            
+            def get_fallback_request(fallback_model):
+                budget = get_prompt_token_budget(fallback_model, settings['max_tokens'])
+                request = fallback_requests.get(budget)
+                if request is None:
+                    window, fitted_message = fit_history_to_budget(
+                        recent_history, FALLBACK_SYSTEM_MESSAGE, fallback_user_message,
+                        fallback_model, settings['max_tokens']
+                    )
+                    fallback_messages = [{"role": "system", "content": FALLBACK_SYSTEM_MESSAGE}]
+                    fallback_messages.extend(entry.to_dict() for entry in window)
+                    fallback_messages.append({"role": "user", "content": fitted_message})
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Сообщения для запасных моделей с бюджетом {budget} токенов: {fallback_messages}")
+                    request = fallback_requests[budget] = ModelRequest(fallback_messages)
+                return request
             
             # Пробуем использовать запасные модели из списка
             for current_fallback_model in fallback_models:
+                model_name = current_fallback_model.split('/')[-1]
+                if partial_shown:
+                    # Часть ответа модели, которая не смогла ответить до конца, не должна оставаться на экране
+                    partial_shown = False
+                    try:
+                        await loading_message.edit_text(get_generating_text(), parse_mode=ParseMode.HTML)
+                    except Exception as e:
+                        logger.debug(f"Не удалось обновить сообщение о генерации: {e}")
                 try:
                     logger.info(f"Пробуем запасную модель: {current_fallback_model}")
-                    fallback_messages = [{"role": "system", "content": fallback_system_message}]
-                    
-                    if user_id in user_message_history and len(user_message_history[user_id]) > 0:
-                        history_to_add = user_message_history[user_id][-3:]
-                        if len(history_to_add) > 1:
-                            fallback_messages.extend(history_to_add[:-1])
-                        
-                        last_message = history_to_add[-1]
-                        if last_message["role"] == "user":
-                            last_content = last_message["content"]
-                            enhanced_content = (
-                                f"{last_content}\n\n"
-                                "ВАЖНО: Отвечай ТОЛЬКО на русском языке. "
-                                "Отвечай СТРОГО по теме вопроса, не давай общую информацию не по теме. "
-                                "ОТВЕЧАЙ НА ВОПРОСЫ ПО ЛЮБЫМ ТЕМАМ. "
-                                "Ты универсальный помощник, который может обсуждать любые темы."
-                            )
-                            fallback_messages.append({"role": "user", "content": enhanced_content})
-                    
-                    if not fallback_messages or len(fallback_messages) == 1:
-                        fallback_messages.append({
-                            "role": "user", 
-                            "content": user_message + "\n\nВАЖНО: Отвечай ТОЛЬКО на русском языке и строго по теме вопроса. "
-                            "Отвечай на вопросы по ЛЮБЫМ темам."
-                        })
-                    
-                    logger.debug(f"Сообщения для запасной модели {current_fallback_model}: {fallback_messages}")
-                    
-                    bot_response = await generate_response(
-                        messages=fallback_messages,
-                        model=current_fallback_model,
-                        max_tokens=settings['max_tokens'],
-                        temperature=settings['temperature']
-                    )
+                    with trace_span("fallback_attempt", model=current_fallback_model, failed_model=model):
+                        bot_response = await generate_response(
+                            messages=get_fallback_request(current_fallback_model),
+                            model=current_fallback_model,
+                            max_tokens=settings['max_tokens'],
+                            temperature=settings['temperature'],
+                            user_id=user_id,
+                            on_queue_position=show_queue_position,
+                            on_partial=show_partial_response
+                        )
                     
                     if bot_response and bot_response.strip() != "":
                         fallback_model = current_fallback_model
                         used_fallback = True
+                        FALLBACKS.labels(model, current_fallback_model).inc()
                         update_model_status(current_fallback_model, "fully_working")
                         
                         if current_model_status != "unavailable":
@@ -1762,6 +3944,8 @@ async def handle_message(message: types.Message):
                         logger.warning(f"Получен пустой ответ от запасной модели {current_fallback_model}")
                         update_model_status(current_fallback_model, "partially_working", "Пустой ответ")
                         
+                except QueueOverloadedError:
+                    raise
                 except Exception as fallback_error:
                     error_msg = str(fallback_error) if fallback_error is not None else "Неизвестная ошибка"
                     logger.error(f"Запасная модель {current_fallback_model} тоже недоступна: {error_msg}")
@@ -1773,56 +3957,15 @@ async def handle_message(message: types.Message):
         
         # Считаем время генерации
         generation_time = time.time() - start_time
-        await loading_message.delete()
         
         if bot_response is None:
             logger.error("Получен пустой ответ (None) от модели после всех попыток")
             raise Exception("Все модели вернули пустой ответ")
             
-        formatted_response = prepare_response_for_telegram(bot_response)
+        with FORMATTING_SECONDS.time(), trace_span("format", length=len(bot_response)):
+            formatted_response = prepare_response_for_telegram(bot_response)
         new_messages = []
         
-        # Проверяем длину ответа и обрезаем при необходимости
-        if len(formatted_response) > 4096:
-            formatted_response_truncated = formatted_response[:4090] + "..."
-            continue_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔄 Продолжить ответ", callback_data='continue_response')]
-            ])
-            
-            if not hasattr(globals(), 'full_responses'):
-                globals()['full_responses'] = {}
-            globals()['full_responses'][user_id] = formatted_response
-            
-            try:
-                response_msg = await message.answer(formatted_response_truncated, reply_markup=continue_keyboard, parse_mode=ParseMode.HTML)
-                new_messages.append(response_msg.message_id)
-            except Exception as e:
-                logger.error(f"Ошибка при отправке HTML-ответа: {e}")
-                # Если ошибка связана с HTML, отправляем текст без форматирования
-                if "can't parse entities" in str(e):
-                    response_msg = await message.answer(
-                        "❗ <b>Не удалось отформатировать ответ.</b> Ниже ответ без форматирования:\n\n" + bot_response,
-                        reply_markup=continue_keyboard,
-                        parse_mode=None
-                    )
-                    new_messages.append(response_msg.message_id)
-                else:
-                    raise
-        else:
-            try:
-                response_msg = await message.answer(formatted_response, parse_mode=ParseMode.HTML)
-                new_messages.append(response_msg.message_id)
-            except Exception as e:
-                logger.error(f"Ошибка при отправке HTML-ответа: {e}")
-                if "can't parse entities" in str(e):
-                    response_msg = await message.answer(
-                        "❗ <b>Не удалось отформатировать ответ.</b> Ниже ответ без форматирования:\n\n" + bot_response,
-                        parse_mode=None
-                    )
-                    new_messages.append(response_msg.message_id)
-                else:
-                    raise
-        
         info_model = fallback_model if fallback_model else model
         if fallback_model:
             info_text = (
@@ -1837,36 +3980,122 @@ async def handle_message(message: types.Message):
                 f"Модель: {info_model.split('/')[-1]} | "
                 f"Темп.: {settings['temperature']} | Макс.токенов: {settings['max_tokens']}</i>"
             )
-        info_msg = await message.answer(info_text, parse_mode=ParseMode.HTML)
-        new_messages.append(info_msg.message_id)
         
         # Если использовалась запасная модель, предложим пользователю переключиться на нее постоянно
-        if used_fallback and fallback_model:
+        switch_keyboard = None
+        if used_fallback and fallback_model and settings['model'] != AUTO_MODEL:
             switch_keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text=f"🔄 Переключиться на {fallback_model.split('/')[-1]}", 
                                      callback_data=f'set_model_{fallback_model}')]
             ])
-            switch_msg = await message.answer(
-                f"⚠️ <b>Внимание:</b> Модель {model} недоступна или вернула пустой ответ. "
-                f"Был автоматически использован запасной вариант. Хотите переключиться на эту модель постоянно?",
-                reply_markup=switch_keyboard,
-                parse_mode=ParseMode.HTML
-            )
-            new_messages.append(switch_msg.message_id)
+        
+        footer = "\n\n" + info_text
+        if compact_replies and len(formatted_response) + len(footer) <= 4096:
+            # Превращаем сообщение о генерации в ответ одним запросом, информация о генерации идет внизу
+            reply_message = loading_message
+            try:
+                await loading_message.edit_text(formatted_response + footer, reply_markup=switch_keyboard, parse_mode=ParseMode.HTML)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке HTML-ответа: {e}")
+                if "can't parse entities" in str(e):
+                    plain_text = ("❗ Не удалось отформатировать ответ. Ниже ответ без форматирования:\n\n" + bot_response)[:4096]
+                    try:
+                        await loading_message.edit_text(plain_text, reply_markup=switch_keyboard, parse_mode=None)
+                    except Exception as edit_error:
+                        logger.warning(f"Не удалось изменить сообщение о генерации, отправляем ответ отдельно: {edit_error}")
+                        reply_message = await message.answer(plain_text, reply_markup=switch_keyboard, parse_mode=None)
+                else:
+                    # Сообщение о генерации удалено или его нельзя изменить: ответ уже готов, отправляем его отдельно
+                    reply_message = await message.answer(formatted_response + footer, reply_markup=switch_keyboard, parse_mode=ParseMode.HTML)
+            new_messages.append(reply_message.message_id)
+        else:
+            await loading_message.delete()
+            
+            # Проверяем длину ответа и обрезаем при необходимости
+            if len(formatted_response) > 4096:
+                formatted_response_truncated = formatted_response[:4090] + "..."
+                continue_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🔄 Продолжить ответ", callback_data='continue_response')]
+                ])
+                
+                full_responses[user_id] = formatted_response
+                
+                try:
+                    response_msg = await message.answer(formatted_response_truncated, reply_markup=continue_keyboard, parse_mode=ParseMode.HTML)
+                    new_messages.append(response_msg.message_id)
+                except Exception as e:
+                    logger.error(f"Ошибка при отправке HTML-ответа: {e}")
+                    # Если ошибка связана с HTML, отправляем текст без форматирования
+                    if "can't parse entities" in str(e):
+                        response_msg = await message.answer(
+                            "❗ <b>Не удалось отформатировать ответ.</b> Ниже ответ без форматирования:\n\n" + bot_response,
+                            reply_markup=continue_keyboard,
+                            parse_mode=None
+                        )
+                        new_messages.append(response_msg.message_id)
+                    else:
+                        raise
+            else:
+                try:
+                    response_msg = await message.answer(formatted_response, parse_mode=ParseMode.HTML)
+                    new_messages.append(response_msg.message_id)
+                except Exception as e:
+                    logger.error(f"Ошибка при отправке HTML-ответа: {e}")
+                    if "can't parse entities" in str(e):
+                        response_msg = await message.answer(
+                            "❗ <b>Не удалось отформатировать ответ.</b> Ниже ответ без форматирования:\n\n" + bot_response,
+                            parse_mode=None
+                        )
+                        new_messages.append(response_msg.message_id)
+                    else:
+                        raise
+            
+            if compact_replies:
+                # Длинный ответ не оставляет места для информации внизу, поэтому ее кнопка идет отдельно
+                info_msg = await message.answer(info_text, reply_markup=switch_keyboard, parse_mode=ParseMode.HTML)
+                new_messages.append(info_msg.message_id)
+            else:
+                info_msg = await message.answer(info_text, parse_mode=ParseMode.HTML)
+                new_messages.append(info_msg.message_id)
+                
+                if switch_keyboard:
+                    switch_msg = await message.answer(
+                        f"⚠️ <b>Внимание:</b> Модель {model} недоступна или вернула пустой ответ. "
+                        f"Был автоматически использован запасной вариант. Хотите переключиться на эту модель постоянно?",
+                        reply_markup=switch_keyboard,
+                        parse_mode=ParseMode.HTML
+                    )
+                    new_messages.append(switch_msg.message_id)
         
         user_last_messages[user_id] = new_messages
         
-        user_message_history[user_id].append({"role": "assistant", "content": bot_response})
+        # История ограничена deque: при переполнении самые старые сообщения отбрасываются сами
+        history.append(HistoryEntry(ROLE_ASSISTANT, bot_response))
+        
+        snapshot_writer.mark_dirty("history")
+        
+        schedule_history_summary(user_id, model)
+    
+    except QueueOverloadedError as e:
+        logger.warning(f"Запрос пользователя {user_id} не обработан из-за перегрузки: {e}")
+        
+        retry_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔄 Попробовать снова", callback_data='retry_last_message')]
+        ])
         
-        # Каждая пара - это 2 сообщения, поэтому умножаем на 2
-        history_length = min(settings.get("history_length", 10), 100)  # Максимум 100 пар
-        max_messages = history_length * 2
-        if len(user_message_history[user_id]) > max_messages:
-            excess = len(user_message_history[user_id]) - max_messages
-            user_message_history[user_id] = user_message_history[user_id][excess:]
-            logger.info(f"История пользователя {user_id} сокращена до {max_messages} сообщений (макс. {history_length} пар)")
+        overload_text = (
+            "🚦 <b>Сейчас очень много запросов</b>\n\n"
+            "Бот временно перегружен и не успел обработать ваше сообщение. "
+            "Пожалуйста, повторите запрос через минуту."
+        )
+        try:
+            error_msg = await loading_message.edit_text(overload_text, reply_markup=retry_keyboard, parse_mode=ParseMode.HTML)
+        except Exception:
+            error_msg = await message.answer(overload_text, reply_markup=retry_keyboard, parse_mode=ParseMode.HTML)
         
-        save_user_history(user_message_history)
+        if user_id not in user_last_messages:
+            user_last_messages[user_id] = []
+        user_last_messages[user_id].append(error_msg.message_id)
     
     except Exception as e:
         logger.error(f"Ошибка при запросе к API: {e}")
@@ -1906,14 +4135,14 @@ async def continue_response(callback_query: types.CallbackQuery):
         logger.error("Получен пустой ID пользователя (None) в continue_response")
         return
     
-    if not hasattr(globals(), 'full_responses') or user_id not in globals()['full_responses']:
+    if user_id not in full_responses:
         await callback_query.message.edit_text(
             "❌ К сожалению, продолжение ответа недоступно. Попробуйте задать вопрос заново.",
             reply_markup=None
         )
         return
     
-    full_response = globals()['full_responses'][user_id]
+    full_response = full_responses[user_id]
     if full_response is None:
         logger.error("Получен пустой полный ответ (None) в continue_response")
         await callback_query.message.edit_text(
@@ -1978,9 +4207,10 @@ async def retry_last_message(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     
     if user_id in user_message_history and user_message_history[user_id]:
-        user_messages = [msg for msg in user_message_history[user_id] if msg["role"] == "user"]
+        history = user_message_history[user_id]
+        user_messages = [entry for entry in history if entry.role == ROLE_USER]
         if user_messages:
-            last_user_message = user_messages[-1]["content"]
+            last_user_message = user_messages[-1].content
             
             new_message = types.Message(
                 message_id=callback_query.message.message_id,
@@ -1992,11 +4222,11 @@ async def retry_last_message(callback_query: types.CallbackQuery):
                 via_bot=None
             )
             
-            if user_message_history[user_id][-1]["role"] == "user":
-                user_message_history[user_id].pop()
-            elif len(user_message_history[user_id]) >= 2 and user_message_history[user_id][-2]["role"] == "user":
-                user_message_history[user_id].pop(-2)
-                user_message_history[user_id].pop(-1)
+            if history[-1].role == ROLE_USER:
+                history.pop()
+            elif len(history) >= 2 and history[-2].role == ROLE_USER:
+                history.pop()
+                history.pop()
             
             await callback_query.message.answer(f"🔄 <i>Повторяю запрос:</i>\n{last_user_message}", parse_mode=ParseMode.HTML)
             
@@ -2100,6 +4330,150 @@ MODEL_STATUSES = {
     "unavailable": []  # Недоступна
 }
 
+class ModelStatusBackend:
+    """
+    Передает изменения статусов моделей другим процессам бота.
+    
+    Каждый процесс читает MODEL_STATUSES локально, а backend рассылает изменения, чтобы
+    ошибка модели, замеченная одним процессом, сразу учитывалась при выборе модели во всех.
+    Эта реализация используется при работе в одном процессе и ничего не рассылает.
+    """
+    
+    async def start(self):
+        pass
+    
+    def publish(self, model, status):
+        pass
+    
+    async def close(self):
+        pass
+
+class WorkerModelStatusBackend(ModelStatusBackend):
+    """Отправляет изменения статусов основному процессу, который пересылает их остальным рабочим процессам"""
+    
+    def __init__(self, status_queue, worker_index):
+        self.status_queue = status_queue
+        self.worker_index = worker_index
+    
+    def publish(self, model, status):
+        self.status_queue.put_nowait(("model_status", self.worker_index, model, status))
+
+class RedisModelStatusBackend(ModelStatusBackend):
+    """
+    Общее состояние моделей в Redis (или совместимом хранилище) для нескольких экземпляров бота.
+    
+    Текущие статусы хранятся в хэше {prefix}:model_status, а изменения рассылаются через канал
+    с тем же именем. Каждый экземпляр подписан на канал и сразу применяет чужие изменения к своему
+    MODEL_STATUSES. После потери соединения экземпляр переподключается и перечитывает хэш.
+    """
+    
+    def __init__(self, client, prefix=REDIS_KEY_PREFIX, apply=None):
+        """
+        Args:
+            client: Асинхронный клиент Redis (redis.asyncio.Redis или fakeredis.FakeAsyncRedis)
+            prefix: Префикс ключей
+            apply: Функция применения статуса (model, status), по умолчанию set_model_status
+        """
+        self.client = client
+        self.key = f"{prefix}:model_status"
+        self.apply = apply or set_model_status
+        self.instance_id = f"{os.getpid()}-{id(self)}"
+        self.listener = None
+        self.pending = set()
+    
+    async def start(self):
+        """
+        Сохраняет в Redis статусы, полученные при проверке моделей, и подписывается на изменения.
+        
+        Записываются только статусы моделей, которых еще нет в хэше: статусы, известные другим
+        экземплярам по реальным запросам, точнее разовой проверки при запуске и не перезаписываются.
+        """
+        statuses = {model: status for status, models in MODEL_STATUSES.items() for model in models}
+        try:
+            if statuses:
+                async with self.client.pipeline(transaction=False) as pipe:
+                    for model, status in statuses.items():
+                        pipe.hsetnx(self.key, model, status)
+                    await pipe.execute()
+        except Exception as e:
+            logger.error(f"Не удалось записать статусы моделей в Redis: {e}")
+        self.listener = asyncio.create_task(self._listen())
+    
+    async def _load(self):
+        shared = await self.client.hgetall(self.key)
+        for model, status in shared.items():
+            if status in MODEL_STATUSES:
+                self.apply(model, status)
+        return len(shared)
+    
+    async def _listen(self):
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(self.key)
+                # Изменения, сделанные пока не было подписки, берем из хэша
+                loaded = await self._load()
+                logger.info(f"Подписка на общие статусы моделей в Redis активна ({loaded} моделей)")
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    change = json_loads(message["data"])
+                    if change["instance"] != self.instance_id and change["status"] in MODEL_STATUSES:
+                        self.apply(change["model"], change["status"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка подписки на статусы моделей в Redis: {e}, переподключение через 5 сек")
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+    
+    def publish(self, model, status):
+        try:
+            task = asyncio.get_running_loop().create_task(self._publish(model, status))
+        except RuntimeError:
+            return
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+    
+    async def _publish(self, model, status):
+        change = json_dumps({"instance": self.instance_id, "model": model, "status": status})
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.hset(self.key, model, status)
+                pipe.publish(self.key, change)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Не удалось передать статус модели {model} в Redis: {e}")
+    
+    async def close(self):
+        if self.pending:
+            await asyncio.wait(set(self.pending), timeout=5)
+        if self.listener:
+            self.listener.cancel()
+        await self.client.aclose()
+
+def create_model_status_backend(default):
+    """Возвращает Redis backend, если задан REDIS_URL, иначе переданный backend по умолчанию"""
+    if not REDIS_URL:
+        return default
+    if aioredis is None:
+        logger.warning("REDIS_URL задан, но пакет redis не установлен: статусы моделей не будут общими")
+        return default
+    return RedisModelStatusBackend(aioredis.from_url(REDIS_URL, decode_responses=True))
+
+model_status_backend = create_model_status_backend(ModelStatusBackend())
+
+def set_model_status(model, status):
+    """Переносит модель в список MODEL_STATUSES с указанным статусом в текущем процессе"""
+    for models in MODEL_STATUSES.values():
+        if model in models:
+            models.remove(model)
+    MODEL_STATUSES[status].append(model)
+
 # Функция для проверки и переключения моделей при проблемах с API
 async def check_api_models(check_timeout, min_check_time):
     """
@@ -2109,7 +4483,8 @@ async def check_api_models(check_timeout, min_check_time):
     - unavailable: недоступна полностью (не существует, отключена и т.д.)
     
     Args:
-        check_timeout: Время ожидания ответа от модели в секундах при проверке
+        check_timeout: Наибольшее время ожидания ответа от модели в секундах при проверке.
+            Таймауты каждой модели считаются по ее задержкам (model_router.timeout_budget)
         min_check_time: Минимальное время (в секундах), которое будет затрачено на проверку каждой модели
     """
     global user_settings, MODEL_STATUSES
@@ -2149,7 +4524,7 @@ async def check_api_models(check_timeout, min_check_time):
                     model=model,
                     max_tokens=20,  # Небольшое количество токенов для быстрого ответа
                     temperature=0.3,  # Низкая температура для стабильности
-                    timeout=check_timeout  # Используем настраиваемый таймаут
+                    timeout=model_router.timeout_budget(model, 20, max_total=check_timeout)
                 )
             )
             
@@ -2173,7 +4548,12 @@ async def check_api_models(check_timeout, min_check_time):
             error_str = error_message.lower()
             
             # Классифицируем ошибки по типу API
-            if model.startswith('huggingface/'):
+            provider = get_model_provider(model)
+            if isinstance(e, ProviderTimeoutError):
+                # Модель не уложилась в таймаут проверки: скорее всего, она медленная или перегружена
+                result_status = "partially_working"
+            
+            elif provider == 'huggingface':
                 # Особая обработка для Hugging Face API
                 
                 # Временные ошибки Hugging Face
@@ -2191,7 +4571,7 @@ async def check_api_models(check_timeout, min_check_time):
                     result_status = "unavailable"
                     error_message = "модель не найдена (404)"
             
-            elif model.startswith('together/'):
+            elif provider == 'together':
                 # Особая обработка для Together AI API
                 
                 # Временные ошибки API
@@ -2251,15 +4631,35 @@ async def check_api_models(check_timeout, min_check_time):
     for model in MODEL_STATUSES['unavailable']:
         logger.info(f"  - {model}: {response_times.get(model, 'н/д'):.2f} сек")
 
-async def main():
-    # Загружаем настройки пользователей при запуске
-    global user_settings, user_message_history
+# Функция для загрузки сохраненных данных пользователей текущего процесса
+def load_saved_state():
+    global user_settings, user_message_history, user_history_summaries
     
     logger.info("Загружаем сохраненные настройки пользователей...")
     user_settings = load_user_settings()
     logger.info(f"Загружены настройки для {len(user_settings)} пользователей")
     
-    # Инициализируем Vosk модель для локального распознавания
+    logger.info("Загружаем историю сообщений пользователей...")
+    user_message_history = load_user_history(user_settings)
+    logger.info(f"Загружена история для {len(user_message_history)} пользователей")
+    
+    user_history_summaries = load_history_summaries()
+    logger.info(f"Загружены краткие содержания диалогов для {len(user_history_summaries)} пользователей")
+    
+    # Выгруженное на диск состояние новее общих файлов: бот мог остановиться до их перезаписи
+    cold_users.update(user_id for user_id in list_cold_users() if is_own_user(user_id))
+    for user_id in cold_users:
+        for state_dict in (user_settings, user_message_history, user_history_summaries):
+            state_dict.pop(user_id, None)
+    logger.info(f"Пользователей, выгруженных на диск: {len(cold_users)}")
+    
+    # Все загруженные пользователи считаются активными с момента запуска
+    now = time.monotonic()
+    for user_id in set(user_settings) | set(user_message_history) | set(user_history_summaries):
+        user_last_activity[user_id] = now
+
+# Функция для инициализации локального распознавания речи
+def init_voice_recognition():
     logger.info("Попытка инициализации Vosk модели для локального распознавания...")
     if init_vosk_model():
         logger.info("✅ Локальное распознавание голосовых сообщений активировано (безлимитное)")
@@ -2273,13 +4673,8 @@ async def main():
                 logger.warning("⚠️ Локальное распознавание не доступно даже при повторной попытке, будет использоваться Google API (с ограничениями)")
         else:
             logger.warning("⚠️ Локальное распознавание не доступно, будет использоваться Google API (с ограничениями)")
-    
-    await check_api_models(check_timeout=API_CHECK_TIMEOUT, min_check_time=API_MIN_CHECK_TIME)
-    
-    logger.info("Загружаем историю сообщений пользователей...")
-    user_message_history = load_user_history()
-    logger.info(f"Загружена история для {len(user_message_history)} пользователей")
-    
+
+async def set_bot_commands():
     await bot.set_my_commands([
         types.BotCommand(command="start", description="Начать диалог заново"),
         types.BotCommand(command="help", description="Показать справку"),
@@ -2288,6 +4683,34 @@ async def main():
         types.BotCommand(command="info", description="Показать текущие настройки"),
         types.BotCommand(command="menu", description="Показать меню с кнопками")
     ])
+
+async def main():
+    # Распределяем файлы с данными пользователей под текущее количество процессов
+    reshard_state_files(BOT_WORKERS)
+    
+    await discover_local_models()
+    await check_api_models(check_timeout=API_CHECK_TIMEOUT, min_check_time=API_MIN_CHECK_TIME)
+    await set_bot_commands()
+    
+    metrics_runner = await start_metrics_server(METRICS_PORT)
+    loop_lag_monitor.start()
+    
+    if BOT_WORKERS > 1:
+        try:
+            await run_workers()
+        finally:
+            await close_provider_sessions()
+            if metrics_runner:
+                await metrics_runner.cleanup()
+        return
+    
+    await model_status_backend.start()
+    
+    # Загружаем настройки и историю пользователей при запуске
+    load_saved_state()
+    
+    # Инициализируем Vosk модель для локального распознавания
+    init_voice_recognition()
     
     logger.info("Проверка регистрации обработчиков сообщений...")
     
@@ -2306,10 +4729,356 @@ async def main():
         logger.warning("⚠️ Обработчик голосовых сообщений НЕ обнаружен!")
     
     asyncio.create_task(periodic_save())
+    asyncio.create_task(periodic_eviction())
     
     logger.info("Запуск бота...")
     
-    await dp.start_polling(bot)
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await delete_webhook_for_polling()
+            await dp.start_polling(bot)
+    finally:
+        await snapshot_writer.flush()
+        await model_status_backend.close()
+        await close_provider_sessions()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+async def delete_webhook_for_polling():
+    """Удаляет webhook, оставшийся от запуска в режиме webhook: пока он задан, getUpdates завершается ошибкой конфликта"""
+    try:
+        await bot.delete_webhook(drop_pending_updates=False)
+    except Exception as e:
+        logger.warning(f"Не удалось удалить webhook перед запуском long polling: {e}")
+
+# Обновления, которые обрабатываются в фоне (после ответа на webhook-запрос или в рабочем процессе)
+update_tasks = set()
+
+async def process_update(update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+
+def start_update_task(update):
+    task = asyncio.create_task(process_update(update))
+    update_tasks.add(task)
+    task.add_done_callback(update_tasks.discard)
+
+async def wait_update_tasks():
+    """Ждет завершения обрабатываемых обновлений, но не дольше WEBHOOK_SHUTDOWN_TIMEOUT секунд"""
+    if update_tasks:
+        logger.info(f"Ожидаем завершения обработки {len(update_tasks)} обновлений...")
+        done, pending = await asyncio.wait(set(update_tasks), timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+
+async def wait_for_shutdown_signal():
+    """Ждет SIGINT или SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows не поддерживает обработчики сигналов в цикле событий
+            pass
+    await stop_event.wait()
+
+async def handle_webhook(request):
+    """
+    Принимает обновление от Telegram. Отвечает сразу, а само обновление обрабатывается в фоне,
+    чтобы долгая генерация ответа не задерживала доставку следующих обновлений.
+    """
+    if WEBHOOK_SECRET:
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # Строки с не-ASCII символами compare_digest не сравнивает, поэтому сравниваем байты
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            logger.warning(f"Отклонен webhook-запрос с неверным секретом от {request.remote}")
+            return web.Response(status=401)
+    
+    try:
+        update = types.Update.model_validate(json_loads(await request.read()), context={"bot": bot})
+    except Exception as e:
+        logger.warning(f"Не удалось разобрать webhook-запрос: {e}")
+        return web.Response(status=400)
+    
+    if worker_update_queues:
+        route_update_to_worker(update)
+    else:
+        start_update_task(update)
+    return web.Response()
+
+async def handle_health(request):
+    return web.Response(text="ok")
+
+def create_webhook_app():
+    """Создает aiohttp приложение, передающее обновления в общий диспетчер dp"""
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    app.router.add_get("/health", handle_health)
+    return app
+
+async def run_webhook():
+    """
+    Запускает HTTP-сервер для приема обновлений и регистрирует webhook в Telegram.
+    
+    При SIGINT/SIGTERM сервер перестает принимать запросы и ждет до WEBHOOK_SHUTDOWN_TIMEOUT секунд,
+    пока завершится обработка уже принятых обновлений.
+    """
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook сервер запущен на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    
+    try:
+        await wait_for_shutdown_signal()
+    finally:
+        logger.info("Остановка webhook сервера...")
+        await site.stop()
+        await wait_update_tasks()
+        await runner.cleanup()
+        await bot.session.close()
+
+async def handle_metrics(request):
+    if prometheus_client is None:
+        return web.Response(status=503, text="prometheus_client не установлен")
+    return web.Response(body=prometheus_client.generate_latest(), headers={"Content-Type": prometheus_client.CONTENT_TYPE_LATEST})
+
+async def start_metrics_server(port):
+    """
+    Запускает локальный HTTP-сервер с метриками Prometheus на /metrics.
+    
+    Returns:
+        web.AppRunner или None, если сервер отключен или не удалось занять порт
+    """
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик на {METRICS_HOST}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+# Номер текущего рабочего процесса (None в основном процессе или при работе в одном процессе)
+WORKER_INDEX = None
+
+# Очереди обновлений рабочих процессов (заполняются только в основном процессе при BOT_WORKERS > 1)
+worker_update_queues = []
+
+def is_own_user(user_id):
+    """Проверяет, что данные пользователя обрабатываются текущим процессом"""
+    return WORKER_INDEX is None or user_id % BOT_WORKERS == WORKER_INDEX
+
+def get_worker_share(limit, worker_index, workers):
+    """Доля целого лимита для рабочего процесса: остаток от деления достается первым процессам, но не меньше 1"""
+    return max(1, limit // workers + (1 if worker_index < limit % workers else 0))
+
+def divide_limits_between_workers(worker_index, workers):
+    """
+    Делит между рабочими процессами общий лимит Telegram, лимиты частоты и одновременных запросов к провайдерам.
+    
+    Каждый процесс соблюдает лимиты только для своих запросов, поэтому без деления все процессы
+    вместе отправляли бы в workers раз больше запросов. Лимит одновременных запросов не опускается
+    ниже 1, поэтому провайдер с лимитом меньше количества процессов получает по запросу от каждого.
+    """
+    global_rate = TELEGRAM_GLOBAL_RATE / workers
+    telegram_send_scheduler.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+    for adapter in provider_adapters.values():
+        adapter.concurrency = get_worker_share(adapter.concurrency, worker_index, workers)
+        adapter.limiter = TokenBucket(adapter.limiter.max_rate / workers, max(1.0, adapter.limiter.capacity / workers))
+    admission_controller.max_concurrent = get_worker_share(MAX_CONCURRENT_REQUESTS, worker_index, workers)
+    admission_controller.provider_limits = {name: adapter.concurrency for name, adapter in provider_adapters.items()}
+
+def get_shard_file_path(path, worker_index, workers):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.shard{worker_index}of{workers}{ext}"
+
+def reshard_state_files(workers):
+    """
+    Раскладывает файлы настроек, истории и кратких содержаний по рабочим процессам.
+    
+    У каждого процесса свои файлы (user_history.shard0of4.json и т.д.), в которых только его пользователи.
+    Если файлы остались от запуска с другим количеством процессов, они объединяются и делятся заново.
+    Вызывается до запуска рабочих процессов, когда никто не пишет в эти файлы.
+    """
+    for path in (SETTINGS_FILE, HISTORY_FILE, SUMMARY_FILE):
+        stem, ext = os.path.splitext(path)
+        shard_pattern = re.compile(rf"^{re.escape(stem)}\.shard\d+of\d+{re.escape(ext)}$")
+        existing = [name for name in glob.glob(f"{glob.escape(stem)}.shard*{ext}") if shard_pattern.match(name)]
+        if os.path.exists(path):
+            existing.append(path)
+        
+        targets = [path] if workers == 1 else [get_shard_file_path(path, i, workers) for i in range(workers)]
+        if set(existing) <= set(targets):
+            continue
+        
+        try:
+            merged = {}
+            for name in existing:
+                with open(name, 'rb') as f:
+                    merged.update(json_loads(f.read()))
+            
+            split = {target: {} for target in targets}
+            for user_id, value in merged.items():
+                split[targets[int(user_id) % len(targets)]][user_id] = value
+            for target, data in split.items():
+                write_json_atomic(target, data, pretty=path != HISTORY_FILE)
+            for name in set(existing) - set(targets):
+                os.remove(name)
+            logger.info(f"Данные {path} ({len(merged)} пользователей) распределены по {workers} процессам")
+        except Exception as e:
+            logger.error(f"Ошибка при распределении {path} по процессам: {e}")
+            raise
+
+def route_update_to_worker(update):
+    """Передает обновление рабочему процессу, который обслуживает пользователя"""
+    user = getattr(update.event, "from_user", None)
+    shard_key = user.id if user is not None else update.update_id
+    worker_update_queues[shard_key % len(worker_update_queues)].put(
+        ("update", update.model_dump_json(exclude_none=True))
+    )
+
+async def relay_model_statuses(status_queue):
+    """Пересылает изменения статусов моделей от одного рабочего процесса всем остальным"""
+    while True:
+        message = await asyncio.to_thread(status_queue.get)
+        if message is None:
+            return
+        kind, source_index, model, status = message
+        set_model_status(model, status)
+        for worker_index, update_queue in enumerate(worker_update_queues):
+            if worker_index != source_index:
+                update_queue.put(("model_status", model, status))
+
+async def poll_updates_for_workers():
+    """Получает обновления через long polling и распределяет их по рабочим процессам"""
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+    await delete_webhook_for_polling()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Ошибка при получении обновлений: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            route_update_to_worker(update)
+            offset = update.update_id + 1
+
+async def run_workers():
+    """
+    Запускает BOT_WORKERS рабочих процессов и распределяет между ними обновления по user_id.
+    
+    Основной процесс получает обновления (через webhook или long polling) и не обрабатывает их сам.
+    При остановке рабочие процессы дообрабатывают принятые обновления и сохраняют данные.
+    """
+    context = multiprocessing.get_context("spawn")
+    status_queue = context.Queue()
+    processes = []
+    for worker_index in range(BOT_WORKERS):
+        update_queue = context.Queue()
+        worker_update_queues.append(update_queue)
+        process = context.Process(
+            target=run_worker,
+            args=(worker_index, BOT_WORKERS, update_queue, status_queue, MODEL_STATUSES),
+            name=f"bot-worker-{worker_index}",
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+    logger.info(f"Запущено рабочих процессов: {BOT_WORKERS}")
+    
+    relay_task = asyncio.create_task(relay_model_statuses(status_queue))
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            polling_task = asyncio.create_task(poll_updates_for_workers())
+            try:
+                await wait_for_shutdown_signal()
+            finally:
+                polling_task.cancel()
+                await bot.session.close()
+    finally:
+        logger.info("Останавливаем рабочие процессы...")
+        for update_queue in worker_update_queues:
+            update_queue.put(None)
+        for process in processes:
+            await asyncio.to_thread(process.join, WEBHOOK_SHUTDOWN_TIMEOUT + 10)
+            if process.is_alive():
+                logger.warning(f"Процесс {process.name} не завершился вовремя, останавливаем принудительно")
+                process.terminate()
+        status_queue.put(None)
+        await relay_task
+
+def run_worker(worker_index, workers, update_queue, status_queue, model_statuses):
+    # Сигналы остановки обрабатывает основной процесс, он же завершает рабочие через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_main(worker_index, workers, update_queue, status_queue, model_statuses))
+
+async def worker_main(worker_index, workers, update_queue, status_queue, model_statuses):
+    global WORKER_INDEX, BOT_WORKERS, SETTINGS_FILE, HISTORY_FILE, SUMMARY_FILE, MODEL_STATUSES, model_status_backend
+    
+    WORKER_INDEX = worker_index
+    BOT_WORKERS = workers
+    divide_limits_between_workers(worker_index, workers)
+    SETTINGS_FILE = get_shard_file_path(SETTINGS_FILE, worker_index, workers)
+    HISTORY_FILE = get_shard_file_path(HISTORY_FILE, worker_index, workers)
+    SUMMARY_FILE = get_shard_file_path(SUMMARY_FILE, worker_index, workers)
+    MODEL_STATUSES = model_statuses
+    if isinstance(span_exporter, FileSpanExporter):
+        # Строки, которые несколько процессов дописывают в один файл, могут перемешаться
+        span_exporter.path = get_shard_file_path(TRACE_FILE, worker_index, workers)
+    model_status_backend = create_model_status_backend(WorkerModelStatusBackend(status_queue, worker_index))
+    await model_status_backend.start()
+    
+    load_saved_state()
+    init_voice_recognition()
+    await discover_local_models()
+    
+    metrics_runner = await start_metrics_server(METRICS_PORT + 1 + worker_index if METRICS_PORT else 0)
+    loop_lag_monitor.start()
+    asyncio.create_task(periodic_save())
+    asyncio.create_task(periodic_eviction())
+    logger.info(f"Рабочий процесс {worker_index} готов к обработке обновлений")
+    
+    try:
+        while True:
+            message = await asyncio.to_thread(update_queue.get)
+            if message is None:
+                break
+            if message[0] == "update":
+                start_update_task(types.Update.model_validate_json(message[1], context={"bot": bot}))
+            elif message[0] == "model_status":
+                set_model_status(message[1], message[2])
+    finally:
+        await wait_update_tasks()
+        await snapshot_writer.flush()
+        await model_status_backend.close()
+        await close_provider_sessions()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+        logger.info(f"Рабочий процесс {worker_index} остановлен")
 
 async def periodic_save():
     """Периодически сохраняет настройки и историю сообщений пользователей"""
@@ -2318,9 +5087,8 @@ async def periodic_save():
         await asyncio.sleep(5 * 60)
         
         logger.info("Выполняем автоматическое сохранение данных...")
-        save_user_settings(user_settings)
-        save_user_history(user_message_history)
-        logger.info("Автоматическое сохранение выполнено успешно.")
+        if await snapshot_writer.flush():
+            logger.info("Автоматическое сохранение выполнено успешно.")
 
 # Функция для получения приоритетного списка запасных моделей
 def get_fallback_models(current_model):
@@ -2328,6 +5096,7 @@ def get_fallback_models(current_model):
     Создает приоритетный список запасных моделей на основе:
     1. Текущего провайдера API (предпочтение отдается моделям того же провайдера)
     2. Статуса работоспособности моделей
+    3. Ожидаемого времени до ответа по замерам model_router (если включен ADAPTIVE_ROUTING)
     
     Args:
         current_model: Текущая модель, для которой нужны запасные варианты
@@ -2335,21 +5104,13 @@ def get_fallback_models(current_model):
     Returns:
         list: Отсортированный список запасных моделей в порядке приоритета
     """
-    current_provider = None
-    if current_model.startswith('huggingface/'):
-        current_provider = 'huggingface'
-    elif current_model.startswith('together/'):
-        current_provider = 'together'
-    else:
-        current_provider = 'openrouter'
+    current_provider = get_model_provider(current_model)
     
     fallback_models = []
     
     # 1. Полностью рабочие модели того же провайдера
     for m in MODEL_STATUSES["fully_working"]:
-        if m != current_model and ((current_provider == 'huggingface' and m.startswith('huggingface/')) or 
-                               (current_provider == 'together' and m.startswith('together/')) or
-                               (current_provider == 'openrouter' and not (m.startswith('huggingface/') or m.startswith('together/')))):
+        if m != current_model and get_model_provider(m) == current_provider:
             fallback_models.append(m)
     
     # 2. Полностью рабочие модели других провайдеров
@@ -2360,9 +5121,7 @@ def get_fallback_models(current_model):
     # 3. Частично рабочие модели того же провайдера (только если полностью рабочих нет)
     if not fallback_models:
         for m in MODEL_STATUSES["partially_working"]:
-            if m != current_model and ((current_provider == 'huggingface' and m.startswith('huggingface/')) or 
-                                  (current_provider == 'together' and m.startswith('together/')) or
-                                  (current_provider == 'openrouter' and not (m.startswith('huggingface/') or m.startswith('together/')))):
+            if m != current_model and get_model_provider(m) == current_provider:
                 fallback_models.append(m)
     
     # 4. Частично рабочие модели других провайдеров (только если нет других вариантов)
@@ -2376,6 +5135,14 @@ def get_fallback_models(current_model):
         if reliable_model not in fallback_models and reliable_model in AVAILABLE_MODELS:
             fallback_models.append(reliable_model)
     
+    if ADAPTIVE_ROUTING:
+        fallback_models = model_router.rank(fallback_models)
+    
+    if LOCAL_LLM_PREFERRED_FALLBACK:
+        # Локальные модели не зависят от сети и лимитов бесплатных API, поэтому пробуются первыми
+        local_models = [m for m in fallback_models if get_model_provider(m) == "local"]
+        fallback_models = local_models + [m for m in fallback_models if m not in local_models]
+    
     return fallback_models
 
 # Функция для обновления статуса модели
@@ -2407,11 +5174,8 @@ def update_model_status(model, new_status=None, error_message=None):
     if new_status is None:
         return
     
-    for status in MODEL_STATUSES:
-        if model in MODEL_STATUSES[status]:
-            MODEL_STATUSES[status].remove(model)
-    
-    MODEL_STATUSES[new_status].append(model)
+    set_model_status(model, new_status)
+    model_status_backend.publish(model, new_status)
     
     if error_message:
         logger.warning(f"Статус модели {model} изменен на {new_status} из-за ошибки: {error_message}")
@@ -2435,6 +5199,7 @@ async def back_to_settings_menu(callback_query: types.CallbackQuery):
         [InlineKeyboardButton(text="📜 Длина истории", callback_data='setting_history_length')],
         [InlineKeyboardButton(text="✍️ Системное сообщение", callback_data='setting_system_message')],
         [InlineKeyboardButton(text="💬 Режим динамического чата", callback_data='setting_dynamic_chat')],
+        [InlineKeyboardButton(text="📦 Компактные ответы", callback_data='setting_compact_replies')],
         [InlineKeyboardButton(text="🔙 Вернуться в главное меню", callback_data='back_to_main')]
     ])
     
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Микробенчмарк форматирования ответов моделей для Telegram.
+
+Запуск из корня репозитория:
+    python bench/formatting.py [--repeat 5] [--save baseline.json] [--baseline baseline.json --threshold 0.25]
+
+Замеряет время и пиковый объем выделенной памяти process_content, format_code_blocks,
+format_markdown_to_html, sanitize_html_for_telegram и prepare_response_for_telegram на наборе
+типичных ответов моделей: с большим количеством кода, со списками, очень длинных
+и с намеренно запутанной разметкой.
+
+С --save результаты записываются в JSON файл. С --baseline результаты сравниваются с ранее
+сохраненными, и при замедлении или росте памяти больше чем на --threshold (доля) скрипт
+завершается с кодом 1. Базовые результаты зависят от машины, поэтому их нужно снимать
+на той же машине, что и сравниваемые.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:bench")
+
+import Bot  # noqa: E402
+
+CODE_SAMPLE = '''def fetch_all(urls, timeout=10):
+    results = {}
+    for url in urls:
+        if url.startswith("http") and len(url) < 2048:
+            results[url] = requests.get(url, timeout=timeout).text
+    return {k: v for k, v in results.items() if v}
+'''
+
+def make_code_heavy(rng, blocks=8):
+    parts = ["# Решение\n\nНиже несколько вариантов с `requests` и `aiohttp`:\n"]
+    for i in range(blocks):
+        lang = rng.choice(["python", "js", "bash", ""])
+        parts.append(f"## Вариант {i + 1}\n\nФункция `fetch_all` принимает **список** адресов:\n\n```{lang}\n{CODE_SAMPLE}```\n")
+    return "\n".join(parts)
+
+def make_list_heavy(rng, items=120):
+    lines = ["# Список", ""]
+    for i in range(items):
+        lines.append(f"* **Пункт {i}**: *описание* пункта с `кодом` и [ссылкой](https://example.com/{i})")
+        if rng.random() < 0.3:
+            lines.append(f"## Раздел {i}")
+    return "\n".join(lines)
+
+def make_huge(rng, size=40000):
+    parts = []
+    total = 0
+    while total < size:
+        part = rng.choice([
+            make_code_heavy(rng, blocks=1),
+            make_list_heavy(rng, items=10),
+            "Обычный абзац текста с **жирным**, *курсивом* и _подчеркиванием_. " * 5,
+        ])
+        parts.append(part)
+        total += len(part)
+    return "\n\n".join(parts)
+
+def make_adversarial(rng, depth=200):
+    # Глубоко вложенные и незакрытые теги, неизвестные теги, непарные звездочки и обратные кавычки
+    nested = "".join(f"<{rng.choice(['b', 'i', 'div', 'span', 'x' + str(i)])}>" for i in range(depth))
+    return (
+        "<think>рассуждение</think><!-- комментарий -->\\boxed{42}\n"
+        + nested + "текст" + "</div></span>" * (depth // 4) + "\n"
+        + "*" * 500 + "_" * 500 + "`" * 301 + "\n"
+        + "<pre><code class=\"python\">x = 1</pre></code>" * 50 + "\n"
+        + "```python\nнезакрытый блок кода\n" + "a < b && c > d\n" * 200
+    )
+
+def make_corpus(seed=1):
+    rng = random.Random(seed)
+    return {
+        "code_heavy": make_code_heavy(rng),
+        "list_heavy": make_list_heavy(rng),
+        "huge": make_huge(rng),
+        "adversarial": make_adversarial(rng),
+    }
+
+FUNCTIONS = {
+    "process_content": (Bot.process_content, lambda text: text),
+    "format_code_blocks": (Bot.format_code_blocks, lambda text: text),
+    "format_markdown_to_html": (Bot.format_markdown_to_html, lambda text: text),
+    # На вход очистки подается HTML, как в prepare_response_for_telegram
+    "sanitize_html_for_telegram": (Bot.sanitize_html_for_telegram, Bot.format_markdown_to_html),
+    "prepare_response_for_telegram": (Bot.prepare_response_for_telegram, lambda text: text),
+}
+
+def measure(func, argument, repeat, min_time=0.2):
+    """Возвращает лучшее время одного вызова в секундах и пиковую память одного вызова в байтах"""
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func(argument)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or loops >= 10 ** 6:
+            break
+        loops *= 2
+
+    best = elapsed / loops
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func(argument)
+        best = min(best, (time.perf_counter() - started) / loops)
+
+    tracemalloc.start()
+    func(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def compare(results, baseline, threshold):
+    """Возвращает список описаний регрессий относительно базовых результатов"""
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        for metric, unit, scale in (("time", "мкс", 1e6), ("peak", "КБ", 1 / 1024)):
+            if previous[metric] and current[metric] > previous[metric] * (1 + threshold):
+                regressions.append(
+                    f"{key}: {metric} {previous[metric] * scale:.1f} → {current[metric] * scale:.1f} {unit} "
+                    f"(+{(current[metric] / previous[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="записать результаты в JSON файл")
+    parser.add_argument("--baseline", help="сравнить с результатами из JSON файла")
+    parser.add_argument("--threshold", type=float, default=0.25, help="допустимое ухудшение (доля)")
+    args = parser.parse_args()
+
+    corpus = make_corpus()
+    results = {}
+    print(f"{'функция':<32}{'ответ':<14}{'размер':>8}{'время, мкс':>14}{'память, КБ':>13}")
+    for name, (func, prepare) in FUNCTIONS.items():
+        for corpus_name, text in corpus.items():
+            argument = prepare(text)
+            best, peak = measure(func, argument, args.repeat)
+            results[f"{name}/{corpus_name}"] = {"time": best, "peak": peak}
+            print(f"{name:<32}{corpus_name:<14}{len(argument):>8}{best * 1e6:>14.1f}{peak / 1024:>13.1f}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2, ensure_ascii=False)
+        print(f"\nРезультаты записаны в {args.save}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nРегрессии больше {args.threshold * 100:.0f}%:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print(f"\nРегрессий больше {args.threshold * 100:.0f}% нет")
+
+if __name__ == "__main__":
+    main()
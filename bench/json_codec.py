@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк JSON кодеков, доступных боту, на файле истории 10 000 пользователей.
+
+Запуск из корня репозитория:
+    python bench/json_codec.py [--users 10000] [--messages 20] [--repeat 5]
+
+Для каждого установленного кодека (json, orjson, msgspec) выводит лучшее время
+кодирования и разбора файла истории и его размер.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:bench")
+
+import Bot  # noqa: E402
+
+WORDS = [
+    "привет", "модель", "ответ", "вопрос", "история", "сообщение", "код", "python",
+    "функция", "данные", "пользователь", "настройки", "запрос", "как", "это", "работает",
+    "hello", "world", "async", "await", "список", "словарь", "ошибка", "пример"
+]
+
+def make_history_data(users, messages, seed=1):
+    """Строит данные файла истории в том виде, в котором их записывает save_user_history"""
+    rng = random.Random(seed)
+    history_data = {}
+    for user_id in range(users):
+        history = []
+        for i in range(messages):
+            role = Bot.ROLE_USER if i % 2 == 0 else Bot.ROLE_ASSISTANT
+            length = rng.randint(3, 20) if role == Bot.ROLE_USER else rng.randint(20, 80)
+            history.append(Bot.HistoryEntry(role, " ".join(rng.choice(WORDS) for _ in range(length))))
+        history_data[str(100000000 + user_id)] = [entry.to_dict() for entry in history]
+    return history_data
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    
+    history_data = make_history_data(args.users, args.messages)
+    print(f"История: {args.users} пользователей по {args.messages} сообщений, кодек бота по умолчанию: {Bot.JSON_BACKEND}")
+    print(f"{'кодек':<10}{'кодирование, мс':>18}{'разбор, мс':>14}{'размер, МБ':>14}")
+    
+    baseline = None
+    for name, (dumps, loads) in Bot.JSON_BACKENDS.items():
+        encoded = dumps(history_data)
+        assert loads(encoded) == history_data
+        encode_time = best_time(lambda: dumps(history_data), args.repeat)
+        decode_time = best_time(lambda: loads(encoded), args.repeat)
+        total = encode_time + decode_time
+        baseline = baseline or total
+        print(f"{name:<10}{encode_time * 1000:>18.1f}{decode_time * 1000:>14.1f}{len(encoded) / 1e6:>14.2f}"
+              f"   x{baseline / total:.1f}")
+
+if __name__ == "__main__":
+    main()
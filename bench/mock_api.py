@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Локальные заглушки OpenRouter, Together AI, Hugging Face, локального сервера моделей
+и Telegram Bot API для бенчмарков.
+
+Все заглушки работают в одном aiohttp приложении:
+    /openrouter/chat/completions     - OpenRouter (OPENROUTER_API_URL)
+    /together/chat/completions       - Together AI (TOGETHER_API_URL)
+    /huggingface/<модель>            - Hugging Face (HUGGINGFACE_API_URL)
+    /local/chat/completions, /local/models - локальный сервер моделей (LOCAL_LLM_URL), с потоковой генерацией
+    /bot<токен>/<метод>              - Telegram Bot API (TELEGRAM_API_URL)
+    /file/bot<токен>/<путь>          - скачивание файлов Telegram
+
+Задержка, доля ошибок и доля ответов 429 провайдеров (в том числе для отдельных моделей)
+настраиваются через MockConfig.
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+# Ответ модели с типичным для бота форматированием, чтобы форматирование тоже попадало в замер
+MOCK_REPLY = (
+    "# Ответ\n\n"
+    "Вот **краткий** ответ на *ваш* вопрос:\n\n"
+    "* первый пункт со `встроенным кодом`\n"
+    "* второй пункт\n\n"
+    "```python\n"
+    "def answer(question):\n"
+    "    return question.upper()\n"
+    "```\n\n"
+    "Вопрос был: "
+)
+
+@dataclass
+class MockConfig:
+    latency: float = 0.5             # Средняя задержка ответа провайдера (в секундах)
+    jitter: float = 0.2              # Разброс задержки: равномерно в пределах ±jitter
+    error_rate: float = 0.0          # Доля ответов 503
+    rate_limit_rate: float = 0.0     # Доля ответов 429
+    retry_after: float = 1.0         # Значение заголовка Retry-After в ответах 429
+    telegram_latency: float = 0.02   # Задержка ответа Telegram Bot API (в секундах)
+    down_models: set = field(default_factory=set)  # Модели (в именах API провайдера), которые всегда отвечают 503
+    model_latency: dict = field(default_factory=dict)     # Средняя задержка отдельных моделей: модель -> секунды
+    model_error_rate: dict = field(default_factory=dict)  # Доля ответов 503 отдельных моделей: модель -> доля
+    files: dict = field(default_factory=dict)       # Файлы для getFile: file_id -> содержимое
+    local_models: tuple = ("qwen2.5-3b-instruct",)  # Модели локального сервера
+    chunk_delay: float = 0.05        # Пауза между частями потокового ответа (в секундах)
+
+class MockApi:
+    """Заглушки API с подсчетом запросов по провайдерам, моделям и ответам"""
+
+    def __init__(self, config, seed=1):
+        self.config = config
+        self.rng = random.Random(seed)
+        self.requests = Counter()       # (провайдер, модель, код ответа) -> количество
+        self.telegram_calls = Counter() # метод -> количество
+        self.sent_texts = []            # (chat_id, текст) всех отправленных и измененных сообщений
+        self.message_ids = itertools.count(1)
+        self.runner = None
+
+    def create_app(self):
+        app = web.Application(client_max_size=50 * 1024 ** 2)
+        app.router.add_post("/openrouter/chat/completions", self.handle_chat_completions)
+        app.router.add_post("/together/chat/completions", self.handle_chat_completions)
+        app.router.add_post("/huggingface/{model:.+}", self.handle_huggingface)
+        app.router.add_post("/local/chat/completions", self.handle_chat_completions)
+        app.router.add_get("/local/models", self.handle_local_models)
+        app.router.add_post("/bot{token}/{method}", self.handle_telegram)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_telegram_file)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Запускает сервер и возвращает его адрес вида http://host:port"""
+        self.runner = web.AppRunner(self.create_app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def _provider_response(self, provider, model):
+        """Имитирует задержку и сбои провайдера. Возвращает ответ с ошибкой или None"""
+        config = self.config
+        latency = config.model_latency.get(model, config.latency)
+        await asyncio.sleep(max(0.0, latency + self.rng.uniform(-config.jitter, config.jitter)))
+        if model in config.down_models or self.rng.random() < config.model_error_rate.get(model, config.error_rate):
+            self.requests[provider, model, 503] += 1
+            return web.json_response({"error": "Service Unavailable"}, status=503)
+        if self.rng.random() < config.rate_limit_rate:
+            self.requests[provider, model, 429] += 1
+            return web.json_response(
+                {"error": "Rate limit exceeded"}, status=429,
+                headers={"Retry-After": str(config.retry_after)}
+            )
+        self.requests[provider, model, 200] += 1
+        return None
+
+    async def handle_chat_completions(self, request):
+        provider = request.path.split("/")[1]
+        body = await request.json()
+        model = body.get("model")
+        error = await self._provider_response(provider, model)
+        if error is not None:
+            return error
+        question = body["messages"][-1]["content"][:200]
+        if body.get("stream"):
+            return await self._stream_reply(request, MOCK_REPLY + question)
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": MOCK_REPLY + question}}]})
+
+    async def _stream_reply(self, request, text):
+        """Отдает ответ частями в формате server-sent events, как OpenAI-совместимые серверы"""
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for start in range(0, len(text), 16):
+            chunk = {"choices": [{"index": 0, "delta": {"content": text[start:start + 16]}}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            await asyncio.sleep(self.config.chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def handle_local_models(self, request):
+        return web.json_response({"object": "list", "data": [
+            {"id": model, "object": "model", "owned_by": "local"} for model in self.config.local_models
+        ]})
+
+    async def handle_huggingface(self, request):
+        body = await request.json()
+        model = request.match_info["model"]
+        error = await self._provider_response("huggingface", model)
+        if error is not None:
+            return error
+        return web.json_response([{"generated_text": body["inputs"] + MOCK_REPLY + "Hugging Face"}])
+
+    async def handle_telegram(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.telegram_calls[method] += 1
+        if self.config.telegram_latency:
+            await asyncio.sleep(self.config.telegram_latency)
+
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(data.get("chat_id", 0))
+            text = str(data.get("text", ""))
+            self.sent_texts.append((chat_id, text))
+            message_id = int(data["message_id"]) if "message_id" in data else next(self.message_ids)
+            return self._ok({
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": text
+            })
+        if method == "getFile":
+            file_id = data["file_id"]
+            if file_id not in self.config.files:
+                return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: file not found"}, status=400)
+            return self._ok({
+                "file_id": file_id, "file_unique_id": file_id,
+                "file_size": len(self.config.files[file_id]), "file_path": f"voice/{file_id}.oga"
+            })
+        if method == "getMe":
+            return self._ok({"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+        return self._ok(True)
+
+    async def handle_telegram_file(self, request):
+        file_id = request.match_info["path"].rsplit("/", 1)[-1].split(".")[0]
+        if file_id not in self.config.files:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.config.files[file_id], content_type="audio/ogg")
+
+    @staticmethod
+    def _ok(result):
+        return web.Response(text=json.dumps({"ok": True, "result": result}), content_type="application/json")
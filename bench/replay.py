@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный бенчмарк бота без доступа к сети.
+
+Запуск из корня репозитория:
+    python bench/replay.py [--users 50] [--messages 5] [--latency 0.5] [--error-rate 0.05]
+
+Запускает локальные заглушки OpenRouter, Together AI, Hugging Face и Telegram Bot API
+(bench/mock_api.py), направляет на них бота через OPENROUTER_API_URL, TOGETHER_API_URL,
+HUGGINGFACE_API_URL и TELEGRAM_API_URL и пропускает синтетические сообщения пользователей
+через настоящие обработчики dp. Выводит пропускную способность, задержку ответа
+(p50/p95/p99), количество ответов запасными моделями и ошибок, а также запросы к API.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_api import MockApi, MockConfig  # noqa: E402
+
+QUESTIONS = [
+    "Привет! Как дела?",
+    "Напиши функцию на Python, которая сортирует список словарей по ключу",
+    "Чем отличается процесс от потока?",
+    "Объясни, что такое асинхронность, простыми словами",
+    "Составь список из пяти книг по истории",
+    "Как приготовить борщ?",
+    "Переведи на английский: хорошего дня",
+    "Почему небо голубое?",
+]
+
+def find_free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def configure_bot_environment(base_url):
+    """Направляет бота на заглушки. Вызывается до импорта Bot, так как адреса читаются при импорте"""
+    os.environ["OPENROUTER_API_URL"] = f"{base_url}/openrouter/chat/completions"
+    os.environ["TOGETHER_API_URL"] = f"{base_url}/together/chat/completions"
+    os.environ["HUGGINGFACE_API_URL"] = f"{base_url}/huggingface"
+    os.environ["TELEGRAM_API_URL"] = base_url
+    os.environ["TELEGRAM_TOKEN"] = "123456:bench"
+    for name in ("OPENROUTER_API_KEY", "TOGETHER_API_KEY", "HUGGINGFACE_API_KEY"):
+        os.environ[name] = "bench"
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def classify_reply(texts):
+    """Определяет исход обработки сообщения по последнему тексту, отправленному в чат"""
+    if not texts:
+        return "no_reply"
+    text = texts[-1]
+    if "Произошла ошибка" in text:
+        return "error"
+    if "очень много запросов" in text:
+        return "overloaded"
+    if "запасная модель" in text:
+        return "fallback"
+    return "ok"
+
+class Replay:
+    def __init__(self, Bot, mock, args):
+        self.Bot = Bot
+        self.mock = mock
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.update_ids = iter(range(1, 10 ** 9))
+        self.latencies = []
+        self.outcomes = Counter()
+
+    def make_update(self, user_id, text):
+        from aiogram.types import Update
+        update_id = next(self.update_ids)
+        return Update.model_validate({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "text": text
+            }
+        }, context={"bot": self.Bot.bot})
+
+    async def run_user(self, user_id):
+        # Пользователи начинают писать не одновременно
+        await asyncio.sleep(self.rng.uniform(0, self.args.ramp_up))
+        for _ in range(self.args.messages):
+            update = self.make_update(user_id, self.rng.choice(QUESTIONS))
+            sent_before = len(self.mock.sent_texts)
+            started = time.perf_counter()
+            await self.Bot.dp.feed_update(self.Bot.bot, update)
+            self.latencies.append(time.perf_counter() - started)
+            texts = [text for chat_id, text in self.mock.sent_texts[sent_before:] if chat_id == user_id]
+            self.outcomes[classify_reply(texts)] += 1
+            await asyncio.sleep(self.rng.expovariate(1 / self.args.think_time) if self.args.think_time else 0)
+
+    async def run(self):
+        first_user = 100000000
+        started = time.perf_counter()
+        await asyncio.gather(*(self.run_user(first_user + i) for i in range(self.args.users)))
+        return time.perf_counter() - started
+
+def print_report(replay, mock, elapsed):
+    total = len(replay.latencies)
+    print(f"\nСообщений: {total} за {elapsed:.1f} сек, {total / elapsed:.2f} сообщ/сек")
+    print(f"Задержка ответа, сек: p50 {percentile(replay.latencies, 50):.3f}  "
+          f"p95 {percentile(replay.latencies, 95):.3f}  p99 {percentile(replay.latencies, 99):.3f}  "
+          f"макс {max(replay.latencies, default=0):.3f}")
+    print("Исходы: " + ", ".join(f"{name} {count}" for name, count in sorted(replay.outcomes.items())))
+
+    print(f"\n{'провайдер':<12}{'модель':<50}{'200':>7}{'429':>7}{'503':>7}")
+    models = sorted({(provider, model) for provider, model, _ in mock.requests})
+    for provider, model in models:
+        counts = [mock.requests[provider, model, status] for status in (200, 429, 503)]
+        print(f"{provider:<12}{model:<50}" + "".join(f"{count:>7}" for count in counts))
+
+    print("\nЗапросы к Telegram Bot API: " + ", ".join(
+        f"{method} {count}" for method, count in mock.telegram_calls.most_common()
+    ))
+
+async def run(args):
+    host = "127.0.0.1"
+    port = find_free_port(host)
+    configure_bot_environment(f"http://{host}:{port}")
+    # Файлы состояния бота пишутся во временный каталог, а не в рабочий каталог репозитория
+    os.chdir(tempfile.mkdtemp(prefix="bot-bench-"))
+
+    import Bot
+    logging.getLogger().setLevel(args.log_level)
+
+    config = MockConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        telegram_latency=args.telegram_latency,
+        down_models=set(args.down_model)
+    )
+    mock = MockApi(config, seed=args.seed)
+    await mock.start(host, port)
+
+    # Как после успешной проверки моделей при запуске
+    Bot.MODEL_STATUSES["fully_working"] = list(Bot.AVAILABLE_MODELS)
+    if args.model:
+        Bot.DEFAULT_SETTINGS["model"] = args.model
+
+    replay = Replay(Bot, mock, args)
+    print(f"Пользователей: {args.users}, сообщений на пользователя: {args.messages}, "
+          f"модель: {Bot.DEFAULT_SETTINGS['model']}")
+    try:
+        elapsed = await replay.run()
+    finally:
+        for task in list(Bot.summary_tasks.values()):
+            task.cancel()
+        await Bot.close_provider_sessions()
+        await Bot.bot.session.close()
+        await mock.close()
+    print_report(replay, mock, elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="количество одновременных пользователей")
+    parser.add_argument("--messages", type=int, default=5, help="сообщений от каждого пользователя")
+    parser.add_argument("--think-time", type=float, default=2.0, help="средняя пауза между сообщениями пользователя (сек)")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--model", help="модель пользователей (по умолчанию из DEFAULT_SETTINGS)")
+    parser.add_argument("--latency", type=float, default=0.5, help="средняя задержка провайдера (сек)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="разброс задержки провайдера (сек)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After в ответах 429 (сек)")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="задержка Telegram Bot API (сек)")
+    parser.add_argument("--down-model", action="append", default=[],
+                        help="модель в имени API провайдера, которая всегда отвечает 503 (можно повторять)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="ERROR", help="уровень логов бота")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
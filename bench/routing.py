@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Симуляция выбора запасных моделей по замерам задержки и доли успешных ответов.
+
+Запуск из корня репозитория:
+    python bench/routing.py [--users 20] [--messages 8] [--scale 1.0]
+
+Каждой модели на заглушках провайдеров (bench/mock_api.py) назначается своя задержка и доля
+ошибок: есть быстрые и надежные модели, быстрые, но часто отказывающие, и медленные. Основная
+модель пользователей отвечает только ошибками, поэтому каждый ответ дает запасная модель.
+
+Один и тот же поток сообщений прогоняется в трех режимах:
+    static    - фиксированный порядок запасных моделей (ADAPTIVE_ROUTING=0)
+    adaptive  - порядок по ожидаемому времени до ответа (model_router)
+    auto      - пользователи с моделью "auto": основная модель тоже выбирается по замерам
+
+Для каждого режима выводится время до ответа (p50/p95/среднее), исходы и число запросов
+к моделям на одно сообщение.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+from argparse import Namespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_api import MockApi, MockConfig  # noqa: E402
+from replay import Replay, configure_bot_environment, find_free_port, percentile  # noqa: E402
+
+# Профили моделей: (доля моделей, диапазон задержки в секундах, доля ошибок)
+MODEL_PROFILES = [
+    (0.2, (0.3, 0.6), 0.02),   # быстрые и надежные
+    (0.3, (0.3, 0.6), 0.6),    # быстрые, но часто отказывающие
+    (0.5, (1.5, 4.0), 0.1),    # медленные
+]
+
+def make_model_profiles(Bot, models, rng, scale):
+    """Назначает моделям задержку и долю ошибок. Возвращает словари для MockConfig в именах API провайдеров"""
+    latency = {}
+    error_rate = {}
+    shuffled = list(models)
+    rng.shuffle(shuffled)
+    start = 0
+    for index, (share, (low, high), errors) in enumerate(MODEL_PROFILES):
+        end = len(shuffled) if index == len(MODEL_PROFILES) - 1 else start + round(share * len(shuffled))
+        for model in shuffled[start:end]:
+            api_model = Bot.get_provider_adapter(model).api_model(model)
+            latency[api_model] = rng.uniform(low, high) * scale
+            error_rate[api_model] = errors
+        start = end
+    return latency, error_rate
+
+async def run_mode(Bot, mock, args, mode, primary_model):
+    # Каждый режим начинается с одинакового состояния: все модели рабочие, замеров нет
+    Bot.MODEL_STATUSES["fully_working"] = list(Bot.AVAILABLE_MODELS)
+    Bot.MODEL_STATUSES["partially_working"] = []
+    Bot.MODEL_STATUSES["unavailable"] = []
+    Bot.model_router = Bot.ModelRouter()
+    Bot.ADAPTIVE_ROUTING = mode != "static"
+    Bot.DEFAULT_SETTINGS["model"] = Bot.AUTO_MODEL if mode == "auto" else primary_model
+    Bot.user_settings.clear()
+    Bot.user_message_history.clear()
+    mock.rng = random.Random(args.seed)
+    mock.requests.clear()
+    mock.sent_texts.clear()
+
+    replay = Replay(Bot, mock, Namespace(
+        users=args.users, messages=args.messages, think_time=args.think_time, ramp_up=args.ramp_up, seed=args.seed
+    ))
+    elapsed = await replay.run()
+    for task in list(Bot.summary_tasks.values()):
+        task.cancel()
+    attempts = sum(mock.requests.values())
+    return replay, elapsed, attempts
+
+async def run(args):
+    host = "127.0.0.1"
+    port = find_free_port(host)
+    configure_bot_environment(f"http://{host}:{port}")
+    os.chdir(tempfile.mkdtemp(prefix="bot-bench-routing-"))
+
+    import Bot
+    logging.getLogger().setLevel(args.log_level)
+
+    primary_model = args.model or Bot.DEFAULT_SETTINGS["model"]
+    rng = random.Random(args.seed)
+    candidates = [model for model in Bot.AVAILABLE_MODELS if model != primary_model]
+    model_latency, model_error_rate = make_model_profiles(Bot, candidates, rng, args.scale)
+    primary_api_model = Bot.get_provider_adapter(primary_model).api_model(primary_model)
+    config = MockConfig(
+        latency=args.scale,
+        jitter=0.1 * args.scale,
+        telegram_latency=0.01,
+        down_models={primary_api_model},
+        model_latency=model_latency,
+        model_error_rate=model_error_rate
+    )
+    mock = MockApi(config, seed=args.seed)
+    await mock.start(host, port)
+
+    print(f"Пользователей: {args.users}, сообщений на пользователя: {args.messages}, "
+          f"недоступная основная модель: {primary_model}, моделей-кандидатов: {len(candidates)}")
+    print(f"\n{'режим':<10}{'p50':>8}{'p95':>8}{'среднее':>10}{'запросов/сообщ':>16}  исходы")
+    try:
+        for mode in args.modes.split(","):
+            replay, elapsed, attempts = await run_mode(Bot, mock, args, mode, primary_model)
+            latencies = replay.latencies
+            mean = sum(latencies) / len(latencies) if latencies else 0.0
+            outcomes = ", ".join(f"{name} {count}" for name, count in sorted(replay.outcomes.items()))
+            print(f"{mode:<10}{percentile(latencies, 50):>8.2f}{percentile(latencies, 95):>8.2f}{mean:>10.2f}"
+                  f"{attempts / max(len(latencies), 1):>16.2f}  {outcomes}")
+            if mode != "static":
+                best = Bot.model_router.rank(candidates)[:3]
+                print("          лучшие по замерам: " + "; ".join(
+                    f"{model.split('/')[-1]} ({Bot.model_router.describe(model)})" for model in best
+                ))
+    finally:
+        await Bot.close_provider_sessions()
+        await Bot.bot.session.close()
+        await mock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="количество одновременных пользователей")
+    parser.add_argument("--messages", type=int, default=8, help="сообщений от каждого пользователя")
+    parser.add_argument("--think-time", type=float, default=0.5, help="средняя пауза между сообщениями пользователя (сек)")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--model", help="недоступная основная модель (по умолчанию из DEFAULT_SETTINGS)")
+    parser.add_argument("--scale", type=float, default=1.0, help="множитель задержек моделей")
+    parser.add_argument("--modes", default="static,adaptive,auto", help="режимы через запятую")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="CRITICAL", help="уровень логов бота (ошибки моделей в симуляции ожидаемы)")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
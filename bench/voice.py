@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк обработки голосовых сообщений.
+
+Запуск из корня репозитория:
+    python bench/voice.py [--count 40] [--concurrency 8] [--durations 3,10,30] [--recognizer stub|vosk]
+
+Генерирует синтетические OGG/Opus сообщения заданной длительности (нужен ffmpeg) или берет
+готовые .ogg файлы из --samples, и пропускает их через настоящий обработчик голосовых сообщений:
+скачивание с заглушки Telegram Bot API (bench/mock_api.py), конвертация ffmpeg, распознавание
+и ответ модели. Одновременно обрабатывается не больше --concurrency сообщений.
+
+Распознаватель выбирается через --recognizer: vosk использует модель из --vosk-model (подойдет
+и маленькая vosk-model-small-ru), stub вместо распознавания ждет длительность * --stub-rtf секунд,
+поэтому бенчмарк работает на любой машине с Linux и ffmpeg.
+
+Выводит пропускную способность (сообщений в минуту), коэффициент реального времени (RTF)
+конвертации и распознавания, ожидание в очереди пулов потоков (ffmpeg и отдельного пула Vosk),
+загрузку CPU и пиковую память.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import glob
+import logging
+import math
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from array import array
+from collections import defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_api import MockApi, MockConfig  # noqa: E402
+from replay import configure_bot_environment, find_free_port, percentile  # noqa: E402
+
+SAMPLE_RATE = 16000
+
+def write_speech_like_wav(path, duration, rng):
+    """Пишет WAV с речеподобным сигналом: слоги с меняющимся тоном, паузы и шум"""
+    samples = array("h")
+    t = 0
+    total = int(duration * SAMPLE_RATE)
+    while len(samples) < total:
+        syllable = int(rng.uniform(0.12, 0.3) * SAMPLE_RATE)
+        pitch = rng.uniform(90, 250)
+        for i in range(syllable):
+            envelope = math.sin(math.pi * i / syllable)
+            phase = 2 * math.pi * pitch * t / SAMPLE_RATE
+            value = envelope * (0.5 * math.sin(phase) + 0.3 * math.sin(2 * phase) + 0.2 * math.sin(3 * phase))
+            samples.append(int(12000 * value + rng.gauss(0, 300)))
+            t += 1
+        pause = int(rng.uniform(0.02, 0.15) * SAMPLE_RATE)
+        samples.extend(int(rng.gauss(0, 300)) for _ in range(pause))
+        t += pause
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples[:total].tobytes())
+
+def make_samples(durations, directory, seed):
+    """Кодирует синтетические сообщения в OGG/Opus, как их присылает Telegram. Возвращает {длительность: байты}"""
+    rng = random.Random(seed)
+    samples = {}
+    for duration in durations:
+        wav_path = os.path.join(directory, f"sample{duration}.wav")
+        ogg_path = os.path.join(directory, f"sample{duration}.ogg")
+        write_speech_like_wav(wav_path, duration, rng)
+        subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", wav_path,
+             "-c:a", "libopus", "-b:a", "24k", "-ar", "48000", ogg_path],
+            check=True
+        )
+        with open(ogg_path, "rb") as file:
+            samples[duration] = file.read()
+    return samples
+
+def load_samples(directory):
+    """Читает готовые .ogg файлы. Длительность берется из имени файла вида <секунды>.ogg или через ffprobe"""
+    samples = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.ogg"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            duration = float(name)
+        except ValueError:
+            probe = subprocess.run(
+                ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+                capture_output=True, text=True, check=True
+            )
+            duration = float(probe.stdout.strip())
+        with open(path, "rb") as file:
+            samples[duration] = file.read()
+    return samples
+
+class MeasuredExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Пул потоков по умолчанию для цикла событий, который замеряет ожидание и выполнение задач"""
+
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers, thread_name_prefix="bench-worker")
+        self.waits = defaultdict(list)
+        self.runs = defaultdict(list)
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted = time.perf_counter()
+        # asyncio.to_thread передает функцию как functools.partial(context.run, func, ...)
+        target = fn.args[0] if isinstance(fn, functools.partial) and fn.args else fn
+        name = getattr(target, "__name__", repr(target))
+
+        def run():
+            started = time.perf_counter()
+            self.waits[name].append(started - submitted)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.runs[name].append(time.perf_counter() - started)
+
+        return super().submit(run)
+
+def make_stub_recognizer(rtf):
+    def recognize_with_vosk(audio_file_path, stop_event):
+        with wave.open(audio_file_path, "rb") as wav:
+            duration = wav.getnframes() / wav.getframerate()
+        time.sleep(duration * rtf)
+        return "тестовое голосовое сообщение"
+    return recognize_with_vosk
+
+def cpu_seconds():
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+async def run(args):
+    if not shutil.which("ffmpeg"):
+        sys.exit("Для бенчмарка нужен ffmpeg в PATH")
+
+    samples_dir = tempfile.mkdtemp(prefix="bot-bench-voice-")
+    if args.samples:
+        samples = load_samples(args.samples)
+    else:
+        durations = [float(value) for value in args.durations.split(",")]
+        samples = make_samples(durations, samples_dir, args.seed)
+    if not samples:
+        sys.exit("Нет голосовых сообщений для бенчмарка")
+
+    host = "127.0.0.1"
+    port = find_free_port(host)
+    configure_bot_environment(f"http://{host}:{port}")
+    os.chdir(samples_dir)
+
+    import Bot
+    logging.getLogger().setLevel(args.log_level)
+
+    if args.recognizer == "vosk":
+        Bot.VOSK_MODEL_PATH = args.vosk_model
+        if not Bot.init_vosk_model():
+            sys.exit(f"Не удалось загрузить модель Vosk из {args.vosk_model}")
+    else:
+        Bot.recognize_with_vosk = make_stub_recognizer(args.stub_rtf)
+        Bot.vosk_model = "stub"
+        Bot.use_local_recognition = True
+
+    files = {f"voice{index}": data for index, data in enumerate(samples.values())}
+    file_durations = dict(zip(files, samples))
+    mock = MockApi(MockConfig(latency=args.latency, jitter=0, files=files), seed=args.seed)
+    await mock.start(host, port)
+    Bot.MODEL_STATUSES["fully_working"] = list(Bot.AVAILABLE_MODELS)
+
+    loop = asyncio.get_running_loop()
+    executor = MeasuredExecutor(args.workers)
+    loop.set_default_executor(executor)
+    recognition_executor = MeasuredExecutor(args.recognition_workers or Bot.VOICE_RECOGNITION_WORKERS)
+    Bot.vosk_executor = recognition_executor
+
+    from aiogram.types import Update
+    jobs = asyncio.Queue()
+    for index in range(args.count):
+        jobs.put_nowait(list(files)[index % len(files)])
+    latencies = []
+    audio_seconds = 0.0
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def sender(worker):
+        nonlocal audio_seconds
+        while not jobs.empty():
+            file_id = jobs.get_nowait()
+            duration = file_durations[file_id]
+            user_id = 100000000 + worker
+            update = Update.model_validate({
+                "update_id": next(update_ids),
+                "message": {
+                    "message_id": 1, "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+                    "voice": {"file_id": file_id, "file_unique_id": file_id,
+                              "duration": math.ceil(duration), "mime_type": "audio/ogg"}
+                }
+            }, context={"bot": Bot.bot})
+            started = time.perf_counter()
+            await Bot.dp.feed_update(Bot.bot, update)
+            latencies.append(time.perf_counter() - started)
+            audio_seconds += duration
+
+    print(f"Сообщений: {args.count}, длительности: {', '.join(f'{d:g}' for d in samples)} сек, "
+          f"одновременно: {args.concurrency}, потоков: {args.workers}, потоков распознавания: "
+          f"{recognition_executor._max_workers}, распознаватель: {args.recognizer}")
+    cpu_before = cpu_seconds()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(sender(worker) for worker in range(args.concurrency)))
+    finally:
+        elapsed = time.perf_counter() - started
+        cpu_used = cpu_seconds() - cpu_before
+        await Bot.close_provider_sessions()
+        await Bot.bot.session.close()
+        await mock.close()
+        executor.shutdown(wait=False)
+        recognition_executor.shutdown(wait=False)
+
+    print(f"\nОбработано {len(latencies)} сообщений ({audio_seconds:.0f} сек аудио) за {elapsed:.1f} сек: "
+          f"{len(latencies) / elapsed * 60:.1f} сообщ/мин")
+    print(f"Время обработки сообщения, сек: p50 {percentile(latencies, 50):.2f}  "
+          f"p95 {percentile(latencies, 95):.2f}  макс {max(latencies, default=0):.2f}")
+    print(f"RTF всего конвейера: {sum(latencies) / audio_seconds if audio_seconds else 0:.3f}")
+    for pool, name, label in ((executor, "run", "ffmpeg"), (recognition_executor, "recognize_with_vosk", "распознавание")):
+        runs = pool.runs.get(name, [])
+        waits = pool.waits.get(name, [])
+        if runs:
+            print(f"{label}: RTF {sum(runs) / audio_seconds:.3f}, "
+                  f"ожидание в очереди p50 {percentile(waits, 50) * 1000:.0f} мс, p95 {percentile(waits, 95) * 1000:.0f} мс")
+    print(f"CPU: {cpu_used / elapsed * 100:.0f}% одного ядра (бот и ffmpeg вместе)")
+    # ru_maxrss в Linux измеряется в килобайтах
+    print(f"Пиковая память: бот {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} МБ, "
+          f"ffmpeg {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.0f} МБ")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=40, help="сколько голосовых сообщений обработать")
+    parser.add_argument("--concurrency", type=int, default=8, help="сколько сообщений обрабатывается одновременно")
+    parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 1) + 4),
+                        help="размер пула потоков по умолчанию (ffmpeg)")
+    parser.add_argument("--recognition-workers", type=int, default=0,
+                        help="размер пула распознавания (0 - VOICE_RECOGNITION_WORKERS бота)")
+    parser.add_argument("--durations", default="3,10,30", help="длительности синтетических сообщений (сек)")
+    parser.add_argument("--samples", help="каталог с готовыми .ogg файлами вместо синтетических")
+    parser.add_argument("--recognizer", choices=["stub", "vosk"], default="stub")
+    parser.add_argument("--vosk-model", default="vosk-model-small-ru-0.22", help="путь к модели Vosk")
+    parser.add_argument("--stub-rtf", type=float, default=0.1, help="RTF распознавателя-заглушки")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа модели после распознавания (сек)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="ERROR", help="уровень логов бота")
+    args = parser.parse_args()
+    if args.recognizer == "vosk":
+        args.vosk_model = os.path.abspath(args.vosk_model)
+    if args.samples:
+        args.samples = os.path.abspath(args.samples)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()